@@ -0,0 +1,150 @@
+# asgi.py
+# Native ASGI webhook: PTB runs on the server's own event loop, so an update
+# goes from the request straight into application.update_queue with no thread
+# hop. Run with lifespan enabled, e.g.:
+#   uvicorn asgi:app --host 0.0.0.0 --port 8000
+#   gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+# GET / answers while the process is up; GET /ready only once PTB has started
+# and the DB is migrated (503 with the failing part otherwise).
+import json
+import logging
+
+from telegram import Update
+
+import bot
+import db
+import metrics
+
+# ===================== SETTINGS =====================
+# shared with the Flask webhook, see bot.py
+WEBHOOK_SECRET = bot.WEBHOOK_SECRET
+WEBHOOK_PATH = f"/{bot.BOT_TOKEN}"
+WEBHOOK_QUEUE_SIZE = bot.WEBHOOK_QUEUE_SIZE
+MAX_BODY_BYTES = 1024 * 1024
+
+log = logging.getLogger(__name__)
+
+# built at lifespan startup, in the worker that serves requests
+application = None
+dedupe = bot.update_dedupe
+
+# ===================== HTTP HELPERS =====================
+async def _respond(send, status: int, body: bytes = b"", headers=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"text/plain; charset=utf-8"), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _read_body(receive):
+    chunks, size = [], 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+def _header(scope, name: bytes) -> bytes:
+    for key, value in scope["headers"]:
+        if key == name:
+            return value
+    return b""
+
+# ===================== ENDPOINTS =====================
+async def webhook(scope, receive, send):
+    if WEBHOOK_SECRET and _header(scope, b"x-telegram-bot-api-secret-token").decode() != WEBHOOK_SECRET:
+        return await _respond(send, 403, b"forbidden")
+    if not application.running:
+        # stopping: nothing would process the update, so leave it unclaimed for redelivery
+        return await _respond(send, 503, b"stopping", [(b"retry-after", b"1")])
+    processor = application.update_processor
+    if processor.full():
+        # refuse before spending time on the body
+        return await _respond(send, 503, b"busy", [(b"retry-after", b"1")])
+    body = await _read_body(receive)
+    if body is None:
+        return await _respond(send, 413, b"too large")
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return await _respond(send, 400, b"bad update")
+    update_id = data.get("update_id") if isinstance(data, dict) else None
+    if isinstance(update_id, int) and not dedupe.claim(update_id):
+        # a redelivery of an update already taken: acknowledge, skip parsing
+        return await _respond(send, 200, b"ok")
+    try:
+        update = Update.de_json(data, application.bot)
+    except (ValueError, TypeError, KeyError):
+        dedupe.release(update_id)
+        return await _respond(send, 400, b"bad update")
+    if not processor.admit(update.update_id):
+        # refused: Telegram retries, and that retry must not count as a duplicate
+        dedupe.release(update_id)
+        return await _respond(send, 503, b"busy", [(b"retry-after", b"1")])
+    application.update_queue.put_nowait(update)
+    await _respond(send, 200, b"ok")
+
+async def index(scope, receive, send):
+    await _respond(send, 200, "Bot is running".encode())
+
+async def ready(scope, receive, send):
+    ok, report = bot.readiness(application, await db.run(bot.db_status))
+    await send({
+        "type": "http.response.start",
+        "status": 200 if ok else 503,
+        "headers": [(b"content-type", b"application/json")],
+    })
+    await send({"type": "http.response.body", "body": json.dumps(report).encode()})
+
+async def metrics_endpoint(scope, receive, send):
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", metrics.CONTENT_TYPE.encode())],
+    })
+    await send({"type": "http.response.body", "body": metrics.render().encode()})
+
+# ===================== LIFESPAN =====================
+async def _lifespan(receive, send):
+    global application
+    tasks = []
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                application = bot.make_app(max_pending=WEBHOOK_QUEUE_SIZE)
+                tasks = await bot.start_runtime(application)
+            except Exception as e:
+                bot.startup_error = str(e)
+                log.exception("startup failed")
+                await send({"type": "lifespan.startup.failed", "message": str(e)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await bot.stop_runtime(application, tasks)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+# ===================== ASGI APP =====================
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] != "http":
+        return
+    path, method = scope["path"], scope["method"]
+    if path == WEBHOOK_PATH and method == "POST":
+        return await webhook(scope, receive, send)
+    if path == "/" and method in ("GET", "HEAD"):
+        return await index(scope, receive, send)
+    if path == "/ready" and method in ("GET", "HEAD"):
+        return await ready(scope, receive, send)
+    if path == "/metrics" and method == "GET":
+        return await metrics_endpoint(scope, receive, send)
+    await _respond(send, 404, b"not found")
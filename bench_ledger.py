@@ -0,0 +1,272 @@
+# bench_ledger.py
+# Data-path benchmark on a synthetic ledger: balances, reports, reconcile,
+# rate lookups and inserts. Runs offline against a temporary DB — no bot
+# token or network needed.
+#   python bench_ledger.py --size 10k                 # 10k | 1m | 10m | <int>
+#   python bench_ledger.py --size 1m --iterations 30 --out results.json
+#   python bench_ledger.py --size 10m --db /tmp/ledger10m.db --keep   # reuse later
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import sqlite3
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+SIZES = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+SEED = 20240601
+# Fixed calendar so runs are comparable; the ledger covers SPAN_DAYS up to END.
+END = datetime(2025, 10, 1, 21, 0, 0)
+SPAN_DAYS = 3 * 365
+CHUNK = 50_000
+
+# typical amount per operation in native units, and initial to_usd
+AMOUNT_SCALE = {"ARS": 8000, "RUB": 1500, "USD": 40, "USDT": 50, "BTC": 0.0008, "ETH": 0.015, "EUR": 35}
+START_RATE = {"ARS": 0.0012, "RUB": 0.011, "USDT": 1.0, "BTC": 45000.0, "ETH": 2500.0, "EUR": 1.08}
+CATEGORY_WEIGHTS = [0.55, 0.1, 0.2, 0.15]
+USERS = [SimpleNamespace(id=101, username="mom"), SimpleNamespace(id=102, username="dad"),
+         SimpleNamespace(id=103, username="kid1"), SimpleNamespace(id=104, username="kid2")]
+
+def parse_size(value: str) -> int:
+    return SIZES.get(value.lower()) or int(value)
+
+def _prepare_env(db_path: str):
+    # bot reads these at import; a placeholder token is enough, nothing is sent
+    os.environ["DB_PATH"] = db_path
+    os.environ.setdefault("BOT_TOKEN", "0:offline-benchmark")
+
+# ===================== GENERATOR =====================
+def generate_rates(bot, rng: random.Random):
+    """Daily to_usd random walk per currency, noon UTC."""
+    start = END - timedelta(days=SPAN_DAYS)
+    rates = dict(START_RATE)
+    for day in range(SPAN_DAYS + 1):
+        ts = (start + timedelta(days=day)).replace(hour=12, minute=0, second=0).isoformat()
+        for ccy in bot.CCY_LIST:
+            if ccy == "USD":
+                continue
+            drift = 0.0015 if ccy == "ARS" else 0.0
+            vol = {"BTC": 0.03, "ETH": 0.035, "USDT": 0.0005}.get(ccy, 0.006)
+            rates[ccy] *= max(0.5, 1 - drift + rng.gauss(0, vol))
+            yield ts, ccy, rates[ccy]
+
+def generate_txns(bot, n: int, rng: random.Random):
+    """Yield txn_row() tuples in chunks; n counts ledger rows (an exchange is 2)."""
+    start = END - timedelta(days=SPAN_DAYS)
+    span = (END - start).total_seconds()
+    chunk, i = [], 0
+    while i < n:
+        ts = (start + timedelta(seconds=span * (i + rng.random()) / n)).isoformat()
+        user = rng.choice(USERS)
+        acc = rng.choice(bot.ACCOUNTS)
+        ccy = bot.ACCOUNT_CCY[acc]
+        amount = round(AMOUNT_SCALE[ccy] * rng.lognormvariate(0, 0.9), 8)
+        r = rng.random()
+        if r < 0.72:
+            cat = rng.choices(bot.CATEGORIES, CATEGORY_WEIGHTS)[0]
+            if rng.random() < 0.1:
+                ccy = rng.choice(bot.CCY_LIST)
+                amount = round(AMOUNT_SCALE[ccy] * rng.lognormvariate(0, 0.9), 8)
+            chunk.append(bot.txn_row(ts, user, "expense", cat, acc, amount, ccy))
+            i += 1
+        elif r < 0.87:
+            chunk.append(bot.txn_row(ts, user, "income", None, acc, amount * 4, ccy))
+            i += 1
+        elif r < 0.985 and i + 1 < n:
+            to_acc = rng.choice(bot.ACCOUNTS)
+            to_ccy = bot.ACCOUNT_CCY[to_acc]
+            chunk.append(bot.txn_row(ts, user, "exchange_out", None, acc, amount, ccy, note=f"-> {to_acc}"))
+            chunk.append(bot.txn_row(ts, user, "exchange_in", None, to_acc,
+                                     round(AMOUNT_SCALE[to_ccy] * rng.lognormvariate(0, 0.9), 8), to_ccy,
+                                     note=f"from {acc}"))
+            i += 2
+        else:
+            chunk.append(bot.txn_row(ts, user, "reconcile", None, acc, round(rng.gauss(0, amount), 8), ccy,
+                                     note="reconcile"))
+            i += 1
+        if len(chunk) >= CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def build_ledger(bot, db, n: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    bot.init_db()
+    t0 = time.perf_counter()
+    with db.transaction(bot.DB_PATH) as conn:
+        conn.executemany("INSERT INTO fx_rates(ts,currency,to_usd) VALUES(?,?,?)", generate_rates(bot, rng))
+    rate_secs = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    rows = 0
+    for chunk in generate_txns(bot, n, rng):
+        with db.transaction(bot.DB_PATH) as conn:
+            bot._write_ledger(conn, chunk)
+        rows += len(chunk)
+    txn_secs = time.perf_counter() - t0
+    db.get_conn(bot.DB_PATH).execute("ANALYZE")
+    return {
+        "transactions": rows,
+        "fx_rates": db.get_conn(bot.DB_PATH).execute("SELECT COUNT(*) FROM fx_rates").fetchone()[0],
+        "rates_load_sec": round(rate_secs, 3),
+        "txn_load_sec": round(txn_secs, 3),
+        "txn_load_rows_per_sec": round(rows / txn_secs, 1) if txn_secs else None,
+    }
+
+# ===================== MEASUREMENT =====================
+def stats(samples) -> dict:
+    s = sorted(samples)
+    pick = lambda p: s[min(len(s) - 1, int(len(s) * p / 100))]
+    return {
+        "n": len(s),
+        "p50_ms": round(pick(50) * 1000, 4),
+        "p99_ms": round(pick(99) * 1000, 4),
+        "mean_ms": round(sum(s) / len(s) * 1000, 4),
+        "min_ms": round(s[0] * 1000, 4),
+        "max_ms": round(s[-1] * 1000, 4),
+    }
+
+def measure(bot, db, fn, iterations: int, cold: bool) -> dict:
+    """cold: fresh connection (empty SQLite page cache) and empty rate caches per call."""
+    fn()  # first call pays for imports/statement compilation in both modes
+    samples = []
+    for _ in range(iterations):
+        if cold:
+            db.close_all()
+            bot.reset_rate_caches()
+        t = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return stats(samples)
+
+def read_paths(bot):
+    day0 = END.replace(hour=0, minute=0, second=0, microsecond=0)
+    periods = {
+        "day": (day0, END),
+        "week": (day0 - timedelta(days=6), END),
+        "month": (day0 - timedelta(days=29), END),
+        "year": (day0 - timedelta(days=364), END),
+    }
+    paths = {
+        "get_latest_rate": lambda: bot.get_latest_rate("ARS"),
+        "sum_balances_by_account": bot.sum_balances_by_account,
+        "sum_balances_in_usd": bot.sum_balances_in_usd,
+        "reconcile_current_balance": lambda: bot.get_account_balance("ARS (нал)"),
+    }
+    for name, (start, end) in periods.items():
+        for mode in bot.REPORT_MODES:
+            paths[f"make_report_text[{name},{mode}]"] = (
+                lambda s=start, e=end, m=mode: bot.make_report_text(s, e, m))
+    for months, step in ((12, "month"), (12, "week"), (36, "month")):
+        marks = bot.networth_marks(months, step, END)
+        paths[f"networth_series[{months}m,{step}]"] = lambda m=marks: bot.networth_series(m)
+    return paths
+
+def bench_inserts(bot, db, iterations: int, concurrency: int) -> dict:
+    ts = END.isoformat()
+    row = lambda: bot.txn_row(ts, None, "expense", "еда", "ARS (нал)", 1.0, "ARS")
+    out = {"add_txn": measure(bot, db, lambda: bot.add_txn(ts, None, "expense", "еда", "ARS (нал)", 1.0, "ARS"),
+                              iterations, cold=False)}
+
+    async def grouped():
+        async def one():
+            t = time.perf_counter()
+            await bot.write_ledger([row()])
+            return time.perf_counter() - t
+        t0 = time.perf_counter()
+        samples = await asyncio.gather(*(one() for _ in range(concurrency)))
+        return time.perf_counter() - t0, samples
+
+    elapsed, samples = asyncio.run(grouped())
+    out["write_ledger_group_commit"] = {**stats(samples), "concurrency": concurrency,
+                                        "rows_per_sec": round(concurrency / elapsed, 1)}
+    return out
+
+def _git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="10k", help="10k | 1m | 10m | number of ledger rows")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=500, help="parallel write_ledger calls")
+    parser.add_argument("--db", help="ledger file to build or reuse (default: temporary)")
+    parser.add_argument("--keep", action="store_true", help="keep --db after the run and reuse it if present")
+    parser.add_argument("--out", help="results file (default: bench_ledger_<size>.json)")
+    args = parser.parse_args()
+
+    n = parse_size(args.size)
+    tmpdir = None
+    if args.db:
+        db_path = args.db
+    else:
+        tmpdir = tempfile.TemporaryDirectory(prefix="bench_ledger_")
+        db_path = os.path.join(tmpdir.name, "ledger.db")
+    reuse = args.keep and os.path.exists(db_path)
+    _prepare_env(db_path)
+
+    import bot
+    import db
+
+    if reuse:
+        bot.init_db()
+        build = {"reused": db_path}
+    else:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        print(f"building {n} rows in {db_path} …", file=sys.stderr)
+        build = build_ledger(bot, db, n, args.seed)
+
+    results = {}
+    for name, fn in read_paths(bot).items():
+        results[name] = {
+            "warm": measure(bot, db, fn, args.iterations, cold=False),
+            "cold": measure(bot, db, fn, args.iterations, cold=True),
+        }
+        print(f"{name:<42} warm p50 {results[name]['warm']['p50_ms']:>10} ms  p99 {results[name]['warm']['p99_ms']:>10} ms"
+              f"   cold p50 {results[name]['cold']['p50_ms']:>10} ms", file=sys.stderr)
+    results.update(bench_inserts(bot, db, args.iterations, args.concurrency))
+
+    report = {
+        "meta": {
+            "size": n,
+            "seed": args.seed,
+            "iterations": args.iterations,
+            "git_rev": _git_rev(),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "started": datetime.utcnow().isoformat(),
+        },
+        "build": build,
+        "results": results,
+    }
+    out = args.out or f"bench_ledger_{args.size}.json"
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"results written to {out}", file=sys.stderr)
+
+    db.shutdown()
+    db.close_all()
+    if tmpdir is not None:
+        tmpdir.cleanup()
+    elif not args.keep:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+
+if __name__ == "__main__":
+    sys.exit(main())
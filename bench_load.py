@@ -0,0 +1,315 @@
+# bench_load.py
+# End-to-end load test: webhook → update_queue → ConversationHandler → Bot API.
+# Many simulated users walk scripted multi-step flows (expense, income,
+# exchange, reconcile, report) against a webhook server, at a target update
+# rate; the bot's replies are captured by a local fake Bot API
+# (fake_bot_api.py), so nothing reaches Telegram. Reports throughput, reply
+# latency percentiles and dropped / out-of-order / unexpected replies; with
+# --spawn also the cold start, from spawning the server to /ready answering 200.
+#   python bench_load.py --spawn asgi --users 200 --rate 300 --duration 30
+#   python bench_load.py --spawn flask --workers 2 --json load.json
+#   python bench_load.py --url http://127.0.0.1:8000/<token> --api-port 8081
+#     (the server must run with BOT_API_URL=http://127.0.0.1:8081)
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import subprocess
+
+import httpx
+
+from fake_bot_api import FakeBotAPI
+
+PLACEHOLDER_TOKEN = "123456:load-test"
+USER_ID_BASE = 10_000
+
+# ===================== SCRIPTS =====================
+# A step is (kind, payload, expect): kind "text" sends a message, "callback"
+# presses an inline button on the bot's last message; expect is a substring
+# of the reply (sendMessage or editMessageText) that step must produce.
+FLOWS = {
+    "expense": [
+        ("text", "/expense", "Выберите категорию"),
+        ("callback", "cat:еда", "Категория: еда"),
+        ("text", "1500", "Выберите валюту"),
+        ("callback", "ccy:ARS", "Валюта: ARS"),
+        ("callback", "acc:ARS (нал)", "✅ Расход записан"),
+    ],
+    "income": [
+        ("text", "/income", "Введите сумму дохода"),
+        ("text", "500", "Выберите валюту дохода"),
+        ("callback", "ccy:USD", "для зачисления"),
+        ("callback", "acc:USD (нал)", "✅ Доход записан"),
+    ],
+    "exchange": [
+        ("text", "/exchange", "ОТКУДА"),
+        ("callback", "acc:USD (нал)", "КУДА"),
+        ("callback", "acc:ARS (нал)", "Введите сумму исходной"),
+        ("text", "100", "Введите курс сделки"),
+        ("text", "1", "✅ Обмен"),
+    ],
+    "reconcile": [
+        ("text", "/reconcile", "для сверки"),
+        ("callback", "acc:EUR (карта)", "конечный остаток"),
+        ("text", "250", "✅"),
+    ],
+    "report": [
+        ("text", "/report", "Выберите период"),
+        ("callback", "period:Неделя", "Отчёт"),
+    ],
+}
+FLOW_WEIGHTS = {"expense": 0.55, "income": 0.1, "exchange": 0.1, "reconcile": 0.1, "report": 0.15}
+# exchange and report need rates; sent once by the first user before the run
+SETUP = [("text", f"/setrate {ccy} {rate}", "✅ Курс сохранён")
+         for ccy, rate in (("ARS", 0.0012), ("RUB", 0.011), ("EUR", 1.08),
+                           ("USDT", 1.0), ("BTC", 60000), ("ETH", 3000))]
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+# ===================== DRIVER =====================
+class LoadDriver:
+    def __init__(self, webhook_url: str, rate: float, timeout: float, secret: str = "", think: float = 0.0):
+        self.webhook_url = webhook_url
+        self.rate = rate
+        self.timeout = timeout
+        self.think = think          # pause between a reply and the user's next step
+        self.headers = {"x-telegram-bot-api-secret-token": secret} if secret else {}
+        self.client = None
+        self._update_ids = itertools.count(1)
+        self._next_slot = 0.0
+        self._pending = {}          # chat_id -> (expect, sent_at, future)
+        self._last_message = {}     # chat_id -> message_id of the bot's last message
+        self._all_expects = {e for steps in FLOWS.values() for _, _, e in steps}
+        self.latencies = {}         # flow name -> [seconds]
+        self.counts = dict.fromkeys(("sent", "replied", "dropped", "out_of_order", "unexpected",
+                                     "unsolicited", "rejected", "http_errors", "flows", "stuck_users"), 0)
+
+    # ---------- Bot API side ----------
+    def on_call(self, rec):
+        """FakeBotAPI callback: match a reply to the user's pending step."""
+        if rec["method"] not in ("sendMessage", "editMessageText") or rec["chat_id"] is None:
+            return
+        chat_id = rec["chat_id"]
+        if rec["message_id"] is not None:
+            self._last_message[chat_id] = rec["message_id"]
+        pending = self._pending.pop(chat_id, None)
+        if pending is None or pending[2].done():
+            self.counts["unsolicited"] += 1
+            return
+        expect, sent_at, fut = pending
+        text = rec["text"] or ""
+        if expect in text:
+            outcome = "ok"
+        elif any(e in text for e in self._all_expects):
+            outcome = "out_of_order"      # a reply that belongs to another step
+        else:
+            outcome = "unexpected"        # error text, validation message, …
+        fut.set_result((outcome, rec["t"] - sent_at, text))
+
+    # ---------- webhook side ----------
+    async def _slot(self):
+        # global pacing: one update every 1/rate seconds across all users
+        now = time.perf_counter()
+        at = max(self._next_slot, now)
+        self._next_slot = at + 1 / self.rate
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def _update(self, user_id: int, kind: str, payload: str) -> dict:
+        user = {"id": user_id, "is_bot": False, "first_name": f"load{user_id}"}
+        chat = {"id": user_id, "type": "private"}
+        update_id = next(self._update_ids)
+        if kind == "text":
+            msg = {"message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": payload}
+            if payload.startswith("/"):
+                msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(payload.split()[0])}]
+            return {"update_id": update_id, "message": msg}
+        return {"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(user_id), "data": payload,
+            "message": {"message_id": self._last_message.get(user_id, 1), "date": int(time.time()),
+                        "chat": chat, "from": {"id": 1, "is_bot": True, "first_name": "Budget"}, "text": "…"},
+        }}
+
+    async def step(self, user_id: int, kind: str, payload: str, expect: str):
+        await self._slot()
+        fut = asyncio.get_running_loop().create_future()
+        body = json.dumps(self._update(user_id, kind, payload))
+        sent_at = time.perf_counter()
+        self._pending[user_id] = (expect, sent_at, fut)
+        self.counts["sent"] += 1
+        try:
+            resp = await self.client.post(self.webhook_url, content=body, headers=self.headers)
+        except httpx.HTTPError:
+            resp = None
+        if resp is None or resp.status_code != 200:
+            self._pending.pop(user_id, None)
+            self.counts["rejected" if resp is not None and resp.status_code == 503 else "http_errors"] += 1
+            return "rejected", None
+        try:
+            outcome, latency, _ = await asyncio.wait_for(fut, self.timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(user_id, None)
+            self.counts["dropped"] += 1
+            return "dropped", None
+        self.counts["replied"] += 1
+        if outcome != "ok":
+            self.counts[outcome] += 1
+        return outcome, latency
+
+    async def run_user(self, user_id: int, deadline: float, rng: random.Random):
+        names, weights = list(FLOW_WEIGHTS), list(FLOW_WEIGHTS.values())
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            for kind, payload, expect in FLOWS[name]:
+                outcome, latency = await self.step(user_id, kind, payload, expect)
+                if latency is not None:
+                    self.latencies.setdefault(name, []).append(latency)
+                if outcome == "rejected":
+                    await asyncio.sleep(1)          # retry-after; the flow is abandoned below
+                if outcome == "ok" and self.think:
+                    await asyncio.sleep(rng.expovariate(1 / self.think))
+                if outcome != "ok":
+                    # the conversation may be stuck mid-flow (entry points do
+                    # not re-enter); this user stops here
+                    self.counts["stuck_users"] += 1
+                    return
+            self.counts["flows"] += 1
+
+    async def run(self, users: int, duration: float, seed: int) -> dict:
+        limits = httpx.Limits(max_connections=min(users, 256), max_keepalive_connections=min(users, 256))
+        async with httpx.AsyncClient(limits=limits, timeout=self.timeout) as self.client:
+            for kind, payload, expect in SETUP:
+                outcome, _ = await self.step(USER_ID_BASE, kind, payload, expect)
+                if outcome != "ok":
+                    raise RuntimeError(f"setup step {payload!r} failed: {outcome}")
+            self.counts = dict.fromkeys(self.counts, 0)
+            self._next_slot = time.perf_counter()
+            t0 = time.perf_counter()
+            deadline = t0 + duration
+            await asyncio.gather(*(self.run_user(USER_ID_BASE + 1 + i, deadline, random.Random(seed + i))
+                                   for i in range(users)))
+            elapsed = time.perf_counter() - t0
+        every = [x for xs in self.latencies.values() for x in xs]
+        return {
+            "elapsed_sec": round(elapsed, 3),
+            "updates_per_sec": round(self.counts["replied"] / elapsed, 1),
+            "flows_per_sec": round(self.counts["flows"] / elapsed, 1),
+            "counts": self.counts,
+            "latency": {"p50_ms": _ms(percentile(every, 50)), "p90_ms": _ms(percentile(every, 90)),
+                        "p99_ms": _ms(percentile(every, 99)), "max_ms": _ms(max(every) if every else None)},
+            "latency_by_flow": {name: {"n": len(xs), "p50_ms": _ms(percentile(xs, 50)),
+                                       "p99_ms": _ms(percentile(xs, 99))}
+                                for name, xs in sorted(self.latencies.items())},
+        }
+
+# ===================== SERVER UNDER TEST =====================
+def spawn_server(kind: str, port: int, workers: int, env: dict, log_path: str) -> subprocess.Popen:
+    here = os.path.dirname(os.path.abspath(__file__))
+    if kind == "asgi":
+        cmd = [sys.executable, "-m", "uvicorn", "asgi:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "bot:create_app()", "-b", f"127.0.0.1:{port}",
+               "-w", str(workers), "--threads", "8", "--log-level", "warning"]
+    log = open(log_path, "wb")
+    return subprocess.Popen(cmd, cwd=here, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+async def wait_ready(base_url: str, proc: subprocess.Popen, timeout: float = 30) -> dict:
+    """Poll /ready until it answers 200; returns its report plus the seconds since spawn."""
+    started = time.monotonic()
+    async with httpx.AsyncClient(timeout=1) as client:
+        while time.monotonic() - started < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"server exited with {proc.returncode}")
+            try:
+                resp = await client.get(base_url + "/ready")
+                if resp.status_code == 200:
+                    return {"spawn_to_ready_sec": round(time.monotonic() - started, 3), **resp.json()}
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.05)
+    raise RuntimeError("server did not become ready")
+
+async def run_load(args) -> dict:
+    # the fake API shares this event loop with the driver, so replies reach
+    # the driver without a thread hop
+    driver = LoadDriver(args.url or "", args.rate, args.timeout, args.secret, args.think_ms / 1000)
+    api = await FakeBotAPI(port=args.api_port, on_call=driver.on_call).start()
+    proc = tmpdir = cold_start = None
+    try:
+        if args.spawn:
+            tmpdir = tempfile.TemporaryDirectory(prefix="bench_load_")
+            env = {**os.environ, "BOT_TOKEN": PLACEHOLDER_TOKEN, "BOT_API_URL": api.url,
+                   "DB_PATH": os.path.join(tmpdir.name, "load.db"), "WEBHOOK_SECRET": args.secret}
+            log_path = os.path.join(tmpdir.name, "server.log")
+            base = f"http://127.0.0.1:{args.port}"
+            proc = spawn_server(args.spawn, args.port, args.workers, env, log_path)
+            try:
+                ready = await wait_ready(base, proc)
+                cold_start = {"spawn_to_ready_sec": ready["spawn_to_ready_sec"], **ready["startup_seconds"]}
+            except RuntimeError:
+                with open(log_path, errors="replace") as f:
+                    sys.stderr.write(f.read()[-4000:])
+                raise
+            driver.webhook_url = f"{base}/{PLACEHOLDER_TOKEN}"
+        else:
+            print(f"fake Bot API on {api.url}; the server must use BOT_API_URL={api.url}", file=sys.stderr)
+        result = await driver.run(args.users, args.duration, args.seed)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        await api.stop()
+        if tmpdir is not None:
+            tmpdir.cleanup()
+    return {"target": args.spawn or args.url, "workers": args.workers if args.spawn else None,
+            "users": args.users, "target_rate": args.rate, "cold_start": cold_start, **result,
+            "api_calls": api.calls}
+
+def main():
+    parser = argparse.ArgumentParser()
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--spawn", choices=("asgi", "flask"), help="start the webhook server on a temporary DB")
+    target.add_argument("--url", help="webhook URL of an already running server")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes (--spawn)")
+    parser.add_argument("--port", type=int, default=8765, help="server port (--spawn)")
+    parser.add_argument("--api-port", type=int, default=0, help="fake Bot API port (0 = any free port)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=200, help="target updates per second, all users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for a reply")
+    parser.add_argument("--think-ms", type=float, default=0, help="mean pause before a user's next step")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", ""))
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    result = asyncio.run(run_load(args))
+    c, lat = result["counts"], result["latency"]
+    if result["cold_start"]:
+        print("cold start: " + "  ".join(f"{phase} {sec} s" for phase, sec in result["cold_start"].items()))
+    print(f"{result['updates_per_sec']} upd/s ({result['flows_per_sec']} flows/s)  "
+          f"p50 {lat['p50_ms']} ms  p90 {lat['p90_ms']} ms  p99 {lat['p99_ms']} ms  max {lat['max_ms']} ms")
+    print(f"sent {c['sent']}  replied {c['replied']}  dropped {c['dropped']}  out-of-order {c['out_of_order']}  "
+          f"unexpected {c['unexpected']}  unsolicited {c['unsolicited']}  rejected {c['rejected']}  "
+          f"http errors {c['http_errors']}  stuck users {c['stuck_users']}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    return 1 if c["dropped"] or c["out_of_order"] or c["http_errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,143 @@
+# bench_webhook.py
+# Ingestion benchmark: Flask bridge (bot.webhook) vs native ASGI (asgi.app).
+# Measures the webhook hand-off only — request in, Update parsed and taken off
+# PTB's update_queue — in-process, without an HTTP server or Telegram.
+#   python bench_webhook.py [--updates 5000] [--concurrency 32] [--json out.json]
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench-token")
+os.environ.setdefault("WEBHOOK_QUEUE_SIZE", "100000")
+
+import bot
+import asgi
+
+def make_update(update_id: int) -> bytes:
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": 1000 + update_id % 50, "type": "private"},
+            "from": {"id": 1000 + update_id % 50, "is_bot": False, "first_name": "bench"},
+            "text": "/balance",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 8}],
+        },
+    }).encode()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def summary(name, n, elapsed, latencies):
+    return {
+        "path": name,
+        "updates": n,
+        "updates_per_sec": round(n / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3),
+    }
+
+def _as_started(app):
+    # the webhooks refuse updates until PTB runs; flag it as started without
+    # start(), which would begin fetching the queue and call getMe
+    app._running = True
+    return app
+
+async def _drain(app, n: int):
+    # stands in for PTB: take each update and mark it processed
+    for _ in range(n):
+        update = await app.update_queue.get()
+        app.update_processor.release(update.update_id)
+
+# ===================== FLASK =====================
+def bench_flask(payloads, concurrency):
+    # our own loop in place of bot._startup(): nothing here may reach Telegram
+    bot.loop = asyncio.new_event_loop()
+    threading.Thread(target=bot.loop.run_forever, daemon=True).start()
+    drained = asyncio.run_coroutine_threadsafe(_drain(_as_started(bot.get_application()), len(payloads)), bot.loop)
+    flask_app = bot.create_app()
+    path = f"/{bot.BOT_TOKEN}"
+    local = threading.local()
+
+    def post(body):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = flask_app.test_client()
+        t = time.perf_counter()
+        resp = client.post(path, data=body, content_type="application/json")
+        assert resp.status_code == 200, resp.status_code
+        return time.perf_counter() - t
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = list(pool.map(post, payloads))
+    drained.result()
+    elapsed = time.perf_counter() - t0
+    bot.loop.call_soon_threadsafe(bot.loop.stop)
+    return summary("flask", len(payloads), elapsed, latencies)
+
+# ===================== ASGI =====================
+async def _asgi_post(body):
+    scope = {
+        "type": "http", "method": "POST", "path": asgi.WEBHOOK_PATH,
+        "headers": [(b"content-type", b"application/json"),
+                    (b"x-telegram-bot-api-secret-token", asgi.WEBHOOK_SECRET.encode())],
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    t = time.perf_counter()
+    await asgi.app(scope, receive, send)
+    assert sent[0]["status"] == 200, sent[0]["status"]
+    return time.perf_counter() - t
+
+async def _bench_asgi(payloads, concurrency):
+    # what the lifespan startup builds, minus start_runtime()
+    asgi.application = _as_started(bot.make_app(max_pending=asgi.WEBHOOK_QUEUE_SIZE))
+    drain = asyncio.create_task(_drain(asgi.application, len(payloads)))
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(body):
+        async with sem:
+            return await _asgi_post(body)
+
+    t0 = time.perf_counter()
+    latencies = await asyncio.gather(*(one(b) for b in payloads))
+    await drain
+    return summary("asgi", len(payloads), time.perf_counter() - t0, latencies)
+
+def bench_asgi(payloads, concurrency):
+    return asyncio.run(_bench_asgi(payloads, concurrency))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+
+    # each path gets its own update_ids: both share bot.update_dedupe
+    results = [bench_flask([make_update(i) for i in range(args.updates)], args.concurrency),
+               bench_asgi([make_update(args.updates + i) for i in range(args.updates)], args.concurrency)]
+    for r in results:
+        print(f"{r['path']:>6}: {r['updates_per_sec']:>9} upd/s  p50 {r['p50_ms']} ms  "
+              f"p99 {r['p99_ms']} ms  max {r['max_ms']} ms")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"concurrency": args.concurrency, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
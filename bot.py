@@ -1,612 +1,3548 @@
-# bot.py
-import os
-import sys
-import sqlite3
-from datetime import datetime, timedelta
-from contextlib import closing
-from dotenv import load_dotenv
-
-from flask import Flask, request
-import asyncio
-import threading
-
-from telegram import (
-    Update, InlineKeyboardButton, InlineKeyboardMarkup
-)
-from telegram.ext import (
-    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, filters, ContextTypes
-)
-
-# ===================== ENV =====================
-load_dotenv()
-
-def _get_token() -> str:
-    token = os.getenv("BOT_TOKEN", "").strip().strip('"').strip("'")
-    if not token:
-        print(
-            "❌ Не найден BOT_TOKEN. Задайте переменную окружения или строку в .env:\n"
-            "BOT_TOKEN=123456:ABC-DEF...\n",
-            file=sys.stderr
-        )
-        sys.exit(1)
-    return token
-
-BOT_TOKEN = _get_token()
-BASE_CCY = os.getenv("BASE_CURRENCY", "USD").upper()
-DEFAULT_INPUT_CCY = os.getenv("DEFAULT_INPUT_CURRENCY", "ARS").upper()
-
-DB_PATH = "budget.db"
-
-# ===================== CONSTANTS =====================
-CATEGORIES = ["еда", "аренда", "развлечения", "прочее"]
-
-ACCOUNTS = [
-    "ARS (нал)",
-    "RUB (нал)",
-    "RUB (карта)",
-    "USD (нал)",
-    "USDT (биржа А)",
-    "USDT (биржа G)",
-    "BTC (биржа А)",
-    "BTC (биржа G)",
-    "ETH (биржа А)",
-    "EUR (карта)",
-]
-
-ACCOUNT_CCY = {
-    "ARS (нал)": "ARS",
-    "RUB (нал)": "RUB",
-    "RUB (карта)": "RUB",
-    "USD (нал)": "USD",
-    "USDT (биржа А)": "USDT",
-    "USDT (биржа G)": "USDT",
-    "BTC (биржа А)": "BTC",
-    "BTC (биржа G)": "BTC",
-    "ETH (биржа А)": "ETH",
-    "EUR (карта)": "EUR",
-}
-
-CCY_LIST = ["ARS","RUB","USD","USDT","BTC","ETH","EUR"]
-
-# Conversation states
-EXP_CAT, EXP_AMOUNT, EXP_CCY, EXP_ACC = range(4)
-INC_AMOUNT, INC_CCY, INC_ACC = range(3)
-EX_FROM_ACC, EX_TO_ACC, EX_AMOUNT, EX_RATE = range(4)
-REP_PERIOD, REP_CUSTOM_FROM, REP_CUSTOM_TO = range(3)
-REC_ACC, REC_AMOUNT = range(2)
-
-# ===================== DB =====================
-def init_db():
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS transactions(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT NOT NULL,
-            user_id INTEGER,
-            username TEXT,
-            type TEXT CHECK(type IN ('expense','income','exchange_in','exchange_out','reconcile')) NOT NULL,
-            category TEXT,
-            account TEXT NOT NULL,
-            amount REAL NOT NULL,
-            currency TEXT NOT NULL,
-            note TEXT
-        )
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS fx_rates(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            ts TEXT NOT NULL,
-            currency TEXT NOT NULL,
-            to_usd REAL NOT NULL
-        )
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS settings(
-            key TEXT PRIMARY KEY,
-            value TEXT
-        )
-        """)
-        c.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('base_ccy',?)", (BASE_CCY,))
-        c.execute(
-            "INSERT INTO fx_rates(ts,currency,to_usd) "
-            "SELECT ?,?,? WHERE NOT EXISTS (SELECT 1 FROM fx_rates WHERE currency='USD')",
-            (datetime.utcnow().isoformat(), "USD", 1.0)
-        )
-
-def get_latest_rate(currency:str)->float:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        c.execute("SELECT to_usd FROM fx_rates WHERE currency=? ORDER BY ts DESC LIMIT 1", (currency.upper(),))
-        row = c.fetchone()
-        if row:
-            return row[0]
-        raise ValueError(f"Нет курса для {currency}. Задайте /setrate {currency} <число> (сколько {BASE_CCY} за 1 {currency}).")
-
-def set_rate(currency:str, to_usd:float):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO fx_rates(ts,currency,to_usd) VALUES(?,?,?)",
-                  (datetime.utcnow().isoformat(), currency.upper(), float(to_usd)))
-
-def add_txn(ts, user, ttype, category, account, amount, currency, note=None):
-    with closing(sqlite3.connect(DB_PATH)) as conn, conn:
-        c = conn.cursor()
-        c.execute("""
-        INSERT INTO transactions(ts,user_id,username,type,category,account,amount,currency,note)
-        VALUES(?,?,?,?,?,?,?,?,?)
-        """, (
-            ts,
-            getattr(user, "id", None) if user else None,
-            getattr(user, "username", None) if user else None,
-            ttype, category, account, amount, currency.upper(), note
-        ))
-
-def sum_balances_by_account():
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        res = {acc: 0.0 for acc in ACCOUNTS}
-        for acc in ACCOUNTS:
-            c.execute("""
-                SELECT SUM(
-                    CASE
-                        WHEN type IN ('income','exchange_in','reconcile') THEN amount
-                        WHEN type IN ('expense','exchange_out') THEN -amount
-                        ELSE 0
-                    END
-                )
-                FROM transactions WHERE account=?
-            """, (acc,))
-            total = c.fetchone()[0]
-            res[acc] = total or 0.0
-        return res
-
-def sum_balances_in_usd():
-    acc_native = sum_balances_by_account()
-    total_usd = 0.0
-    details = []
-    for acc, amt in acc_native.items():
-        ccy = ACCOUNT_CCY[acc]
-        rate = get_latest_rate(ccy)
-        usd = amt * rate if ccy != "USD" else amt
-        details.append((acc, amt, ccy, usd))
-        total_usd += usd
-    return total_usd, details
-
-def parse_period(kind, frm=None, to=None):
-    now = datetime.now()
-    if kind == "Сегодня":
-        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        end = now
-    elif kind == "Неделя":
-        start = (now - timedelta(days=6)).replace(hour=0, minute=0, second=0, microsecond=0)
-        end = now
-    elif kind == "Месяц" or kind == "С начала месяца":
-        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        end = now
-    elif kind == "Произвольный" and frm and to:
-        start = datetime.fromisoformat(frm)
-        end = datetime.fromisoformat(to)
-    else:
-        start = now - timedelta(days=30)
-        end = now
-    return start, end
-
-# ===================== UI HELPERS =====================
-def cat_keyboard():
-    buttons = [[InlineKeyboardButton(c.capitalize(), callback_data=f"cat:{c}")] for c in CATEGORIES]
-    return InlineKeyboardMarkup(buttons)
-
-def ccy_keyboard(default_first=True):
-    lst = CCY_LIST.copy()
-    if default_first and DEFAULT_INPUT_CCY in lst:
-        lst.remove(DEFAULT_INPUT_CCY)
-        lst.insert(0, DEFAULT_INPUT_CCY)
-    rows, row = [], []
-    for i, c in enumerate(lst, start=1):
-        row.append(InlineKeyboardButton(c, callback_data=f"ccy:{c}"))
-        if i % 3 == 0:
-            rows.append(row); row=[]
-    if row: rows.append(row)
-    return InlineKeyboardMarkup(rows)
-
-def accounts_keyboard():
-    return InlineKeyboardMarkup([[InlineKeyboardButton(acc, callback_data=f"acc:{acc}")] for acc in ACCOUNTS])
-
-def period_keyboard():
-    opts = ["Сегодня","Неделя","Месяц","С начала месяца","Произвольный"]
-    return InlineKeyboardMarkup([[InlineKeyboardButton(o, callback_data=f"period:{o}")] for o in opts])
-
-# ===================== COMMANDS =====================
-async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    init_db()
-    text = (
-        f"Привет! Я семейный бюджет-бот.\n\n"
-        f"База: {BASE_CCY}. Валюта ввода по умолчанию: {DEFAULT_INPUT_CCY}.\n\n"
-        f"Что умею:\n"
-        f"• /expense – записать расход\n"
-        f"• /income – записать доход\n"
-        f"• /exchange – обмен валют (фиксируем курс)\n"
-        f"• /setrate <CCY> <курс_к_{BASE_CCY}> – задать/обновить курс\n"
-        f"• /balance – остатки по кошелькам и в {BASE_CCY}\n"
-        f"• /report – отчёт по периодам\n"
-        f"• /reconcile – сверка (ввести конечный остаток по кошельку)\n"
-        f"• /help – подсказка"
-    )
-    if update.message:
-        await update.message.reply_text(text)
-
-async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message:
-        await update.message.reply_text("Команды: /expense /income /exchange /setrate /balance /report /reconcile")
-
-# ===================== EXPENSE FLOW =====================
-async def expense_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Выберите категорию расхода:", reply_markup=cat_keyboard())
-    return EXP_CAT
-
-async def expense_pick_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer()
-    cat = query.data.split(":",1)[1]
-    context.user_data["exp_cat"] = cat
-    await query.edit_message_text(f"Категория: {cat}. Введите сумму (только число, {DEFAULT_INPUT_CCY} по умолчанию).")
-    return EXP_AMOUNT
-
-async def expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    amount_str = update.message.text.replace(",", ".").strip()
-    try:
-        amount = float(amount_str)
-    except:
-        await update.message.reply_text("Не понял сумму. Введите число, например 123.45")
-        return EXP_AMOUNT
-    context.user_data["exp_amount"] = amount
-    await update.message.reply_text(
-        f"Выберите валюту (по умолчанию {DEFAULT_INPUT_CCY}) или укажите счёт:",
-        reply_markup=ccy_keyboard(default_first=True)
-    )
-    return EXP_CCY
-
-async def expense_pick_ccy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer()
-    ccy = query.data.split(":",1)[1]
-    context.user_data["exp_ccy"] = ccy
-    await query.edit_message_text(f"Валюта: {ccy}. Теперь выберите счёт/кошелёк:", reply_markup=accounts_keyboard())
-    return EXP_ACC
-
-async def expense_pick_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query; await query.answer()
-    acc = query.data.split(":",1)[1]
-    data = context.user_data
-    add_txn(datetime.utcnow().isoformat(), query.from_user, "expense",
-            data.get("exp_cat"), acc, data.get("exp_amount"), data.get("exp_ccy", DEFAULT_INPUT_CCY))
-    await query.edit_message_text(f"✅ Расход записан: {data.get('exp_amount')} {data.get('exp_ccy', DEFAULT_INPUT_CCY)} • {data.get('exp_cat')} • {acc}")
-    context.user_data.clear()
-    return ConversationHandler.END
-
-# ===================== INCOME FLOW =====================
-async def income_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Введите сумму дохода (число).")
-    return INC_AMOUNT
-
-async def income_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    amount_str = update.message.text.replace(",", ".").strip()
-    try:
-        amount = float(amount_str)
-    except:
-        await update.message.reply_text("Не понял сумму. Введите число, например 500")
-        return INC_AMOUNT
-    context.user_data["inc_amount"] = amount
-    await update.message.reply_text("Выберите валюту дохода:", reply_markup=ccy_keyboard(default_first=False))
-    return INC_CCY
-
-async def income_pick_ccy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    ccy = q.data.split(":",1)[1]
-    context.user_data["inc_ccy"] = ccy
-    await q.edit_message_text("Выберите счёт/кошелёк для зачисления:", reply_markup=accounts_keyboard())
-    return INC_ACC
-
-async def income_pick_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    acc = q.data.split(":",1)[1]
-    data = context.user_data
-    add_txn(datetime.utcnow().isoformat(), q.from_user, "income",
-            None, acc, data.get("inc_amount"), data.get("inc_ccy"))
-    await q.edit_message_text(f"✅ Доход записан: {data.get('inc_amount')} {data.get('inc_ccy')} • {acc}")
-    context.user_data.clear()
-    return ConversationHandler.END
-
-# ===================== EXCHANGE FLOW =====================
-async def exchange_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Выберите счёт, ОТКУДА списываем:", reply_markup=accounts_keyboard())
-    return EX_FROM_ACC
-
-async def ex_pick_from(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    context.user_data["ex_from"] = q.data.split(":",1)[1]
-    await q.edit_message_text("Теперь выберите счёт, КУДА зачисляем:", reply_markup=accounts_keyboard())
-    return EX_TO_ACC
-
-async def ex_pick_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    context.user_data["ex_to"] = q.data.split(":",1)[1]
-    await q.edit_message_text("Введите сумму исходной валюты (число).")
-    return EX_AMOUNT
-
-async def ex_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        amt = float(update.message.text.replace(",", ".").strip())
-    except:
-        await update.message.reply_text("Нужно число, попробуйте ещё раз.")
-        return EX_AMOUNT
-    context.user_data["ex_amt"] = amt
-    await update.message.reply_text("Введите курс сделки: сколько USD за 1 единицу исходной валюты.\nНапр.: ARS→USD: 0.0012; USD→EUR: 1.07 (но это USD за 1 исходной валюты).")
-    return EX_RATE
-
-async def ex_rate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        rate_to_usd = float(update.message.text.replace(",", ".").strip())
-    except:
-        await update.message.reply_text("Нужно число (курс к USD).")
-        return EX_RATE
-    data = context.user_data
-    from_acc = data["ex_from"]; to_acc = data["ex_to"]; amt = data["ex_amt"]
-
-    from_ccy = ACCOUNT_CCY[from_acc]
-    to_ccy = ACCOUNT_CCY[to_acc]
-
-    set_rate(from_ccy, rate_to_usd)
-    if to_ccy != "USD":
-        try:
-            to_usd_to_ccy = get_latest_rate(to_ccy)
-        except:
-            await update.message.reply_text(f"Нет курса для {to_ccy}. Задайте /setrate {to_ccy} <курс_к_{BASE_CCY}> и повторите обмен.")
-            context.user_data.clear()
-            return ConversationHandler.END
-    else:
-        to_usd_to_ccy = 1.0
-
-    usd_value = amt * rate_to_usd
-    target_rate = to_usd_to_ccy
-    target_amount = usd_value / target_rate
-
-    add_txn(datetime.utcnow().isoformat(), update.message.from_user if update.message else None,
-            "exchange_out", None, from_acc, amt, from_ccy, note=f"-> {to_acc}")
-    add_txn(datetime.utcnow().isoformat(), update.message.from_user if update.message else None,
-            "exchange_in", None, to_acc, target_amount, to_ccy, note=f"from {from_acc}")
-
-    await update.message.reply_text(f"✅ Обмен: {amt} {from_ccy} → {round(target_amount,8)} {to_ccy} (курс {from_ccy}→USD={rate_to_usd}).")
-    context.user_data.clear()
-    return ConversationHandler.END
-
-# ===================== SET RATE =====================
-async def setrate(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    parts = update.message.text.split()
-    if len(parts) != 3:
-        await update.message.reply_text(f"Формат: /setrate CCY КУРС_К_{BASE_CCY}\nНапр.: /setrate ARS 0.0012")
-        return
-    _, ccy, rate = parts
-    try:
-        set_rate(ccy.upper(), float(rate))
-    except Exception as e:
-        await update.message.reply_text(f"Ошибка: {e}")
-        return
-    await update.message.reply_text(f"✅ Курс сохранён: 1 {ccy.upper()} = {rate} {BASE_CCY}")
-
-# ===================== BALANCE =====================
-async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        total_usd, details = sum_balances_in_usd()
-    except Exception as e:
-        await update.message.reply_text(f"Нужно задать курсы всех валют, которые есть в кошельках.\nОшибка: {e}")
-        return
-    lines = ["Остатки по кошелькам:"]
-    for acc, amt, ccy, usd in details:
-        lines.append(f"• {acc}: {round(amt,8)} {ccy}  (~{round(usd,2)} USD)")
-    lines.append(f"\nИтого в USD: {round(total_usd,2)}")
-    await update.message.reply_text("\n".join(lines))
-
-# ===================== REPORT =====================
-async def report_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Выберите период отчёта:", reply_markup=period_keyboard())
-    return REP_PERIOD
-
-async def report_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    kind = q.data.split(":",1)[1]
-    if kind == "Произвольный":
-        await q.edit_message_text("Введите даты в формате YYYY-MM-DD YYYY-MM-DD (от и до).")
-        return REP_CUSTOM_FROM
-    start, end = parse_period(kind)
-    await q.edit_message_text(make_report_text(start, end))
-    return ConversationHandler.END
-
-async def report_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        frm, to = update.message.text.strip().split()
-        start, end = parse_period("Произвольный", frm + "T00:00:00", to + "T23:59:59")
-    except Exception:
-        await update.message.reply_text("Формат: 2025-11-01 2025-11-10")
-        return REP_CUSTOM_FROM
-    await update.message.reply_text(make_report_text(start, end))
-    return ConversationHandler.END
-
-def make_report_text(start: datetime, end: datetime)->str:
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        c.execute("""
-        SELECT COALESCE(category,'прочее'), currency, SUM(amount) 
-        FROM transactions 
-        WHERE type='expense' AND ts BETWEEN ? AND ?
-        GROUP BY category, currency
-        """, (start.isoformat(), end.isoformat()))
-        rows = c.fetchall()
-
-    cat_totals_usd = {}
-    for cat, ccy, amt in rows:
-        try:
-            rate = get_latest_rate(ccy)
-        except:
-            rate = 0.0
-        usd = amt * (rate if ccy!="USD" else 1.0)
-        cat_totals_usd[cat] = cat_totals_usd.get(cat, 0.0) + usd
-
-    lines = [f"Отчёт {start.strftime('%Y-%m-%d')} → {end.strftime('%Y-%m-%d')}"]
-    if not cat_totals_usd:
-        lines.append("Нет расходов за период.")
-    else:
-        lines.append("Расходы по категориям (в USD):")
-        for cat, val in cat_totals_usd.items():
-            lines.append(f"• {cat}: {round(val,2)}")
-    return "\n".join(lines)
-
-# ===================== RECONCILE =====================
-async def reconcile_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Выберите кошелёк для сверки:", reply_markup=accounts_keyboard())
-    return REC_ACC
-
-async def reconcile_pick_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    q = update.callback_query; await q.answer()
-    acc = q.data.split(":",1)[1]
-    context.user_data["rec_acc"] = acc
-    await q.edit_message_text(f"Введите конечный остаток в нативной валюте кошелька ({ACCOUNT_CCY[acc]}).")
-    return REC_AMOUNT
-
-async def reconcile_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        amt = float(update.message.text.replace(",", ".").strip())
-    except:
-        await update.message.reply_text("Нужно число.")
-        return REC_AMOUNT
-
-    acc = context.user_data["rec_acc"]
-    with closing(sqlite3.connect(DB_PATH)) as conn:
-        c = conn.cursor()
-        c.execute("""
-        SELECT COALESCE(SUM(CASE WHEN type IN ('income','exchange_in','reconcile') THEN amount 
-                                 WHEN type IN ('expense','exchange_out') THEN -amount ELSE 0 END),0)
-        FROM transactions WHERE account=?
-        """, (acc,))
-        current = c.fetchone()[0] or 0.0
-
-    diff = amt - current
-    if abs(diff) < 1e-9:
-        add_txn(datetime.utcnow().isoformat(), update.message.from_user, "reconcile",
-                None, acc, 0.0, ACCOUNT_CCY[acc], note="confirm ok")
-        await update.message.reply_text("✅ Сальдо подтверждено, корректировка не требуется.")
-    elif diff > 0:
-        add_txn(datetime.utcnow().isoformat(), update.message.from_user, "reconcile",
-                None, acc, diff, ACCOUNT_CCY[acc], note="reconcile up")
-        await update.message.reply_text(f"✅ Сверка: добавлено {round(diff,8)} {ACCOUNT_CCY[acc]}")
-    else:
-        add_txn(datetime.utcnow().isoformat(), update.message.from_user, "reconcile",
-                None, acc, -abs(diff), ACCOUNT_CCY[acc], note="reconcile down (as expense)")
-        await update.message.reply_text(f"✅ Сверка: списано {round(abs(diff),8)} {ACCOUNT_CCY[acc]}")
-    context.user_data.clear()
-    return ConversationHandler.END
-
-# ===================== PTB APP BUILD =====================
-def make_app():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start_cmd))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("setrate", setrate))
-    app.add_handler(CommandHandler("balance", balance))
-
-    exp_conv = ConversationHandler(
-        entry_points=[CommandHandler("expense", expense_start)],
-        states={
-            EXP_CAT: [CallbackQueryHandler(expense_pick_cat, pattern=r"^cat:")],
-            EXP_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, expense_amount)],
-            EXP_CCY: [CallbackQueryHandler(expense_pick_ccy, pattern=r"^ccy:")],
-            EXP_ACC: [CallbackQueryHandler(expense_pick_acc, pattern=r"^acc:")],
-        },
-        fallbacks=[],
-        per_message=False,
-    )
-    app.add_handler(exp_conv)
-
-    inc_conv = ConversationHandler(
-        entry_points=[CommandHandler("income", income_start)],
-        states={
-            INC_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, income_amount)],
-            INC_CCY: [CallbackQueryHandler(income_pick_ccy, pattern=r"^ccy:")],
-            INC_ACC: [CallbackQueryHandler(income_pick_acc, pattern=r"^acc:")],
-        },
-        fallbacks=[],
-        per_message=False,
-    )
-    app.add_handler(inc_conv)
-
-    ex_conv = ConversationHandler(
-        entry_points=[CommandHandler("exchange", exchange_start)],
-        states={
-            EX_FROM_ACC: [CallbackQueryHandler(ex_pick_from, pattern=r"^acc:")],
-            EX_TO_ACC: [CallbackQueryHandler(ex_pick_to, pattern=r"^acc:")],
-            EX_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ex_amount)],
-            EX_RATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ex_rate)],
-        },
-        fallbacks=[],
-        per_message=False,
-    )
-    app.add_handler(ex_conv)
-
-    rep_conv = ConversationHandler(
-        entry_points=[CommandHandler("report", report_start)],
-        states={
-            REP_PERIOD: [CallbackQueryHandler(report_period, pattern=r"^period:")],
-            REP_CUSTOM_FROM: [MessageHandler(filters.TEXT & ~filters.COMMAND, report_custom)],
-        },
-        fallbacks=[],
-        per_message=False,
-    )
-    app.add_handler(rep_conv)
-
-    rec_conv = ConversationHandler(
-        entry_points=[CommandHandler("reconcile", reconcile_start)],
-        states={
-            REC_ACC: [CallbackQueryHandler(reconcile_pick_acc, pattern=r"^acc:")],
-            REC_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, reconcile_amount)],
-        },
-        fallbacks=[],
-        per_message=False,
-    )
-    app.add_handler(rec_conv)
-
-    return app
-
-# ===================== FLASK + PTB RUNTIME =====================
-flask_app = Flask(__name__)
-
-# 1) Создаём PTB-приложение
-application = make_app()
-
-# 2) Заводим единый event-loop и запускаем PTB в фоне
-loop = asyncio.new_event_loop()
-asyncio.set_event_loop(loop)
-
-async def _startup():
-    await application.initialize()
-    await application.start()
-    # НЕ делаем run_polling / run_webhook — мы принимаем апдейты через Flask
-
-loop.create_task(_startup())
-
-def _run_loop():
-    loop.run_forever()
-
-threading.Thread(target=_run_loop, daemon=True).start()
-
-# 3) Webhook endpoint (синхронный) — безопасно прокидываем Update в очередь PTB
-@flask_app.post(f"/{BOT_TOKEN}")
-def webhook():
-    data = request.get_json(force=True)
-    update = Update.de_json(data, application.bot)
-    asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
-    return "ok", 200
-
-@flask_app.get("/")
-def index():
-    return "Bot is running", 200
+# bot.py
+import time
+# cold-start metric: everything from here to a ready worker
+IMPORT_STARTED = time.perf_counter()
+import os
+import re
+import csv
+import gzip
+import json
+import codecs
+import difflib
+import struct
+import heapq
+import hashlib
+import sqlite3
+import importlib
+import tempfile
+import logging
+import functools
+import itertools
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import date, datetime, time as dtime, timedelta
+from dotenv import load_dotenv
+
+import asyncio
+import threading
+
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
+)
+from telegram.constants import ChatType
+from telegram.error import TelegramError
+from telegram.ext import (
+    ApplicationBuilder, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ConversationHandler, filters, ContextTypes
+)
+
+import db
+import metrics
+from persistence import (
+    ChatOrderedUpdateProcessor, ConversationPrefetch, SQLitePersistence, SharedConversationHandler, UpdateDedupe,
+    create_schema as create_ptb_schema, current_update_id,
+)
+
+# ===================== ENV =====================
+load_dotenv()
+
+BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip().strip('"').strip("'")
+
+def require_token() -> str:
+    # checked when an app is built, so tools can import this module without one
+    if not BOT_TOKEN:
+        raise RuntimeError(
+            "❌ Не найден BOT_TOKEN. Задайте переменную окружения или строку в .env:\n"
+            "BOT_TOKEN=123456:ABC-DEF..."
+        )
+    return BOT_TOKEN
+BASE_CCY = os.getenv("BASE_CURRENCY", "USD").upper()
+DEFAULT_INPUT_CCY = os.getenv("DEFAULT_INPUT_CURRENCY", "ARS").upper()
+REPORT_MODE = os.getenv("REPORT_MODE", "latest").lower()
+
+DB_PATH = os.getenv("DB_PATH", "budget.db")
+# Bot API endpoint; point at a local stand-in (fake_bot_api.py) for load tests.
+BOT_API_URL = os.getenv("BOT_API_URL", "https://api.telegram.org").rstrip("/")
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "32"))
+# Both webhooks (asgi.py and create_app()): the secret_token passed to
+# setWebhook (empty disables the check), and the updates accepted but not yet
+# processed, beyond which they answer 503 and Telegram redelivers later.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Bot admins, comma-separated user ids. They may edit any chat's catalog
+# (/catalog); without the list a chat's own admins may (anyone, in a private
+# chat). /archive now runs only for them, so it is off while the list is empty.
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(",", " ").split()}
+
+# Every chat is a tenant with its own ledger. "shared" keeps all tenants in
+# DB_PATH; "sharded" gives each one its own file under SHARD_DIR, while fx
+# rates and bot state stay in DB_PATH.
+STORAGE_MODE = os.getenv("STORAGE_MODE", "shared").lower()
+SHARD_DIR = os.getenv("SHARD_DIR", "tenants")
+# Owner of the rows written before tenancy, and of writes by offline tools.
+# Upgrading a ledger written by several users (a group chat) requires it: set
+# it to that chat's id. A single user's ledger goes to their private chat.
+DEFAULT_TENANT = int(os.getenv("DEFAULT_TENANT_ID", "0"))
+
+log = logging.getLogger(__name__)
+
+# ===================== CONSTANTS =====================
+CATEGORIES = ["еда", "аренда", "развлечения", "прочее"]
+
+ACCOUNTS = [
+    "ARS (нал)",
+    "RUB (нал)",
+    "RUB (карта)",
+    "USD (нал)",
+    "USDT (биржа А)",
+    "USDT (биржа G)",
+    "BTC (биржа А)",
+    "BTC (биржа G)",
+    "ETH (биржа А)",
+    "EUR (карта)",
+]
+
+ACCOUNT_CCY = {
+    "ARS (нал)": "ARS",
+    "RUB (нал)": "RUB",
+    "RUB (карта)": "RUB",
+    "USD (нал)": "USD",
+    "USDT (биржа А)": "USDT",
+    "USDT (биржа G)": "USDT",
+    "BTC (биржа А)": "BTC",
+    "BTC (биржа G)": "BTC",
+    "ETH (биржа А)": "ETH",
+    "EUR (карта)": "EUR",
+}
+
+CCY_LIST = ["ARS","RUB","USD","USDT","BTC","ETH","EUR"]
+
+# Conversation states
+EXP_CAT, EXP_AMOUNT, EXP_CCY, EXP_ACC = range(4)
+INC_AMOUNT, INC_CCY, INC_ACC = range(3)
+EX_FROM_ACC, EX_TO_ACC, EX_AMOUNT, EX_RATE = range(4)
+REP_PERIOD, REP_CUSTOM_FROM, REP_CUSTOM_TO = range(3)
+REC_ACC, REC_AMOUNT = range(2)
+IMP_FILE = 0
+
+# ===================== DB =====================
+def _signed_amount(row:str="")->str:
+    col = f"{row}." if row else ""
+    return (f"CASE WHEN {col}type IN ('income','exchange_in','reconcile') THEN {col}amount "
+            f"WHEN {col}type IN ('expense','exchange_out') THEN -{col}amount ELSE 0 END")
+
+# Schema migrations, applied in order; PRAGMA user_version holds how many ran.
+# Never edit a released migration — append a new one.
+def _m001_base(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS transactions(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts TEXT NOT NULL,
+        user_id INTEGER,
+        username TEXT,
+        type TEXT CHECK(type IN ('expense','income','exchange_in','exchange_out','reconcile')) NOT NULL,
+        category TEXT,
+        account TEXT NOT NULL,
+        amount REAL NOT NULL,
+        currency TEXT NOT NULL,
+        note TEXT
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS fx_rates(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        to_usd REAL NOT NULL
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS settings(
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+    c.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('base_ccy',?)", (BASE_CCY,))
+    c.execute(
+        "INSERT INTO fx_rates(ts,currency,to_usd) "
+        "SELECT ?,?,? WHERE NOT EXISTS (SELECT 1 FROM fx_rates WHERE currency='USD')",
+        (datetime.utcnow().isoformat(), "USD", 1.0)
+    )
+
+def _m002_account_balances(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS account_balances(
+        account TEXT PRIMARY KEY,
+        balance REAL NOT NULL DEFAULT 0
+    )
+    """)
+    # account_balances is maintained by triggers in the same transaction as
+    # every write to transactions, whoever does the write.
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_balances_ins AFTER INSERT ON transactions BEGIN
+        INSERT INTO account_balances(account,balance) VALUES(NEW.account, {_signed_amount("NEW")})
+        ON CONFLICT(account) DO UPDATE SET balance=balance+excluded.balance;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_balances_del AFTER DELETE ON transactions BEGIN
+        UPDATE account_balances SET balance=balance-({_signed_amount("OLD")}) WHERE account=OLD.account;
+    END
+    """)
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_balances_upd AFTER UPDATE OF account,type,amount ON transactions BEGIN
+        UPDATE account_balances SET balance=balance-({_signed_amount("OLD")}) WHERE account=OLD.account;
+        INSERT INTO account_balances(account,balance) VALUES(NEW.account, {_signed_amount("NEW")})
+        ON CONFLICT(account) DO UPDATE SET balance=balance+excluded.balance;
+    END
+    """)
+    if c.execute("SELECT NOT EXISTS (SELECT 1 FROM account_balances)").fetchone()[0]:
+        c.execute(f"INSERT INTO account_balances(account,balance) "
+                  f"SELECT account, SUM({_signed_amount()}) FROM transactions GROUP BY account")
+
+def _m003_hot_path_indexes(c):
+    # latest / as-of rate lookups; to_usd included so the lookup never touches the table
+    c.execute("CREATE INDEX IF NOT EXISTS idx_fx_rates_ccy_ts ON fx_rates(currency, ts, to_usd)")
+    # expense report: type='expense' AND ts BETWEEN … GROUP BY category, currency
+    c.execute("CREATE INDEX IF NOT EXISTS idx_txn_type_ts ON transactions(type, ts, category, currency, amount)")
+    # per-account balance recomputation
+    c.execute("CREATE INDEX IF NOT EXISTS idx_txn_account ON transactions(account, type, amount)")
+    c.execute("ANALYZE")
+
+def _m004_fx_version(c):
+    # Bumped by every write to fx_rates; rate caches in all workers compare it
+    # before trusting their copy.
+    c.execute("INSERT OR IGNORE INTO settings(key,value) VALUES('fx_version','0')")
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_fx_version_{event.lower()} AFTER {event} ON fx_rates BEGIN
+            UPDATE settings SET value=CAST(value AS INTEGER)+1 WHERE key='fx_version';
+        END
+        """)
+
+def _m005_daily_expense_rollup(c):
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_expense_rollup(
+        day TEXT NOT NULL,
+        category TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(day, category, currency)
+    ) WITHOUT ROWID
+    """)
+    add = """
+        INSERT INTO daily_expense_rollup(day,category,currency,amount,n)
+        SELECT substr(NEW.ts,1,10), COALESCE(NEW.category,'прочее'), NEW.currency, NEW.amount, 1
+        WHERE NEW.type='expense'
+        ON CONFLICT(day,category,currency) DO UPDATE SET amount=amount+excluded.amount, n=n+1;
+    """
+    sub = """
+        UPDATE daily_expense_rollup SET amount=amount-OLD.amount, n=n-1
+        WHERE OLD.type='expense' AND day=substr(OLD.ts,1,10)
+          AND category=COALESCE(OLD.category,'прочее') AND currency=OLD.currency;
+    """
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_rollup_ins AFTER INSERT ON transactions BEGIN {add} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_rollup_del AFTER DELETE ON transactions BEGIN {sub} END")
+    c.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_upd AFTER UPDATE OF ts,type,category,currency,amount ON transactions
+    BEGIN {sub} {add} END
+    """)
+    c.execute("""
+    INSERT INTO daily_expense_rollup(day,category,currency,amount,n)
+    SELECT substr(ts,1,10), COALESCE(category,'прочее'), currency, SUM(amount), COUNT(*)
+    FROM transactions WHERE type='expense'
+    GROUP BY 1, 2, 3
+    """)
+
+def _m006_ptb_persistence(c):
+    create_ptb_schema(c)
+
+def _m007_import_hash(c):
+    # content hash of rows loaded by /import; re-importing a statement skips them
+    c.execute("ALTER TABLE transactions ADD COLUMN import_hash TEXT")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_txn_import_hash ON transactions(import_hash) "
+              "WHERE import_hash IS NOT NULL")
+
+def _legacy_tenant(c)->int:
+    """Chat that owns the rows written before tenancy.
+
+    DEFAULT_TENANT_ID when set. Otherwise a ledger written by one user only
+    is that user's private chat, whose id is the user id; an empty ledger
+    needs no owner. Rows from several users (a group chat) cannot be placed:
+    chats are tenants by chat id, so rows filed under 0 would vanish from
+    every chat."""
+    if os.getenv("DEFAULT_TENANT_ID") is not None:
+        return DEFAULT_TENANT
+    users = [user for (user,) in c.execute("SELECT DISTINCT user_id FROM transactions LIMIT 2")]
+    if not users:
+        return DEFAULT_TENANT
+    if len(users) == 1 and users[0] is not None:
+        log.warning("existing ledger assigned to the private chat of its only user %s", users[0])
+        return users[0]
+    raise RuntimeError("В базе уже есть операции нескольких пользователей: задайте DEFAULT_TENANT_ID — id чата, "
+                       "которому они принадлежат (для личного чата это id пользователя), и перезапустите бота.")
+
+def _m008_tenants(c):
+    # tenant_id (the chat id) on every ledger row and on everything derived from it
+    owner = _legacy_tenant(c)
+    c.execute(f"ALTER TABLE transactions ADD COLUMN tenant_id INTEGER NOT NULL DEFAULT {int(owner)}")
+    for name in ("idx_txn_type_ts", "idx_txn_account", "idx_txn_import_hash"):
+        c.execute(f"DROP INDEX IF EXISTS {name}")
+    c.execute("CREATE INDEX idx_txn_type_ts ON transactions(tenant_id, type, ts, category, currency, amount)")
+    c.execute("CREATE INDEX idx_txn_account ON transactions(tenant_id, account, type, amount)")
+    c.execute("CREATE UNIQUE INDEX idx_txn_import_hash ON transactions(tenant_id, import_hash) "
+              "WHERE import_hash IS NOT NULL")
+
+    # derived tables are rebuilt from the ledger with the tenant in their keys
+    for name in ("balances_ins", "balances_del", "balances_upd", "rollup_ins", "rollup_del", "rollup_upd"):
+        c.execute(f"DROP TRIGGER IF EXISTS trg_{name}")
+    c.execute("DROP TABLE IF EXISTS account_balances")
+    c.execute("DROP TABLE IF EXISTS daily_expense_rollup")
+    c.execute("""
+    CREATE TABLE account_balances(
+        tenant_id INTEGER NOT NULL,
+        account TEXT NOT NULL,
+        balance REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY(tenant_id, account)
+    ) WITHOUT ROWID
+    """)
+    c.execute("""
+    CREATE TABLE daily_expense_rollup(
+        tenant_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        category TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(tenant_id, day, category, currency)
+    ) WITHOUT ROWID
+    """)
+    bal_add = f"""
+        INSERT INTO account_balances(tenant_id,account,balance) VALUES(NEW.tenant_id, NEW.account, {_signed_amount("NEW")})
+        ON CONFLICT(tenant_id,account) DO UPDATE SET balance=balance+excluded.balance;
+    """
+    bal_sub = f"""
+        UPDATE account_balances SET balance=balance-({_signed_amount("OLD")})
+        WHERE tenant_id=OLD.tenant_id AND account=OLD.account;
+    """
+    roll_add = """
+        INSERT INTO daily_expense_rollup(tenant_id,day,category,currency,amount,n)
+        SELECT NEW.tenant_id, substr(NEW.ts,1,10), COALESCE(NEW.category,'прочее'), NEW.currency, NEW.amount, 1
+        WHERE NEW.type='expense'
+        ON CONFLICT(tenant_id,day,category,currency) DO UPDATE SET amount=amount+excluded.amount, n=n+1;
+    """
+    roll_sub = """
+        UPDATE daily_expense_rollup SET amount=amount-OLD.amount, n=n-1
+        WHERE OLD.type='expense' AND tenant_id=OLD.tenant_id AND day=substr(OLD.ts,1,10)
+          AND category=COALESCE(OLD.category,'прочее') AND currency=OLD.currency;
+    """
+    c.execute(f"CREATE TRIGGER trg_balances_ins AFTER INSERT ON transactions BEGIN {bal_add} END")
+    c.execute(f"CREATE TRIGGER trg_balances_del AFTER DELETE ON transactions BEGIN {bal_sub} END")
+    c.execute(f"CREATE TRIGGER trg_balances_upd AFTER UPDATE OF tenant_id,account,type,amount ON transactions "
+              f"BEGIN {bal_sub} {bal_add} END")
+    c.execute(f"CREATE TRIGGER trg_rollup_ins AFTER INSERT ON transactions BEGIN {roll_add} END")
+    c.execute(f"CREATE TRIGGER trg_rollup_del AFTER DELETE ON transactions BEGIN {roll_sub} END")
+    c.execute(f"CREATE TRIGGER trg_rollup_upd AFTER UPDATE OF tenant_id,ts,type,category,currency,amount "
+              f"ON transactions BEGIN {roll_sub} {roll_add} END")
+    _rebuild_account_balances(c)
+    _rebuild_expense_rollup(c)
+
+    # per-tenant settings (report_mode); base_ccy and fx_version stay global in settings
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS tenant_settings(
+        tenant_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        value TEXT,
+        PRIMARY KEY(tenant_id, key)
+    ) WITHOUT ROWID
+    """)
+    c.execute("INSERT OR IGNORE INTO tenant_settings(tenant_id,key,value) "
+              "SELECT ?, key, value FROM settings WHERE key='report_mode'", (owner,))
+    # a tenant's own accounts and categories; a tenant without rows of a kind uses the defaults
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS catalog(
+        tenant_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        name TEXT NOT NULL,
+        currency TEXT,
+        position INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY(tenant_id, kind, name)
+    )
+    """)
+
+def _m009_catalog_admin(c):
+    # archived entries leave the keyboards but still resolve for old rows and imports
+    c.execute("ALTER TABLE catalog ADD COLUMN archived INTEGER NOT NULL DEFAULT 0")
+    # per-tenant catalog_version, bumped by every edit; cached catalogs compare it
+    for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+        c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_catalog_version_{event.lower()} AFTER {event} ON catalog BEGIN
+            INSERT INTO tenant_settings(tenant_id,key,value) VALUES({row}.tenant_id,'catalog_version','1')
+            ON CONFLICT(tenant_id,key) DO UPDATE SET value=CAST(value AS INTEGER)+1;
+        END
+        """)
+
+def _m010_update_ids(c):
+    # the update a ledger row came from, unique per row of it: replays insert nothing
+    c.execute("ALTER TABLE transactions ADD COLUMN update_id INTEGER")
+    c.execute("ALTER TABLE transactions ADD COLUMN update_seq INTEGER")
+    c.execute("CREATE UNIQUE INDEX idx_txn_update ON transactions(update_id, update_seq) "
+              "WHERE update_id IS NOT NULL")
+    # webhook deliveries already accepted, kept for DEDUPE_TTL_SECS across restarts
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS seen_updates(
+        update_id INTEGER PRIMARY KEY,
+        seen_at INTEGER NOT NULL
+    )
+    """)
+
+def _m011_daily_account_deltas(c):
+    # net change per account and day, for as-of balances without reading the rows
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS daily_account_deltas(
+        tenant_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        account TEXT NOT NULL,
+        amount REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY(tenant_id, day, account)
+    ) WITHOUT ROWID
+    """)
+    add = f"""
+        INSERT INTO daily_account_deltas(tenant_id,day,account,amount)
+        VALUES(NEW.tenant_id, substr(NEW.ts,1,10), NEW.account, {_signed_amount("NEW")})
+        ON CONFLICT(tenant_id,day,account) DO UPDATE SET amount=amount+excluded.amount;
+    """
+    sub = f"""
+        UPDATE daily_account_deltas SET amount=amount-({_signed_amount("OLD")})
+        WHERE tenant_id=OLD.tenant_id AND day=substr(OLD.ts,1,10) AND account=OLD.account;
+    """
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_deltas_ins AFTER INSERT ON transactions BEGIN {add} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_deltas_del AFTER DELETE ON transactions BEGIN {sub} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_deltas_upd AFTER UPDATE OF tenant_id,ts,account,type,amount "
+              f"ON transactions BEGIN {sub} {add} END")
+    _rebuild_account_deltas(c)
+
+def _m012_expense_version(c):
+    # per-tenant expense_version, bumped by every change to an expense row; cached
+    # reports in all workers compare it
+    bump = """
+        INSERT INTO tenant_settings(tenant_id,key,value) VALUES({t},'expense_version','1')
+        ON CONFLICT(tenant_id,key) DO UPDATE SET value=CAST(value AS INTEGER)+1;
+    """
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_expense_version_ins AFTER INSERT ON transactions "
+              f"WHEN NEW.type='expense' BEGIN {bump.format(t='NEW.tenant_id')} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_expense_version_del AFTER DELETE ON transactions "
+              f"WHEN OLD.type='expense' BEGIN {bump.format(t='OLD.tenant_id')} END")
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS trg_expense_version_upd AFTER UPDATE ON transactions "
+              f"WHEN OLD.type='expense' OR NEW.type='expense' "
+              f"BEGIN {bump.format(t='OLD.tenant_id')} {bump.format(t='NEW.tenant_id')} END")
+
+def _m013_archives(c):
+    # rows of closed years live in yearly archive files; carry_year marks the
+    # opening-balance rows left in their place
+    c.execute("ALTER TABLE transactions ADD COLUMN carry_year INTEGER")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS archives(
+        year INTEGER PRIMARY KEY,
+        path TEXT NOT NULL,
+        rows INTEGER NOT NULL,
+        archived_at TEXT NOT NULL
+    )
+    """)
+
+MIGRATIONS = [
+    _m001_base,
+    _m002_account_balances,
+    _m003_hot_path_indexes,
+    _m004_fx_version,
+    _m005_daily_expense_rollup,
+    _m006_ptb_persistence,
+    _m007_import_hash,
+    _m008_tenants,
+    _m009_catalog_admin,
+    _m010_update_ids,
+    _m011_daily_account_deltas,
+    _m012_expense_version,
+    _m013_archives,
+]
+
+def init_db():
+    return db.migrate(DB_PATH, MIGRATIONS)
+
+# ===================== TENANTS =====================
+_ready_shards = set()
+_shard_lock = threading.Lock()
+
+def tenant_of(update: Update)->int:
+    chat = update.effective_chat
+    return chat.id if chat else DEFAULT_TENANT
+
+def _shard_path(tenant:int)->str:
+    return os.path.join(SHARD_DIR, f"tenant_{tenant}.db")
+
+def ledger_path(tenant:int)->str:
+    """DB file holding tenant's ledger, created and migrated on first use in sharded mode."""
+    if STORAGE_MODE != "sharded":
+        return DB_PATH
+    path = _shard_path(tenant)
+    if path not in _ready_shards:
+        with _shard_lock:
+            if path not in _ready_shards:
+                os.makedirs(SHARD_DIR, exist_ok=True)
+                db.migrate(path, MIGRATIONS)
+                _ready_shards.add(path)
+    return path
+
+async def open_ledger(tenant:int)->str:
+    """ledger_path() for the event loop: a new shard is migrated on the DB executor."""
+    if STORAGE_MODE != "sharded":
+        return DB_PATH
+    path = _shard_path(tenant)
+    return path if path in _ready_shards else await db.run(ledger_path, tenant)
+
+def split_into_shards()->dict:
+    """Copy every tenant's rows from DB_PATH into its own shard; returns {tenant: rows}.
+
+    Run once when switching STORAGE_MODE to sharded. Tenants whose shard
+    already has transactions are skipped, so it is safe to rerun."""
+    main = db.get_conn(DB_PATH)
+    tenants = [t for (t,) in main.execute("SELECT DISTINCT tenant_id FROM transactions")]
+    copied = {}
+    for tenant in tenants:
+        path = ledger_path(tenant)
+        if path == DB_PATH:
+            continue
+        conn = db.get_conn(path)
+        if conn.execute("SELECT 1 FROM transactions LIMIT 1").fetchone():
+            continue
+        conn.execute("ATTACH DATABASE ? AS src", (DB_PATH,))
+        try:
+            with db.transaction(path):
+                # derived tables fill in through the insert triggers
+                copied[tenant] = conn.execute("""
+                INSERT INTO main.transactions(id,ts,user_id,username,type,category,account,amount,currency,note,
+                                              import_hash,tenant_id,update_id,update_seq,carry_year)
+                SELECT id,ts,user_id,username,type,category,account,amount,currency,note,import_hash,tenant_id,
+                       update_id,update_seq,carry_year
+                FROM src.transactions WHERE tenant_id=?
+                """, (tenant,)).rowcount
+                # archive files hold every tenant's rows: the shard reads the same ones
+                conn.execute("INSERT OR IGNORE INTO main.archives SELECT * FROM src.archives")
+                start = hot_start(conn)
+                if start:
+                    # archived days keep their derived rows; carry rows added deltas of their own
+                    for table in ("daily_expense_rollup", "daily_account_deltas"):
+                        conn.execute(f"INSERT OR REPLACE INTO main.{table} SELECT * FROM src.{table} "
+                                     f"WHERE tenant_id=? AND day < ?", (tenant, start))
+                    _rebuild_account_deltas(conn, tenant)
+                for table in ("tenant_settings", "catalog"):
+                    conn.execute(f"INSERT OR IGNORE INTO main.{table} SELECT * FROM src.{table} WHERE tenant_id=?",
+                                 (tenant,))
+        finally:
+            conn.execute("DETACH DATABASE src")
+    return copied
+
+# ===================== CATALOG =====================
+CATALOG_KINDS = ("account", "category", "currency")
+# how long a worker trusts its cached catalog before re-reading catalog_version;
+# edits made through this worker show up at once
+CATALOG_CHECK_SECS = float(os.getenv("CATALOG_CHECK_SECS", "5"))
+# callback_data is capped at 64 bytes and carries "acc:"/"cat:" plus the name
+CATALOG_NAME_BYTES = 56
+
+class Catalog:
+    """A tenant's accounts (each with its currency), expense categories and currencies.
+
+    One instance per catalog version, never mutated: keyboards rendered from
+    it are memoized on the instance and dropped together with it."""
+
+    def __init__(self, accounts, categories, currencies, archived=(), version=0):
+        # accounts: [(name, currency)] in display order, archived ones included
+        self.version = version
+        self.checked = time.monotonic()
+        self.archived = set(archived)
+        self.account_ccy = dict(accounts)
+        self._names = {"account": list(self.account_ccy), "category": list(categories),
+                       "currency": list(currencies)}
+        self._by_key = {(kind, name.casefold()): name for kind, names in self._names.items() for name in names}
+        self.accounts, self.categories, self.currencies = (
+            [name for name in self._names[kind] if (kind, name) not in self.archived] for kind in CATALOG_KINDS)
+        self._keyboards = {}
+        self._parser = None
+
+    def match(self, kind:str, name:str)->str:
+        """Stored spelling of name (case-insensitive), archived entries included."""
+        found = self._by_key.get((kind, name.strip().casefold()))
+        if found is None:
+            raise ValueError(f"неизвестный {CATALOG_NOUNS[kind]} {name!r}")
+        return found
+
+    def match_account(self, name:str)->str:
+        return self.match("account", name)
+
+    def knows(self, kind:str, name:str)->bool:
+        return (kind, name.strip().casefold()) in self._by_key
+
+    def rows(self)->list:
+        """(kind, name, currency, position, archived) rows, as stored in the catalog table."""
+        return [(kind, name, self.account_ccy.get(name) if kind == "account" else None, pos,
+                 int((kind, name) in self.archived))
+                for kind in CATALOG_KINDS for pos, name in enumerate(self._names[kind])]
+
+    def keyboard(self, kind:str, page:int=0)->InlineKeyboardMarkup:
+        """Inline keyboard of kind ("acc", "cat", "ccy", "ccy_default"), built once per version and page."""
+        markup = self._keyboards.get((kind, page))
+        if markup is None:
+            markup = self._keyboards[kind, page] = _paged_keyboard(kind, *_keyboard_choices(self, kind), page)
+        return markup
+
+    def parser(self)->"QuickParser":
+        """Quick-entry name matcher for this version, built on first use."""
+        if self._parser is None:
+            self._parser = QuickParser(self)
+        return self._parser
+
+CATALOG_NOUNS = {"account": "счёт", "category": "категория", "currency": "валюта"}
+
+DEFAULT_CATALOG = Catalog([(acc, ACCOUNT_CCY[acc]) for acc in ACCOUNTS], CATEGORIES, CCY_LIST)
+
+_catalogs = {}   # tenant -> Catalog
+
+def _catalog_version(conn, tenant:int)->int:
+    row = conn.execute("SELECT value FROM tenant_settings WHERE tenant_id=? AND key='catalog_version'",
+                       (tenant,)).fetchone()
+    return int(row[0]) if row else 0
+
+def _load_catalog(conn, tenant:int, version:int)->Catalog:
+    rows = conn.execute("SELECT kind, name, currency, position, archived FROM catalog WHERE tenant_id=? "
+                        "ORDER BY kind, position, rowid", (tenant,)).fetchall() or DEFAULT_CATALOG.rows()
+    return Catalog(
+        [(name, ccy) for kind, name, ccy, _, _ in rows if kind == "account"],
+        [name for kind, name, _, _, _ in rows if kind == "category"],
+        [name for kind, name, _, _, _ in rows if kind == "currency"],
+        [(kind, name) for kind, name, _, _, archived in rows if archived],
+        version,
+    )
+
+def get_catalog(tenant:int=DEFAULT_TENANT)->Catalog:
+    """tenant's catalog, reloaded only when its catalog_version moved.
+
+    A tenant that never edited its catalog has no rows and gets the built-in one."""
+    conn = db.get_conn(ledger_path(tenant))
+    version = _catalog_version(conn, tenant)
+    cat = _catalogs.get(tenant)
+    if cat is not None and cat.version == version:
+        cat.checked = time.monotonic()
+        return cat
+    cat = _catalogs[tenant] = _load_catalog(conn, tenant, version)
+    return cat
+
+async def tenant_catalog(tenant:int)->Catalog:
+    """get_catalog() for the event loop: served from memory between version checks."""
+    cat = _catalogs.get(tenant)
+    if cat is not None and time.monotonic() - cat.checked < CATALOG_CHECK_SECS:
+        return cat
+    return await db.run(get_catalog, tenant)
+
+# ===================== FX RATE CACHE =====================
+def _fx_version(conn)->int:
+    row = conn.execute("SELECT value FROM settings WHERE key='fx_version'").fetchone()
+    return int(row[0]) if row else 0
+
+class RateCache:
+    """Latest to_usd per currency, shared by all threads of this process.
+
+    Each snapshot() costs one primary-key read of settings.fx_version; the
+    rates themselves are reloaded in a single query only when another writer
+    (this or any other worker) has changed fx_rates."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rates = {}
+        self._stamps = {}       # currency -> ts of its latest rate
+        self._version = None
+        self.hits = 0
+        self.misses = 0
+
+    def snapshot(self, conn=None)->dict:
+        conn = conn or db.get_conn(DB_PATH)
+        version = _fx_version(conn)
+        with self._lock:
+            if version == self._version:
+                self.hits += 1
+                return self._rates
+            self.misses += 1
+        # bare to_usd next to MAX(ts) comes from the latest row of each currency
+        rows = conn.execute("SELECT currency, to_usd, MAX(ts) FROM fx_rates GROUP BY currency").fetchall()
+        rates = {ccy: rate for ccy, rate, _ in rows}
+        with self._lock:
+            self._rates, self._version = rates, version
+            self._stamps = {ccy: ts for ccy, _, ts in rows}
+        return rates
+
+    def stamps(self, conn=None)->dict:
+        """{currency: ts of its latest rate}, as current as snapshot()."""
+        self.snapshot(conn)
+        return self._stamps
+
+    def cached_stamps(self)->dict:
+        # what the last snapshot saw, without touching the DB
+        return self._stamps
+
+    def written(self, rates:dict, version:int, ts:str=None):
+        # write-through when we were current right before this write, else reload lazily
+        with self._lock:
+            if self._version == version - len(rates):
+                self._rates = {**self._rates, **rates}
+                self._stamps = {**self._stamps, **dict.fromkeys(rates, ts or datetime.utcnow().isoformat())}
+                self._version = version
+            else:
+                self._version = None
+
+    def invalidate(self):
+        with self._lock:
+            self._version = None
+
+    def stats(self)->dict:
+        return {"hits": self.hits, "misses": self.misses, "version": self._version}
+
+rate_cache = RateCache()
+
+def _rate_from(rates:dict, currency:str)->float:
+    rate = rates.get(currency.upper())
+    if rate is not None:
+        return rate
+    raise ValueError(f"Нет курса для {currency}. Задайте /setrate {currency} <число> (сколько {BASE_CCY} за 1 {currency}).")
+
+def get_latest_rate(currency:str)->float:
+    return _rate_from(rate_cache.snapshot(), currency)
+
+def set_rate(currency:str, to_usd:float):
+    with db.transaction(DB_PATH) as conn:
+        version, _ = _write_ledger(conn, rates={currency.upper(): float(to_usd)})
+    rate_cache.written({currency.upper(): float(to_usd)}, version)
+    report_cache.rates_written({currency.upper(): float(to_usd)}, version)
+
+# ===================== FX RATE HISTORY =====================
+class RateTimeline:
+    """fx_rates history as per-currency sorted arrays for as-of lookups.
+
+    The rate as of ts is the latest one set at or before ts; amounts dated
+    before a currency's first rate use that first rate."""
+
+    def __init__(self, rows):
+        # rows: (currency, ts, to_usd) ordered by currency, ts
+        self._ts, self._rates = {}, {}
+        for ccy, ts, rate in rows:
+            self._ts.setdefault(ccy, []).append(ts)
+            self._rates.setdefault(ccy, []).append(rate)
+
+    def rate_at(self, currency:str, ts:str):
+        if currency == "USD":
+            return 1.0
+        tss = self._ts.get(currency)
+        if not tss:
+            return None
+        return self._rates[currency][max(bisect_right(tss, ts) - 1, 0)]
+
+    def mixed_days(self, first:str, last:str)->dict:
+        """{day: {currency}} for days in [first, last] during which the
+        currency's rate changes, so one end-of-day rate cannot value all of
+        that day's amounts. A first-ever rate is no change (earlier amounts use
+        it too), and neither is a rate set at the day's first instant."""
+        out = {}
+        for ccy, tss in self._ts.items():
+            lo = max(bisect_left(tss, first), 1)
+            for ts in tss[lo:bisect_right(tss, last + "T23:59:59.999999")]:
+                if ts[10:] > "T00:00:00":
+                    out.setdefault(ts[:10], set()).add(ccy)
+        return out
+
+    def extended(self, rows)->"RateTimeline":
+        """A copy with (currency, ts, to_usd) rows added. Currencies without new
+        rows share their arrays with self, which readers may still be using."""
+        new = RateTimeline(())
+        new._ts, new._rates = dict(self._ts), dict(self._rates)
+        copied = set()
+        for ccy, ts, rate in rows:
+            if ccy not in copied:
+                new._ts[ccy], new._rates[ccy] = list(self._ts.get(ccy, ())), list(self._rates.get(ccy, ()))
+                copied.add(ccy)
+            i = bisect_right(new._ts[ccy], ts)
+            new._ts[ccy].insert(i, ts)
+            new._rates[ccy].insert(i, rate)
+        return new
+
+    def sweep(self, marks)->list:
+        """[{currency: rate}] as of each of the ascending ts marks.
+
+        One forward cursor per currency walks its history alongside the marks,
+        so the cost is the rate rows plus marks × currencies, with no bisects."""
+        out = [{} for _ in marks]
+        for ccy, tss in self._ts.items():
+            rates, i = self._rates[ccy], 0
+            for k, mark in enumerate(marks):
+                while i + 1 < len(tss) and tss[i + 1] <= mark:
+                    i += 1
+                out[k][ccy] = rates[i]
+        return out
+
+    def convert(self, rows)->dict:
+        """Sum (ts, key, currency, amount) rows into {key: USD} in one pass.
+
+        Rows in ts order advance a forward cursor per currency (a merge with
+        the rate history); an out-of-order row falls back to bisect. Amounts
+        in currencies without any rate count as 0, like the latest-rate report."""
+        totals = {}
+        cursors = {}
+        last_ts = ""
+        for ts, key, ccy, amt in rows:
+            if ccy == "USD":
+                rate = 1.0
+            else:
+                tss = self._ts.get(ccy)
+                if not tss:
+                    rate = 0.0
+                else:
+                    if ts < last_ts or ccy not in cursors:
+                        i = max(bisect_right(tss, ts) - 1, 0)
+                    else:
+                        i = cursors[ccy]
+                        while i + 1 < len(tss) and tss[i + 1] <= ts:
+                            i += 1
+                    cursors[ccy] = i
+                    rate = self._rates[ccy][i]
+            last_ts = ts
+            totals[key] = totals.get(key, 0.0) + amt * rate
+        return totals
+
+_timeline_lock = threading.Lock()
+_timeline = (None, None, 0)     # fx_version, RateTimeline, highest fx_rates.id in it
+
+def get_rate_timeline()->RateTimeline:
+    """Process-wide RateTimeline, brought up to date when fx_version changes.
+
+    Every fx_rates row written bumps fx_version once, so when the rows past
+    the last loaded id account for the whole bump they are simply added;
+    anything else (an update or delete) reloads the history."""
+    global _timeline
+    if _fx_version(db.get_conn(DB_PATH)) == _timeline[0]:
+        return _timeline[1]
+    with _timeline_lock, db.snapshot(DB_PATH) as conn:
+        version = _fx_version(conn)
+        cached_version, timeline, last_id = _timeline
+        if version == cached_version:
+            return timeline
+        rows = None
+        if timeline is not None and version > cached_version:
+            rows = conn.execute("SELECT id, currency, ts, to_usd FROM fx_rates WHERE id > ? ORDER BY id",
+                                (last_id,)).fetchall()
+        if rows is not None and len(rows) == version - cached_version:
+            timeline = timeline.extended((ccy, ts, rate) for _, ccy, ts, rate in rows)
+            last_id = rows[-1][0] if rows else last_id
+        else:
+            timeline = RateTimeline(conn.execute("SELECT currency, ts, to_usd FROM fx_rates ORDER BY currency, ts"))
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM fx_rates").fetchone()[0]
+        _timeline = (version, timeline, last_id)
+    return timeline
+
+def reset_rate_caches():
+    """Drop every in-process rate cache; the next lookup reloads from fx_rates."""
+    global _timeline
+    rate_cache.invalidate()
+    with _timeline_lock:
+        _timeline = (None, None, 0)
+
+# ===================== FX RATE REFRESH =====================
+# With FX_PROVIDER set, rates refresh in the background instead of only
+# through /setrate and exchange deals. A currency is due once its latest
+# rate, written by anyone (any worker, /setrate included), is older than its
+# TTL; one batched request fetches everything due and one transaction writes
+# it. Readers keep using the last known rate meanwhile, and a failed fetch
+# leaves it in place.
+FX_PROVIDER = os.getenv("FX_PROVIDER", "").strip()     # "", "http", "file" or "module:factory"
+# http: {symbols} (comma-separated) and {base} are filled in, e.g.
+# https://api.example.com/latest?base={base}&symbols={symbols}
+FX_URL = os.getenv("FX_URL", "")
+FX_FILE = os.getenv("FX_FILE", "rates.json")
+# "per_usd": units of the currency per 1 USD, as most FX APIs quote;
+# "to_usd": USD per 1 unit, as fx_rates stores it
+FX_QUOTE = os.getenv("FX_QUOTE", "per_usd").lower()
+FX_TTL_SECS = int(os.getenv("FX_TTL_SECS", "3600"))
+# per-currency TTLs, e.g. "BTC=300,ETH=300"
+FX_TTL = {ccy.upper(): int(secs) for ccy, secs in
+          (item.split("=", 1) for item in os.getenv("FX_TTL", "").replace(" ", "").split(",") if item)}
+# how often the job looks for due currencies
+FX_REFRESH_SECS = int(os.getenv("FX_REFRESH_SECS", "60"))
+FX_TIMEOUT_SECS = float(os.getenv("FX_TIMEOUT_SECS", "10"))
+# a currency the provider did not answer for is asked again after this
+FX_RETRY_SECS = 300
+# /balance waits this long for a currency that has no rate at all
+FX_WAIT_SECS = 3.0
+
+def _quotes(payload)->dict:
+    # {"rates": {currency: quote}} as FX APIs answer, or a bare {currency: quote}
+    rates = payload.get("rates", payload) if isinstance(payload, dict) else None
+    if not isinstance(rates, dict):
+        raise ValueError("в ответе нет курсов")
+    return {str(ccy).upper(): quote for ccy, quote in rates.items()}
+
+def _to_usd(quotes:dict, currencies)->dict:
+    # {currency: USD per unit} for the requested currencies the provider quoted sensibly
+    rates = {}
+    for ccy in currencies:
+        try:
+            quote = float(quotes[ccy])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 0 < quote < float("inf"):
+            rates[ccy] = 1 / quote if FX_QUOTE == "per_usd" else quote
+    return rates
+
+class HttpRateProvider:
+    """Every due currency in one GET to FX_URL, on one client shared by all refreshes."""
+
+    def __init__(self, url:str=FX_URL, timeout:float=FX_TIMEOUT_SECS):
+        if not url:
+            raise RuntimeError("FX_PROVIDER=http требует FX_URL")
+        self.url, self.timeout = url, timeout
+        self._client = None
+
+    async def fetch(self, currencies)->dict:
+        if self._client is None:
+            import httpx    # only the http provider needs it
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        resp = await self._client.get(self.url.format(symbols=",".join(currencies), base="USD"))
+        resp.raise_for_status()
+        return _to_usd(_quotes(resp.json()), currencies)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+class FileRateProvider:
+    """Quotes from a local JSON file shaped like the HTTP answer, re-read on every fetch.
+
+    Offline stand-in; for a local HTTP one, serve the same file (python -m
+    http.server) and point FX_URL at it."""
+
+    def __init__(self, path:str=FX_FILE):
+        self.path = path
+
+    def _read(self):
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    async def fetch(self, currencies)->dict:
+        return _to_usd(_quotes(await asyncio.to_thread(self._read)), currencies)
+
+    async def close(self):
+        pass
+
+FX_PROVIDERS = {"http": HttpRateProvider, "file": FileRateProvider}
+
+def make_rate_provider(name:str=FX_PROVIDER):
+    """Provider for FX_PROVIDER: a key of FX_PROVIDERS or "module:factory"; None when unset.
+
+    A provider has async fetch(currencies) -> {currency: USD per unit} for
+    those it could price, and async close()."""
+    if not name:
+        return None
+    factory = FX_PROVIDERS.get(name.lower())
+    if factory is None:
+        module, _, attr = name.partition(":")
+        if not attr:
+            raise RuntimeError(f"Неизвестный FX_PROVIDER {name!r}: {', '.join(FX_PROVIDERS)} или module:factory")
+        factory = getattr(importlib.import_module(module), attr)
+    return factory()
+
+class RateRefresher:
+    """Keeps fx_rates fresh from a provider; refreshes share the fetch in flight."""
+
+    def __init__(self, provider=None):
+        self.provider = provider
+        self._wanted = set(CCY_LIST)    # grows with the currencies of tenants' catalogs
+        self._retry_at = {}     # currency -> monotonic time it may be asked for again
+        self._checked = {}      # currency -> when the provider last confirmed the stored rate
+        self._inflight = None
+        self.fetches = 0
+        self.failures = 0
+
+    def ttl(self, currency:str)->int:
+        return FX_TTL.get(currency, FX_TTL_SECS)
+
+    def due(self, stamps:dict, now:datetime=None)->list:
+        """Wanted currencies whose latest rate is missing or older than its TTL.
+
+        Only catalog currencies are wanted: a code that merely appears in
+        fx_rates (a mistyped /setrate) is never requested."""
+        now, mono = now or datetime.utcnow(), time.monotonic()
+        due = []
+        for ccy in sorted(self._wanted):
+            if ccy == "USD" or self._retry_at.get(ccy, 0) > mono:
+                continue
+            ts = max(stamps.get(ccy) or "", self._checked.get(ccy, "")) or None
+            if ts is None or (now - datetime.fromisoformat(ts)).total_seconds() >= self.ttl(ccy):
+                due.append(ccy)
+        return due
+
+    async def refresh(self, currencies=())->dict:
+        """Fetch and store every due currency, currencies (wanted from now on) included.
+
+        Joins a refresh already running, and starts one more when that one
+        did not cover currencies. Returns {currency: to_usd} written."""
+        if self.provider is None:
+            return {}
+        wanted = {ccy.upper() for ccy in currencies} - {"USD"}
+        self._wanted |= wanted
+        written = {}
+        for _ in range(2):
+            if self._inflight is None or self._inflight.done():
+                self._inflight = asyncio.ensure_future(self._refresh())
+            written.update(await asyncio.shield(self._inflight))
+            if not wanted - set(written) or not set(self.due(rate_cache.cached_stamps())) & wanted:
+                break
+        return written
+
+    def revalidate(self):
+        """Start a background refresh when the rates just served include due ones; never waits."""
+        if self.provider is None or (self._inflight is not None and not self._inflight.done()):
+            return
+        if self.due(rate_cache.cached_stamps()):
+            self._inflight = asyncio.ensure_future(self._refresh())
+
+    async def _refresh(self)->dict:
+        self._wanted |= await db.run(catalog_currencies)
+        due = self.due(await db.run(rate_cache.stamps))
+        if not due:
+            return {}
+        self.fetches += 1
+        try:
+            rates = await self.provider.fetch(due)
+        except Exception as e:
+            self.failures += 1
+            log.warning("fx refresh of %s failed, keeping the last known rates: %r", ",".join(due), e)
+            rates = {}
+        retry_at = time.monotonic() + FX_RETRY_SECS
+        for ccy in due:
+            if ccy in rates:
+                self._retry_at.pop(ccy, None)
+            else:
+                self._retry_at[ccy] = retry_at
+        metrics.FX_REFRESH.inc("ok" if len(rates) == len(due) else "partial" if rates else "failed")
+        # an unchanged rate is not stored again: it would only grow fx_rates and
+        # bump fx_version, and with it every worker's rate caches
+        latest, checked = await db.run(rate_cache.snapshot), datetime.utcnow().isoformat()
+        for ccy, rate in list(rates.items()):
+            if ccy in latest and abs(latest[ccy] - rate) <= 1e-12 * abs(rate):
+                self._checked[ccy] = checked
+                del rates[ccy]
+        if rates:
+            await write_ledger(rates=rates)
+        return rates
+
+    async def close(self):
+        if self.provider is not None:
+            await self.provider.close()
+
+rate_refresher = RateRefresher()
+
+def catalog_currencies()->set:
+    """Currencies in use by any tenant's catalog (defaults excluded), across every ledger file."""
+    found = set()
+    for path in _ledger_files():
+        try:
+            found.update(ccy.upper() for (ccy,) in db.get_conn(path).execute(
+                "SELECT DISTINCT name FROM catalog WHERE kind='currency' AND NOT archived"))
+        except sqlite3.Error as e:
+            log.warning("catalog currencies of %s unavailable: %r", path, e)
+    return found
+
+async def refresh_rates_job(context: ContextTypes.DEFAULT_TYPE):
+    await rate_refresher.refresh()
+
+# ===================== LEDGER =====================
+def txn_row(ts, user, ttype, category, account, amount, currency, note=None)->tuple:
+    return (
+        ts,
+        getattr(user, "id", None) if user else None,
+        getattr(user, "username", None) if user else None,
+        ttype, category, account, amount, currency.upper(), note
+    )
+
+# update_id/update_seq tie a row to the update that created it; a replay of
+# the update conflicts on idx_txn_update and inserts nothing
+_TXN_INSERT = """
+INSERT INTO transactions(tenant_id,ts,user_id,username,type,category,account,amount,currency,note,
+                         update_id,update_seq)
+VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+ON CONFLICT(update_id,update_seq) WHERE update_id IS NOT NULL DO NOTHING
+"""
+
+def _expense_version(conn, tenant:int)->int:
+    row = conn.execute("SELECT value FROM tenant_settings WHERE tenant_id=? AND key='expense_version'",
+                       (tenant,)).fetchone()
+    return int(row[0]) if row else 0
+
+def _write_ledger(conn, txns=(), rates=None, tenant:int=DEFAULT_TENANT, update_id:int=None):
+    """Insert tenant's txn_row() tuples and {currency: to_usd} rates in the caller's transaction.
+
+    Rows written for an update (update_id) go in once: when they are already
+    there, its rates are skipped too. Returns (fx_version after the rate
+    inserts or None without rates, (expense_version before, after) or None
+    without expense rows) for the caches to vouch for what they hold."""
+    expenses = None
+    if txns:
+        if any(row[3] == "expense" for row in txns):
+            expenses = (_expense_version(conn, tenant),)
+        cur = conn.executemany(_TXN_INSERT, ((tenant,) + row + (update_id, seq) for seq, row in enumerate(txns)))
+        if cur.rowcount < len(txns):
+            metrics.DUPLICATE_UPDATES.inc("ledger")
+            if cur.rowcount == 0:
+                rates = None
+        if expenses:
+            expenses += (_expense_version(conn, tenant),)
+    if rates:
+        ts = datetime.utcnow().isoformat()
+        conn.executemany("INSERT INTO fx_rates(ts,currency,to_usd) VALUES(?,?,?)",
+                         [(ts, ccy, rate) for ccy, rate in rates.items()])
+    return (_fx_version(conn) if rates else None), expenses
+
+def add_txn(ts, user, ttype, category, account, amount, currency, note=None, tenant:int=DEFAULT_TENANT):
+    with db.transaction(ledger_path(tenant)) as conn:
+        _write_ledger(conn, [txn_row(ts, user, ttype, category, account, amount, currency, note)], tenant=tenant)
+
+async def write_ledger(txns=(), rates=None, tenant:int=DEFAULT_TENANT):
+    """Commit txns and rates as one atomic unit through the group-commit writer.
+
+    With sharded storage the rates go to DB_PATH first and the rows to the
+    tenant's file after; a rate left without its exchange rows is harmless.
+    Inside an update handler the rows are tagged with its update_id."""
+    rates = {ccy.upper(): float(rate) for ccy, rate in (rates or {}).items()}
+    update_id = current_update_id.get()
+    path = await open_ledger(tenant) if txns else DB_PATH
+    if rates and path != DB_PATH:
+        version, _ = await db.write(DB_PATH, _write_ledger, (), rates)
+        expenses = None
+        if txns:
+            _, expenses = await db.write(path, _write_ledger, list(txns), None, tenant, update_id)
+    else:
+        version, expenses = await db.write(path, _write_ledger, list(txns), rates, tenant, update_id)
+    if rates and version is not None:
+        rate_cache.written(rates, version)
+        report_cache.rates_written(rates, version)
+    if expenses:
+        report_cache.rows_written(tenant, [row[0] for row in txns if row[3] == "expense"], *expenses)
+
+def get_account_balance(account:str, tenant:int=DEFAULT_TENANT)->float:
+    c = db.get_conn(ledger_path(tenant)).cursor()
+    c.execute("SELECT balance FROM account_balances WHERE tenant_id=? AND account=?", (tenant, account))
+    row = c.fetchone()
+    return row[0] if row else 0.0
+
+def sum_balances_by_account(tenant:int=DEFAULT_TENANT):
+    cat = get_catalog(tenant)
+    res = {acc: 0.0 for acc in cat.accounts}
+    c = db.get_conn(ledger_path(tenant)).cursor()
+    c.execute("SELECT account, balance FROM account_balances WHERE tenant_id=?", (tenant,))
+    for acc, bal in c.fetchall():
+        # archived accounts stay listed while they still hold money
+        if acc in res or (acc in cat.account_ccy and abs(bal) > 1e-12):
+            res[acc] = bal
+    return res
+
+def _ledger_balances(conn, tenant:int=None)->dict:
+    # {(tenant, account): balance}, one tenant or all of them
+    where, params = ("WHERE tenant_id=?", (tenant,)) if tenant is not None else ("", ())
+    c = conn.execute(f"SELECT tenant_id, account, SUM({_signed_amount()}) FROM transactions {where} "
+                     f"GROUP BY tenant_id, account", params)
+    return {(t, acc): total or 0.0 for t, acc, total in c.fetchall()}
+
+def _rebuild_account_balances(conn, tenant:int=None):
+    if tenant is None:
+        conn.execute("DELETE FROM account_balances")
+    else:
+        conn.execute("DELETE FROM account_balances WHERE tenant_id=?", (tenant,))
+    conn.executemany("INSERT INTO account_balances(tenant_id,account,balance) VALUES(?,?,?)",
+                     ((t, acc, bal) for (t, acc), bal in _ledger_balances(conn, tenant).items()))
+
+def _rebuild_account_deltas(conn, tenant:int=None):
+    where, params = ["1"], []
+    if tenant is not None:
+        where.append("tenant_id=?")
+        params.append(tenant)
+    # archived days keep their deltas; carry-forward rows stand for them and add none
+    start = hot_start(conn)
+    if start:
+        where.append("day >= ?")
+        params.append(start)
+    conn.execute(f"DELETE FROM daily_account_deltas WHERE {' AND '.join(where)}", params)
+    if start:
+        where[-1] = "ts >= ? AND carry_year IS NULL"
+    conn.execute(f"""
+    INSERT INTO daily_account_deltas(tenant_id,day,account,amount)
+    SELECT tenant_id, substr(ts,1,10), account, SUM({_signed_amount()})
+    FROM transactions WHERE {' AND '.join(where)}
+    GROUP BY 1, 2, 3
+    """, params)
+
+def verify_account_balances(repair:bool=True, tenant:int=DEFAULT_TENANT):
+    """Recompute tenant's balances from the ledger; return [(account, stored, actual)] that drifted."""
+    with db.transaction(ledger_path(tenant)) as conn:
+        actual = {acc: bal for (_, acc), bal in _ledger_balances(conn, tenant).items()}
+        stored = dict(conn.execute("SELECT account, balance FROM account_balances WHERE tenant_id=?",
+                                   (tenant,)).fetchall())
+        drift = []
+        for acc in sorted(set(actual) | set(stored)):
+            a, s = actual.get(acc, 0.0), stored.get(acc, 0.0)
+            if abs(a - s) > 1e-9 * max(1.0, abs(a)):
+                drift.append((acc, s, a))
+        if drift and repair:
+            _rebuild_account_balances(conn, tenant)
+            _rebuild_account_deltas(conn, tenant)
+    return drift
+
+def _rebuild_expense_rollup(conn, day_from:str=None, day_to:str=None, tenant:int=None):
+    # archived days keep their rollup: their rows are in the yearly archives
+    start = hot_start(conn)
+    if start:
+        if day_to and day_to < start:
+            return
+        day_from, day_to = max(day_from or start, start), day_to or "9999-12-31"
+    where, params = [], []
+    if tenant is not None:
+        where.append("tenant_id=?")
+        params.append(tenant)
+    if day_from and day_to:
+        where.append("day BETWEEN ? AND ?")
+        params += [day_from, day_to]
+    conn.execute("DELETE FROM daily_expense_rollup" + (" WHERE " + " AND ".join(where) if where else ""), params)
+    if day_from and day_to:
+        # "~" sorts after any time suffix, so this covers every ts on day_to
+        where[-1] = "ts >= ? AND ts < ?"
+        params[-1] = day_to + "~"
+    conn.execute(f"""
+    INSERT INTO daily_expense_rollup(tenant_id,day,category,currency,amount,n)
+    SELECT tenant_id, substr(ts,1,10), COALESCE(category,'прочее'), currency, SUM(amount), COUNT(*)
+    FROM transactions WHERE type='expense' {"".join(" AND " + w for w in where)}
+    GROUP BY 1, 2, 3, 4
+    """, params)
+
+def backfill_expense_rollup(day_from:str=None, day_to:str=None, tenant:int=DEFAULT_TENANT)->int:
+    """Recompute tenant's daily_expense_rollup from the ledger (optionally only for a day range)."""
+    with db.transaction(ledger_path(tenant)) as conn:
+        _rebuild_expense_rollup(conn, day_from, day_to, tenant)
+        # reports read the rollup: cached ones must not outlive a rebuild
+        conn.execute("INSERT INTO tenant_settings(tenant_id,key,value) VALUES(?,'expense_version','1') "
+                     "ON CONFLICT(tenant_id,key) DO UPDATE SET value=CAST(value AS INTEGER)+1", (tenant,))
+        return conn.execute("SELECT COUNT(*) FROM daily_expense_rollup WHERE tenant_id=?", (tenant,)).fetchone()[0]
+
+def sum_balances_in_usd(tenant:int=DEFAULT_TENANT):
+    """(total USD, [(account, amount, currency, USD)], [currencies without a rate]).
+
+    A non-empty account in a currency with no rate yet gets None for its USD
+    value and stays out of the total."""
+    acc_native = sum_balances_by_account(tenant)
+    account_ccy = get_catalog(tenant).account_ccy
+    rates = rate_cache.snapshot()
+    total_usd = 0.0
+    details, missing = [], []
+    for acc, amt in acc_native.items():
+        ccy = account_ccy[acc]
+        rate = 1.0 if ccy == "USD" else rates.get(ccy)
+        if rate is None and abs(amt) > 1e-12:
+            details.append((acc, amt, ccy, None))
+            if ccy not in missing:
+                missing.append(ccy)
+            continue
+        usd = amt * (rate or 0.0)
+        details.append((acc, amt, ccy, usd))
+        total_usd += usd
+    return total_usd, details, missing
+
+# Report valuation: "latest" converts with today's rates, "historical" with the
+# rate in effect when each expense happened.
+REPORT_MODES = ("latest", "historical")
+
+def get_report_mode(tenant:int=DEFAULT_TENANT)->str:
+    row = db.get_conn(ledger_path(tenant)).execute(
+        "SELECT value FROM tenant_settings WHERE tenant_id=? AND key='report_mode'", (tenant,)).fetchone()
+    return row[0] if row and row[0] in REPORT_MODES else REPORT_MODE
+
+def set_report_mode(mode:str, tenant:int=DEFAULT_TENANT):
+    if mode not in REPORT_MODES:
+        raise ValueError(f"Режим отчёта: {' / '.join(REPORT_MODES)}")
+    with db.transaction(ledger_path(tenant)) as conn:
+        conn.execute("INSERT INTO tenant_settings(tenant_id,key,value) VALUES(?,'report_mode',?) "
+                     "ON CONFLICT(tenant_id,key) DO UPDATE SET value=excluded.value", (tenant, mode))
+
+def parse_period(kind, frm=None, to=None):
+    now = datetime.now()
+    if kind == "Сегодня":
+        start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = now
+    elif kind == "Неделя":
+        start = (now - timedelta(days=6)).replace(hour=0, minute=0, second=0, microsecond=0)
+        end = now
+    elif kind == "Месяц" or kind == "С начала месяца":
+        start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = now
+    elif kind == "Произвольный" and frm and to:
+        start = datetime.fromisoformat(frm)
+        end = datetime.fromisoformat(to)
+    else:
+        start = now - timedelta(days=30)
+        end = now
+    return start, end
+
+# ===================== UI HELPERS =====================
+# Rows of choice buttons per keyboard page; longer lists get ‹ › page buttons.
+KEYBOARD_ROWS = int(os.getenv("KEYBOARD_ROWS", "10"))
+PAGE_PATTERN = r"^page:(acc|cat|ccy|ccy_default):\d+$"
+
+def _keyboard_choices(cat:Catalog, kind:str):
+    # -> ([(label, callback_data)], buttons per row)
+    if kind == "acc":
+        return [(acc, f"acc:{acc}") for acc in cat.accounts], 1
+    if kind == "cat":
+        return [(c.capitalize(), f"cat:{c}") for c in cat.categories], 1
+    lst = cat.currencies.copy()
+    if kind == "ccy_default" and DEFAULT_INPUT_CCY in lst:
+        lst.remove(DEFAULT_INPUT_CCY)
+        lst.insert(0, DEFAULT_INPUT_CCY)
+    return [(c, f"ccy:{c}") for c in lst], 3
+
+def _paged_keyboard(kind:str, choices, per_row:int, page:int)->InlineKeyboardMarkup:
+    size = KEYBOARD_ROWS * per_row
+    pages = max(1, -(-len(choices) // size))
+    page = min(max(page, 0), pages - 1)
+    chunk = choices[page * size:(page + 1) * size]
+    rows = [[InlineKeyboardButton(label, callback_data=data) for label, data in chunk[i:i + per_row]]
+            for i in range(0, len(chunk), per_row)]
+    if pages > 1:
+        nav = [InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"page:{kind}:{page}")]
+        if page > 0:
+            nav.insert(0, InlineKeyboardButton("‹", callback_data=f"page:{kind}:{page - 1}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("›", callback_data=f"page:{kind}:{page + 1}"))
+        rows.append(nav)
+    return InlineKeyboardMarkup(rows)
+
+def cat_keyboard(cat:Catalog=DEFAULT_CATALOG, page:int=0):
+    return cat.keyboard("cat", page)
+
+def ccy_keyboard(cat:Catalog=DEFAULT_CATALOG, default_first=True, page:int=0):
+    return cat.keyboard("ccy_default" if default_first else "ccy", page)
+
+def accounts_keyboard(cat:Catalog=DEFAULT_CATALOG, page:int=0):
+    return cat.keyboard("acc", page)
+
+async def keyboard_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # conversation fallback: flips the page in place and leaves the state as is
+    q = update.callback_query; await q.answer()
+    _, kind, page = q.data.split(":")
+    markup = (await tenant_catalog(tenant_of(update))).keyboard(kind, int(page))
+    if q.message is None or q.message.reply_markup != markup:
+        await q.edit_message_reply_markup(markup)
+
+def period_keyboard():
+    opts = ["Сегодня","Неделя","Месяц","С начала месяца","Произвольный"]
+    return InlineKeyboardMarkup([[InlineKeyboardButton(o, callback_data=f"period:{o}")] for o in opts])
+
+# ===================== COMMANDS =====================
+async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text = (
+        f"Привет! Я семейный бюджет-бот.\n\n"
+        f"База: {BASE_CCY}. Валюта ввода по умолчанию: {DEFAULT_INPUT_CCY}.\n\n"
+        f"Что умею:\n"
+        f"• /expense – записать расход\n"
+        f"• /income – записать доход\n"
+        f"• /exchange – обмен валют (фиксируем курс)\n"
+        f"• /e 1500 еда ARS (нал) – расход одной строкой; /i – доход, /x 100 USD (нал) > ARS (нал) @ 1 – обмен\n"
+        f"• /setrate <CCY> <курс_к_{BASE_CCY}> – задать/обновить курс\n"
+        f"• /balance – остатки по кошелькам и в {BASE_CCY}\n"
+        f"• /networth [месяцев] [мес|нед] [график] – динамика чистых активов в {BASE_CCY}\n"
+        f"• /report – отчёт по периодам\n"
+        f"• /reportmode – курс для отчёта: текущий или на дату расхода\n"
+        f"• /reconcile – сверка (ввести конечный остаток по кошельку)\n"
+        f"• /import [счёт] – загрузить выписку CSV\n"
+        f"• /export [период] [счёт] – выгрузить операции (CSV/JSONL, gzip)\n"
+        f"• /catalog – счета, категории и валюты: добавить, переименовать, в архив\n"
+        f"• /archive – закрытые годы в архиве; /archive now – перенести сейчас\n"
+        f"• /checkbalances – пересчитать остатки по журналу\n"
+        f"• /backfillrollup – пересчитать дневные итоги для отчётов\n"
+        f"• /help – подсказка"
+    )
+    if update.message:
+        await update.message.reply_text(text)
+
+async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message:
+        await update.message.reply_text("Команды: /expense /income /exchange /e /i /x /setrate /balance /networth /report /reconcile /import /export /catalog /archive /checkbalances /reportmode /backfillrollup")
+
+# ===================== EXPENSE FLOW =====================
+# Each step stores its field and asks for the next one still missing, so a
+# quick entry (/e) that left a field out resumes the flow at that field.
+def _reset_flow(context, prefix:str):
+    # fields of an abandoned run of the same flow must not be skipped over
+    for key in [k for k in context.user_data if k.startswith(prefix) or k == "note"]:
+        del context.user_data[key]
+
+# user_data field -> catalog kind of the name it holds
+_FLOW_NAMES = {"exp_cat": "category", "exp_acc": "account", "inc_acc": "account",
+               "ex_from": "account", "ex_to": "account", "rec_acc": "account"}
+
+def _drop_stale_names(data, cat:Catalog)->list:
+    """Remove flow fields naming an account or category cat no longer offers; returns the names.
+
+    A keyboard sent, or a flow begun, before a rename or archive still carries the old name."""
+    active = {"account": set(cat.accounts), "category": set(cat.categories)}
+    stale = [key for key, kind in _FLOW_NAMES.items() if key in data and data[key] not in active[kind]]
+    return [data.pop(key) for key in stale]
+
+def _stale_notice(send, names:list):
+    async def notice(text, **kwargs):
+        return await send(f"«{'», «'.join(names)}» больше нет в списке — выберите заново.\n{text}", **kwargs)
+    return notice
+
+async def _expense_next(send, context, tenant:int, user=None):
+    data = context.user_data
+    cat = await tenant_catalog(tenant)
+    stale = _drop_stale_names(data, cat)
+    if stale:
+        send = _stale_notice(send, stale)
+    if "exp_cat" not in data:
+        await send("Выберите категорию расхода:", reply_markup=cat_keyboard(cat))
+        return EXP_CAT
+    if "exp_amount" not in data:
+        await send(f"Категория: {data['exp_cat']}. Введите сумму (только число, {DEFAULT_INPUT_CCY} по умолчанию).")
+        return EXP_AMOUNT
+    if "exp_ccy" not in data:
+        await send(f"Выберите валюту (по умолчанию {DEFAULT_INPUT_CCY}) или укажите счёт:",
+                   reply_markup=ccy_keyboard(cat, default_first=True))
+        return EXP_CCY
+    if "exp_acc" not in data:
+        await send(f"Валюта: {data['exp_ccy']}. Теперь выберите счёт/кошелёк:", reply_markup=accounts_keyboard(cat))
+        return EXP_ACC
+    await write_ledger([txn_row(datetime.utcnow().isoformat(), user, "expense", data["exp_cat"], data["exp_acc"],
+                                data["exp_amount"], data["exp_ccy"], data.get("note"))], tenant=tenant)
+    await send(f"✅ Расход записан: {data['exp_amount']} {data['exp_ccy']} • {data['exp_cat']} • {data['exp_acc']}")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+async def expense_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _reset_flow(context, "exp_")
+    return await _expense_next(update.message.reply_text, context, tenant_of(update))
+
+async def expense_pick_cat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; await query.answer()
+    context.user_data["exp_cat"] = query.data.split(":",1)[1]
+    return await _expense_next(query.edit_message_text, context, tenant_of(update), query.from_user)
+
+async def expense_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    amount_str = update.message.text.replace(",", ".").strip()
+    try:
+        amount = float(amount_str)
+    except:
+        await update.message.reply_text("Не понял сумму. Введите число, например 123.45")
+        return EXP_AMOUNT
+    context.user_data["exp_amount"] = amount
+    return await _expense_next(update.message.reply_text, context, tenant_of(update), update.message.from_user)
+
+async def expense_pick_ccy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; await query.answer()
+    context.user_data["exp_ccy"] = query.data.split(":",1)[1]
+    return await _expense_next(query.edit_message_text, context, tenant_of(update), query.from_user)
+
+async def expense_pick_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query; await query.answer()
+    context.user_data["exp_acc"] = query.data.split(":",1)[1]
+    return await _expense_next(query.edit_message_text, context, tenant_of(update), query.from_user)
+
+# ===================== INCOME FLOW =====================
+async def _income_next(send, context, tenant:int, user=None):
+    data = context.user_data
+    cat = await tenant_catalog(tenant)
+    stale = _drop_stale_names(data, cat)
+    if stale:
+        send = _stale_notice(send, stale)
+    if "inc_amount" not in data:
+        await send("Введите сумму дохода (число).")
+        return INC_AMOUNT
+    if "inc_ccy" not in data:
+        await send("Выберите валюту дохода:", reply_markup=ccy_keyboard(cat, default_first=False))
+        return INC_CCY
+    if "inc_acc" not in data:
+        await send("Выберите счёт/кошелёк для зачисления:", reply_markup=accounts_keyboard(cat))
+        return INC_ACC
+    await write_ledger([txn_row(datetime.utcnow().isoformat(), user, "income", None, data["inc_acc"],
+                                data["inc_amount"], data["inc_ccy"], data.get("note"))], tenant=tenant)
+    await send(f"✅ Доход записан: {data['inc_amount']} {data['inc_ccy']} • {data['inc_acc']}")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+async def income_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _reset_flow(context, "inc_")
+    return await _income_next(update.message.reply_text, context, tenant_of(update))
+
+async def income_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    amount_str = update.message.text.replace(",", ".").strip()
+    try:
+        amount = float(amount_str)
+    except:
+        await update.message.reply_text("Не понял сумму. Введите число, например 500")
+        return INC_AMOUNT
+    context.user_data["inc_amount"] = amount
+    return await _income_next(update.message.reply_text, context, tenant_of(update), update.message.from_user)
+
+async def income_pick_ccy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    context.user_data["inc_ccy"] = q.data.split(":",1)[1]
+    return await _income_next(q.edit_message_text, context, tenant_of(update), q.from_user)
+
+async def income_pick_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    context.user_data["inc_acc"] = q.data.split(":",1)[1]
+    return await _income_next(q.edit_message_text, context, tenant_of(update), q.from_user)
+
+# ===================== EXCHANGE FLOW =====================
+def _exchange_rows(ts, user, from_acc, to_acc, amt, rate_to_usd, account_ccy, rates, note=None):
+    """Both legs of an exchange at the deal rate (USD per 1 unit of the source) -> (rows, target amount).
+
+    rates values the target currency; raises ValueError when it has no rate."""
+    from_ccy = account_ccy[from_acc]
+    to_ccy = account_ccy[to_acc]
+
+    if to_ccy == from_ccy:
+        to_usd_to_ccy = rate_to_usd
+    elif to_ccy != "USD":
+        to_usd_to_ccy = _rate_from(rates, to_ccy)
+    else:
+        to_usd_to_ccy = 1.0
+
+    usd_value = amt * rate_to_usd
+    target_rate = to_usd_to_ccy
+    target_amount = usd_value / target_rate
+    extra = f" • {note}" if note else ""
+    return [
+        txn_row(ts, user, "exchange_out", None, from_acc, amt, from_ccy, note=f"-> {to_acc}{extra}"),
+        txn_row(ts, user, "exchange_in", None, to_acc, target_amount, to_ccy, note=f"from {from_acc}{extra}"),
+    ], target_amount
+
+async def _exchange_next(send, context, tenant:int, user=None):
+    data = context.user_data
+    cat = await tenant_catalog(tenant)
+    stale = _drop_stale_names(data, cat)
+    if stale:
+        send = _stale_notice(send, stale)
+    if "ex_from" not in data or "ex_to" not in data:
+        if "ex_from" not in data:
+            await send("Выберите счёт, ОТКУДА списываем:", reply_markup=accounts_keyboard(cat))
+            return EX_FROM_ACC
+        await send("Теперь выберите счёт, КУДА зачисляем:", reply_markup=accounts_keyboard(cat))
+        return EX_TO_ACC
+    if "ex_amt" not in data:
+        await send("Введите сумму исходной валюты (число).")
+        return EX_AMOUNT
+    if "ex_rate" not in data:
+        await send("Введите курс сделки: сколько USD за 1 единицу исходной валюты.\nНапр.: ARS→USD: 0.0012; USD→EUR: 1.07 (но это USD за 1 исходной валюты).")
+        return EX_RATE
+    from_acc = data["ex_from"]; to_acc = data["ex_to"]; amt = data["ex_amt"]; rate_to_usd = data["ex_rate"]
+
+    account_ccy = cat.account_ccy
+    from_ccy = account_ccy[from_acc]
+    to_ccy = account_ccy[to_acc]
+    try:
+        rows, target_amount = _exchange_rows(datetime.utcnow().isoformat(), user, from_acc, to_acc, amt, rate_to_usd,
+                                             account_ccy, await db.run(rate_cache.snapshot), data.get("note"))
+    except ValueError:
+        await send(f"Нет курса для {to_ccy}. Задайте /setrate {to_ccy} <курс_к_{BASE_CCY}> и повторите обмен.")
+        context.user_data.clear()
+        return ConversationHandler.END
+
+    # deal rate and both legs commit together or not at all
+    await write_ledger(rows, rates={from_ccy: rate_to_usd}, tenant=tenant)
+
+    await send(f"✅ Обмен: {amt} {from_ccy} → {round(target_amount,8)} {to_ccy} (курс {from_ccy}→USD={rate_to_usd}).")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+async def exchange_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _reset_flow(context, "ex_")
+    return await _exchange_next(update.message.reply_text, context, tenant_of(update))
+
+async def ex_pick_from(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    context.user_data["ex_from"] = q.data.split(":",1)[1]
+    return await _exchange_next(q.edit_message_text, context, tenant_of(update), q.from_user)
+
+async def ex_pick_to(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    context.user_data["ex_to"] = q.data.split(":",1)[1]
+    return await _exchange_next(q.edit_message_text, context, tenant_of(update), q.from_user)
+
+async def ex_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        amt = float(update.message.text.replace(",", ".").strip())
+    except:
+        await update.message.reply_text("Нужно число, попробуйте ещё раз.")
+        return EX_AMOUNT
+    context.user_data["ex_amt"] = amt
+    return await _exchange_next(update.message.reply_text, context, tenant_of(update), update.message.from_user)
+
+async def ex_rate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        rate_to_usd = float(update.message.text.replace(",", ".").strip())
+    except:
+        await update.message.reply_text("Нужно число (курс к USD).")
+        return EX_RATE
+    context.user_data["ex_rate"] = rate_to_usd
+    return await _exchange_next(update.message.reply_text, context, tenant_of(update), update.message.from_user)
+
+# ===================== QUICK ENTRY =====================
+# A whole entry in one message, one entry per line:
+#   /e 1500 еда ARS (нал)              сумма [валюта] категория счёт
+#   /i 50000 USD (нал) # зарплата       сумма [валюта] счёт
+#   /x 100 USD (нал) > ARS (нал) @ 1    сумма откуда > куда @ курс к USD
+# Names match loosely: any case, brackets optional, word prefixes, small
+# typos. Amounts may group thousands with spaces (1 500) or dots (1.500.000);
+# a line with any other number left over, or a rate outside /x, is refused.
+# A single line with a field left out goes on as the usual flow from that
+# field; several lines are all recorded in one transaction or none is.
+QUICK_FUZZY_CUTOFF = 0.85
+QUICK_MAX_LINES = 50
+
+_QUICK_LINE = re.compile(r"""
+    \s*(?P<amount>                            # amount comes first when given:
+        \d{1,3}(?:[ \u00a0]\d{3}(?!\d))+(?:[.,]\d+)?    # 1 500, 12 000,50
+      | \d{1,3}(?:\.\d{3}){2,}(?:,\d+)?                 # 1.500.000 (one dot is a decimal point)
+      | \d+(?:[.,]\d+)?)?
+    (?P<body>.*?)
+    (?:\s*@\s*(?P<rate>\d+(?:[.,]\d+)?))?     # exchange: USD per 1 unit of the source
+    (?:\s*\#\s*(?P<note>.*?))?
+    \s*$""", re.X)
+# a number left over after the amount: a separator typed some other way
+_QUICK_STRAY_NUMBER = re.compile(r"\s*[\d.,]*\d")
+_QUICK_ARROW = re.compile(r"\s*(?:->|→|>)\s*")
+_QUICK_WORD = re.compile(r"\w+")
+# Cyrillic letters typed for their Latin look-alikes (биржа "A" vs "А")
+_QUICK_FOLD = str.maketrans("ёаекмнорстух", "eaekmhopctyx")
+# kind -> field -> (user_data key of its flow, name in messages)
+_QUICK_FIELDS = {
+    "expense": {"amount": ("exp_amount", "сумма"), "category": ("exp_cat", "категория"),
+                "account": ("exp_acc", "счёт")},
+    "income": {"amount": ("inc_amount", "сумма"), "account": ("inc_acc", "счёт")},
+    "exchange": {"amount": ("ex_amt", "сумма"), "from": ("ex_from", "счёт списания"),
+                 "to": ("ex_to", "счёт зачисления"), "rate": ("ex_rate", "курс")},
+}
+
+def _quick_words(text:str)->list:
+    return _QUICK_WORD.findall(text.casefold().translate(_QUICK_FOLD))
+
+class QuickParser:
+    """Typed words -> one catalog version's active names; built once per Catalog."""
+
+    def __init__(self, cat:Catalog):
+        self._names = {kind: [(name, _quick_words(name)) for name in names]
+                       for kind, names in (("account", cat.accounts), ("category", cat.categories),
+                                           ("currency", cat.currencies))}
+        self._compact = {kind: {"".join(words): name for name, words in names}
+                         for kind, names in self._names.items()}
+        self._account_ccy = cat.account_ccy
+
+    def resolve(self, kind:str, words:list, ccy:str=None):
+        """The one name words point at; None when no name or several do.
+
+        ccy settles a tie between accounts in different currencies."""
+        if not words:
+            return None
+        compact = self._compact[kind]
+        joined = "".join(words)
+        if joined in compact:
+            return compact[joined]
+        # each typed word is a word of the name or the start of one; whole words rank first
+        best, best_exact = [], -1
+        for name, name_words in self._names[kind]:
+            left, exact = list(name_words), 0
+            for w in words:
+                i = next((i for i, nw in enumerate(left) if nw == w), None)
+                if i is not None:
+                    exact += 1
+                else:
+                    i = next((i for i, nw in enumerate(left) if nw.startswith(w)), None)
+                    if i is None:
+                        break
+                left.pop(i)
+            else:
+                if exact > best_exact:
+                    best, best_exact = [name], exact
+                elif exact == best_exact:
+                    best.append(name)
+        if len(best) > 1 and ccy and kind == "account":
+            best = [name for name in best if self._account_ccy[name] == ccy]
+        if best:
+            return best[0] if len(best) == 1 else None
+        close = difflib.get_close_matches(joined, compact, n=2, cutoff=QUICK_FUZZY_CUTOFF)
+        return compact[close[0]] if len(close) == 1 else None
+
+    def currency(self, word:str):
+        # codes are short: exact only, no prefixes or typos
+        return self._compact["currency"].get(word)
+
+    def split(self, words:list, first:str, second:str, ccy:str=None)->tuple:
+        """words as a `first` name followed by a `second` one -> (first, second), None where not found."""
+        for k in range(1, len(words)):
+            a, b = self.resolve(first, words[:k], ccy), self.resolve(second, words[k:], ccy)
+            if a and b:
+                return a, b
+        a = self.resolve(first, words, ccy)
+        if a:
+            return a, None
+        b = self.resolve(second, words, ccy)
+        if b:
+            return None, b
+        # only one side recognised: keep it, the other one gets asked for
+        for k in range(len(words) - 1, 0, -1):
+            a = self.resolve(first, words[:k], ccy)
+            if a:
+                return a, None
+        for k in range(1, len(words)):
+            b = self.resolve(second, words[k:], ccy)
+            if b:
+                return None, b
+        return None, None
+
+def _quick_number(text:str):
+    if not text:
+        return None
+    text = re.sub(r"\s", "", text)
+    if text.count(".") > 1:
+        text = text.replace(".", "")
+    return float(text.replace(",", "."))
+
+def parse_quick_line(parser:QuickParser, kind:str, line:str)->dict:
+    """One quick-entry line -> {field: value}; a field is None when not given or not recognised.
+
+    "error" is set when the line must not be recorded at all."""
+    m = _QUICK_LINE.match(line)
+    fields = {"amount": _quick_number(m["amount"]), "note": m["note"] or None, "words": bool(m["body"].strip())}
+    if _QUICK_STRAY_NUMBER.match(m["body"]):
+        fields["error"] = f"не понял сумму в «{line.strip()}»"
+    elif m["rate"] and kind != "exchange":
+        fields["error"] = "курс (@ …) указывается только в /x"
+    if kind == "exchange":
+        fields["rate"] = _quick_number(m["rate"])
+        sides = _QUICK_ARROW.split(m["body"], maxsplit=1)
+        if len(sides) == 2:
+            fields["from"], fields["to"] = (parser.resolve("account", _quick_words(side)) for side in sides)
+        else:
+            fields["from"], fields["to"] = parser.split(_quick_words(m["body"]), "account", "account")
+        return fields
+    words = _quick_words(m["body"])
+    # a leading currency code is the currency, unless the words name more without it
+    options = [(None, words)]
+    if words and parser.currency(words[0]):
+        options.append((parser.currency(words[0]), words[1:]))
+    best = None
+    for ccy, rest in options:
+        if kind == "expense":
+            names = parser.split(rest, "category", "account", ccy)
+        else:
+            names = (None, parser.resolve("account", rest, ccy))
+        score = (sum(name is not None for name in names), ccy is not None)
+        if best is None or score > best[0]:
+            best = (score, ccy, names)
+    _, fields["currency"], (fields["category"], fields["account"]) = best
+    return fields
+
+def _quick_lines(text:str)->list:
+    first, _, rest = text.partition("\n")
+    head = first.split(maxsplit=1)
+    return [line for line in [head[1] if len(head) > 1 else ""] + rest.split("\n") if line.strip()]
+
+async def _quick_entry(update: Update, context: ContextTypes.DEFAULT_TYPE, kind:str):
+    tenant = tenant_of(update)
+    cat = await tenant_catalog(tenant)
+    lines = _quick_lines(update.message.text or "")
+    if len(lines) > QUICK_MAX_LINES:
+        await update.message.reply_text(f"Не больше {QUICK_MAX_LINES} строк за раз.")
+        return ConversationHandler.END
+    entries = [parse_quick_line(cat.parser(), kind, line) for line in lines]
+    user = update.message.from_user
+
+    if len(entries) <= 1:
+        # one line: whatever is missing is asked for by the usual flow
+        e = entries[0] if entries else {}
+        if e.get("error"):
+            await update.message.reply_text(f"Ничего не записано: {e['error']}.")
+            return ConversationHandler.END
+        prefix, step = _QUICK_FLOWS[kind]
+        _reset_flow(context, prefix)
+        data = context.user_data
+        for field, (key, _) in _QUICK_FIELDS[kind].items():
+            if e.get(field) is not None:
+                data[key] = e[field]
+        if kind != "exchange" and (e.get("currency") or e.get("account")):
+            data[prefix + "ccy"] = e.get("currency") or cat.account_ccy[e["account"]]
+        if e.get("note"):
+            data["note"] = e["note"]
+        send = update.message.reply_text
+        if e.get("words") and any(e.get(f) is None for f in _QUICK_FIELDS[kind] if f not in ("amount", "rate")):
+            async def send(text, **kwargs):
+                return await update.message.reply_text(f"Не всё узнал в «{lines[0].strip()}».\n{text}", **kwargs)
+        return await step(send, context, tenant, user)
+
+    # several lines: all complete, or nothing is written
+    problems = []
+    for n, e in enumerate(entries, start=1):
+        if e.get("error"):
+            problems.append(f"• строка {n}: {e['error']}")
+            continue
+        missing = [label for field, (_, label) in _QUICK_FIELDS[kind].items() if e.get(field) is None]
+        if missing:
+            problems.append(f"• строка {n}: нет или не узнал — {', '.join(missing)}")
+    if problems:
+        await update.message.reply_text("Ничего не записано:\n" + "\n".join(problems))
+        return ConversationHandler.END
+    ts = datetime.utcnow().isoformat()
+    txns, deal_rates, done = [], {}, []
+    rates = await db.run(rate_cache.snapshot) if kind == "exchange" else None
+    for n, e in enumerate(entries, start=1):
+        if kind == "expense":
+            ccy = e["currency"] or cat.account_ccy[e["account"]]
+            txns.append(txn_row(ts, user, "expense", e["category"], e["account"], e["amount"], ccy, e["note"]))
+            done.append(f"• расход {e['amount']} {ccy} • {e['category']} • {e['account']}")
+        elif kind == "income":
+            ccy = e["currency"] or cat.account_ccy[e["account"]]
+            txns.append(txn_row(ts, user, "income", None, e["account"], e["amount"], ccy, e["note"]))
+            done.append(f"• доход {e['amount']} {ccy} • {e['account']}")
+        else:
+            from_ccy, to_ccy = cat.account_ccy[e["from"]], cat.account_ccy[e["to"]]
+            try:
+                rows, target = _exchange_rows(ts, user, e["from"], e["to"], e["amount"], e["rate"],
+                                              cat.account_ccy, rates, e["note"])
+            except ValueError:
+                problems.append(f"• строка {n}: нет курса для {to_ccy}, задайте /setrate {to_ccy}")
+                continue
+            txns += rows
+            deal_rates[from_ccy] = e["rate"]
+            done.append(f"• обмен {e['amount']} {from_ccy} → {round(target, 8)} {to_ccy}")
+    if problems:
+        await update.message.reply_text("Ничего не записано:\n" + "\n".join(problems))
+        return ConversationHandler.END
+    await write_ledger(txns, rates=deal_rates or None, tenant=tenant)
+    await update.message.reply_text(f"✅ Записано: {len(entries)}\n" + "\n".join(done))
+    return ConversationHandler.END
+
+_QUICK_FLOWS = {"expense": ("exp_", _expense_next), "income": ("inc_", _income_next),
+                "exchange": ("ex_", _exchange_next)}
+
+async def quick_expense(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _quick_entry(update, context, "expense")
+
+async def quick_income(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _quick_entry(update, context, "income")
+
+async def quick_exchange(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await _quick_entry(update, context, "exchange")
+
+# ===================== SET RATE =====================
+async def setrate(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split()
+    if len(parts) != 3:
+        await update.message.reply_text(f"Формат: /setrate CCY КУРС_К_{BASE_CCY}\nНапр.: /setrate ARS 0.0012")
+        return
+    _, ccy, rate = parts
+    try:
+        await write_ledger(rates={ccy: float(rate)})
+    except Exception as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+        return
+    await update.message.reply_text(f"✅ Курс сохранён: 1 {ccy.upper()} = {rate} {BASE_CCY}")
+
+# ===================== CATALOG ADMIN =====================
+CATALOG_KIND_ALIASES = {
+    "account": "account", "счёт": "account", "счет": "account",
+    "category": "category", "категория": "category",
+    "currency": "currency", "валюта": "currency",
+}
+_CCY_CODE = re.compile(r"[A-Z0-9]{2,10}")
+
+async def can_edit_tenant(update: Update, context: ContextTypes.DEFAULT_TYPE)->bool:
+    """Whether the sender may rewrite this chat's ledger: one of ADMIN_IDS when
+    that is set, otherwise an admin of the chat (anyone in a private chat)."""
+    user, chat = update.effective_user, update.effective_chat
+    if user is None or chat is None:
+        return False
+    if ADMIN_IDS:
+        return user.id in ADMIN_IDS
+    if chat.type == ChatType.PRIVATE:
+        return True
+    try:
+        member = await context.bot.get_chat_member(chat.id, user.id)
+    except TelegramError:
+        log.warning("getChatMember failed for chat %s", chat.id, exc_info=True)
+        return False
+    return member.status in (ChatMember.OWNER, ChatMember.ADMINISTRATOR)
+
+def _catalog_name(kind:str, name:str)->str:
+    name = " ".join(name.split())
+    if kind == "category":
+        name = name.casefold()
+    elif kind == "currency":
+        name = name.upper()
+        if not _CCY_CODE.fullmatch(name):
+            raise ValueError(f"код валюты {name!r}: 2–10 латинских букв или цифр")
+    if not name or "->" in name or "→" in name:
+        raise ValueError("пустое или недопустимое название")
+    if len(name.encode()) > CATALOG_NAME_BYTES:
+        raise ValueError(f"название длиннее {CATALOG_NAME_BYTES} байт")
+    return name
+
+def _seed_catalog(conn, tenant:int):
+    # first edit: the tenant takes its own copy of the built-in catalog
+    if conn.execute("SELECT 1 FROM catalog WHERE tenant_id=? LIMIT 1", (tenant,)).fetchone() is None:
+        conn.executemany("INSERT INTO catalog(tenant_id,kind,name,currency,position,archived) VALUES(?,?,?,?,?,?)",
+                         ((tenant,) + row for row in DEFAULT_CATALOG.rows()))
+
+def _add_catalog_entry(conn, tenant:int, kind:str, name:str, currency:str=None):
+    conn.execute("INSERT INTO catalog(tenant_id,kind,name,currency,position) "
+                 "SELECT ?, ?, ?, ?, COALESCE(MAX(position), -1) + 1 FROM catalog WHERE tenant_id=? AND kind=?",
+                 (tenant, kind, name, currency, tenant, kind))
+
+def edit_catalog(conn, tenant:int, action:str, kind:str, name:str, arg:str=None)->str:
+    """Apply one /catalog edit in the caller's transaction; returns the entry's stored name.
+
+    add: arg is the account currency (added to the currencies if new).
+    rename: arg is the new name; the tenant's ledger rows follow the rename.
+    archive / restore: hide the entry from keyboards or bring it back."""
+    _seed_catalog(conn, tenant)
+    cat = _load_catalog(conn, tenant, None)
+    noun = CATALOG_NOUNS[kind]
+    if action == "add":
+        name = _catalog_name(kind, name)
+        if cat.knows(kind, name):
+            where = " (в архиве, верните через restore)" if (kind, cat.match(kind, name)) in cat.archived else ""
+            raise ValueError(f"{noun} {name!r} уже есть{where}")
+        if kind == "account":
+            currency = _catalog_name("currency", arg or "")
+            if not cat.knows("currency", currency):
+                _add_catalog_entry(conn, tenant, "currency", currency)
+            arg = cat.match("currency", currency) if cat.knows("currency", currency) else currency
+        _add_catalog_entry(conn, tenant, kind, name, arg if kind == "account" else None)
+        return name
+    name = cat.match(kind, name)
+    if action == "rename":
+        if kind == "currency":
+            raise ValueError("валюту нельзя переименовать: добавьте новую и отправьте старую в архив")
+        new = _catalog_name(kind, arg or "")
+        if cat.knows(kind, new) and cat.match(kind, new) != name:
+            raise ValueError(f"{noun} {new!r} уже есть")
+        conn.execute("UPDATE catalog SET name=? WHERE tenant_id=? AND kind=? AND name=?", (new, tenant, kind, name))
+        # triggers move balances and rollups to the new name; the emptied rows go
+        if kind == "account":
+            conn.execute("UPDATE transactions SET account=? WHERE tenant_id=? AND account=?", (new, tenant, name))
+            conn.execute("DELETE FROM account_balances WHERE tenant_id=? AND account=?", (tenant, name))
+        else:
+            conn.execute("UPDATE transactions SET category=? WHERE tenant_id=? AND category=?", (new, tenant, name))
+            conn.execute("DELETE FROM daily_expense_rollup WHERE tenant_id=? AND category=? AND n=0",
+                         (tenant, name))
+        return new
+    if action in ("archive", "restore"):
+        active = {"account": cat.accounts, "category": cat.categories, "currency": cat.currencies}[kind]
+        if action == "archive" and active == [name]:
+            raise ValueError(f"нельзя убрать в архив последний {noun}")
+        conn.execute("UPDATE catalog SET archived=? WHERE tenant_id=? AND kind=? AND name=?",
+                     (int(action == "archive"), tenant, kind, name))
+        return name
+    raise ValueError(f"неизвестное действие {action!r}")
+
+def _catalog_text(cat:Catalog)->str:
+    def label(kind, name):
+        return f"{name} (архив)" if (kind, name) in cat.archived else name
+    rows = cat.rows()
+    lines = ["Счета:"]
+    lines += [f"• {label(kind, name)} — {ccy}" for kind, name, ccy, _, _ in rows if kind == "account"]
+    lines.append("Категории: " + ", ".join(label(kind, name) for kind, name, *_ in rows if kind == "category"))
+    lines.append("Валюты: " + ", ".join(label(kind, name) for kind, name, *_ in rows if kind == "currency"))
+    return "\n".join(lines)
+
+CATALOG_USAGE = (
+    "Формат:\n"
+    "/catalog – показать счета, категории и валюты\n"
+    "/catalog add account <ВАЛЮТА> <название>\n"
+    "/catalog add category <название>\n"
+    "/catalog add currency <КОД>\n"
+    "/catalog rename account|category <старое> -> <новое>\n"
+    "/catalog archive|restore account|category|currency <название>"
+)
+
+async def catalog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(update)
+    args = context.args or []
+    if not args:
+        cat = await tenant_catalog(tenant)
+        await update.message.reply_text(_catalog_text(cat) + "\n\n" + CATALOG_USAGE)
+        return
+    # a rename rewrites the chat's ledger rows
+    if not await can_edit_tenant(update, context):
+        await update.message.reply_text("Изменять каталог могут только администраторы чата или бота.")
+        return
+    action = args[0].lower()
+    kind = CATALOG_KIND_ALIASES.get(args[1].lower()) if len(args) > 1 else None
+    rest = " ".join(args[2:])
+    if kind is None or not rest:
+        await update.message.reply_text(CATALOG_USAGE)
+        return
+    name, arg = rest, None
+    if action == "add" and kind == "account":
+        arg, _, name = rest.partition(" ")
+    elif action == "rename":
+        name, _, arg = rest.replace("→", "->").partition("->")
+    try:
+        stored = await db.write(await open_ledger(tenant), edit_catalog, tenant, action, kind, name, arg)
+    except ValueError as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+        return
+    _catalogs.pop(tenant, None)
+    noun = CATALOG_NOUNS[kind]
+    if action == "rename":
+        await update.message.reply_text(f"✅ Переименовано ({noun}): {' '.join(name.split())} → {stored}")
+    else:
+        done = {"add": "Добавлено", "archive": "В архиве", "restore": "Снова в списке"}[action]
+        await update.message.reply_text(f"✅ {done} ({noun}): {stored}")
+
+# ===================== BALANCE =====================
+async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(update)
+    total_usd, details, missing = await db.run(sum_balances_in_usd, tenant)
+    if missing and rate_refresher.provider is not None:
+        # no rate at all yet: give the provider a moment, then answer without it
+        try:
+            await asyncio.wait_for(rate_refresher.refresh(missing), FX_WAIT_SECS)
+        except asyncio.TimeoutError:
+            pass
+        total_usd, details, missing = await db.run(sum_balances_in_usd, tenant)
+    else:
+        # stale rates are served as they are and refreshed behind the reply
+        rate_refresher.revalidate()
+    lines = ["Остатки по кошелькам:"]
+    for acc, amt, ccy, usd in details:
+        value = f"~{round(usd,2)} USD" if usd is not None else "нет курса"
+        lines.append(f"• {acc}: {round(amt,8)} {ccy}  ({value})")
+    lines.append(f"\nИтого в USD: {round(total_usd,2)}")
+    if missing:
+        lines.append(f"Без курса, не вошли в итог: {', '.join(missing)}. "
+                     f"Задайте /setrate {missing[0]} <число> (сколько {BASE_CCY} за 1 {missing[0]}).")
+    await update.message.reply_text("\n".join(lines))
+
+async def check_balances(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    drift = await db.run(verify_account_balances, True, tenant_of(update))
+    if not drift:
+        await update.message.reply_text("✅ Остатки совпадают с журналом операций.")
+        return
+    lines = ["Найдены расхождения, остатки пересчитаны:"]
+    for acc, stored, actual in drift:
+        lines.append(f"• {acc}: было {round(stored,8)}, по журналу {round(actual,8)}")
+    await update.message.reply_text("\n".join(lines))
+
+# ===================== REPORT =====================
+async def report_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("Выберите период отчёта:", reply_markup=period_keyboard())
+    return REP_PERIOD
+
+async def report_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    kind = q.data.split(":",1)[1]
+    if kind == "Произвольный":
+        await q.edit_message_text("Введите даты в формате YYYY-MM-DD YYYY-MM-DD (от и до).")
+        return REP_CUSTOM_FROM
+    start, end = parse_period(kind)
+    await q.edit_message_text(await db.run(report_text, start, end, None, tenant_of(update), True))
+    return ConversationHandler.END
+
+async def report_custom(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        frm, to = update.message.text.strip().split()
+        start, end = parse_period("Произвольный", frm + "T00:00:00", to + "T23:59:59")
+    except Exception:
+        await update.message.reply_text("Формат: 2025-11-01 2025-11-10")
+        return REP_CUSTOM_FROM
+    await update.message.reply_text(await db.run(report_text, start, end, None, tenant_of(update)))
+    return ConversationHandler.END
+
+def _split_period(start: datetime, end: datetime):
+    """Split [start, end] into (head, days, tail).
+
+    days = (first, last) ISO dates fully inside the period, served by
+    daily_expense_rollup; head/tail = partial edge ranges (or None) read
+    from transactions."""
+    one_day, tick = timedelta(days=1), timedelta(microseconds=1)
+    first = start.date() if start.time() == dtime.min else start.date() + one_day
+    last = end.date() if end.time() == dtime.max else end.date() - one_day
+    if first > last:
+        return (start, end), None, None
+    first_start = datetime.combine(first, dtime.min)
+    after_last = datetime.combine(last + one_day, dtime.min)
+    head = (start, first_start - tick) if start < first_start else None
+    tail = (after_last, end) if end >= after_last else None
+    return head, (first.isoformat(), last.isoformat()), tail
+
+def _ledger_rows(conn, sql:str, tenant:int, period)->list:
+    # sql over "{}.transactions" for tenant and (start, end), through the archives the period reaches
+    frm, to = period[0].isoformat(), period[1].isoformat()
+    rows = []
+    for schema in ledger_schemas(conn, frm, to):
+        rows += conn.execute(sql.format(schema), (tenant, frm, to)).fetchall()
+    return rows
+
+def _report_rows_by_ts(conn, start: datetime, end: datetime, tenant:int=DEFAULT_TENANT,
+                       timeline:RateTimeline=None):
+    # (ts, category, currency, amount) in ts order; rollup days are valued at end of day,
+    # except a (day, currency) whose rate changes during the day per timeline, read raw
+    head, days, tail = _split_period(start, end)
+    raw_sql = """
+    SELECT ts, COALESCE(category,'прочее'), currency, amount
+    FROM {}.transactions
+    WHERE tenant_id=? AND type='expense' AND ts BETWEEN ? AND ?
+    ORDER BY ts
+    """
+    if head:
+        yield from _ledger_rows(conn, raw_sql, tenant, head)
+    if days:
+        rollup = conn.execute("""
+        SELECT day || 'T23:59:59.999999', category, currency, amount
+        FROM daily_expense_rollup WHERE tenant_id=? AND day BETWEEN ? AND ?
+        ORDER BY day
+        """, (tenant, *days))
+        mixed = timeline.mixed_days(*days) if timeline else {}
+        if not mixed:
+            yield from rollup
+        else:
+            raw = []
+            for first, last in _day_runs(sorted(mixed)):
+                period = (datetime.combine(date.fromisoformat(first), dtime.min),
+                          datetime.combine(date.fromisoformat(last), dtime.max))
+                raw += [r for r in _ledger_rows(conn, raw_sql, tenant, period) if r[2] in mixed[r[0][:10]]]
+            raw.sort(key=lambda r: r[0])
+            kept = (r for r in rollup if r[2] not in mixed.get(r[0][:10], ()))
+            yield from heapq.merge(kept, raw, key=lambda r: r[0])
+    if tail:
+        yield from _ledger_rows(conn, raw_sql, tenant, tail)
+
+def _day_runs(days:list):
+    # ascending ISO days -> [(first, last)] runs of consecutive days
+    runs = []
+    for day in days:
+        if runs and date.fromisoformat(day) - date.fromisoformat(runs[-1][1]) == timedelta(days=1):
+            runs[-1] = (runs[-1][0], day)
+        else:
+            runs.append((day, day))
+    return runs
+
+def _report_totals(conn, start: datetime, end: datetime, tenant:int=DEFAULT_TENANT):
+    # [(category, currency, amount)] summed over the period
+    head, days, tail = _split_period(start, end)
+    rows = []
+    for part in (head, tail):
+        if part:
+            rows += _ledger_rows(conn, """
+            SELECT COALESCE(category,'прочее'), currency, SUM(amount) 
+            FROM {}.transactions 
+            WHERE tenant_id=? AND type='expense' AND ts BETWEEN ? AND ?
+            GROUP BY category, currency
+            """, tenant, part)
+    if days:
+        rows += conn.execute("""
+        SELECT category, currency, SUM(amount)
+        FROM daily_expense_rollup WHERE tenant_id=? AND day BETWEEN ? AND ?
+        GROUP BY category, currency
+        """, (tenant, *days)).fetchall()
+    return rows
+
+def _tracked(rows, ccys:set):
+    for row in rows:
+        ccys.add(row[2])
+        yield row
+
+def make_report_text(start: datetime, end: datetime, mode:str=None, tenant:int=DEFAULT_TENANT,
+                     ccys:set=None)->str:
+    """Expense report text; the currencies it converted are added to ccys when given."""
+    mode = mode or get_report_mode(tenant)
+    conn = db.get_conn(ledger_path(tenant))
+    ccys = set() if ccys is None else ccys
+    # rates are global: they always come from DB_PATH
+    if mode == "historical":
+        timeline = get_rate_timeline()
+        cat_totals_usd = timeline.convert(_tracked(_report_rows_by_ts(conn, start, end, tenant, timeline), ccys))
+    else:
+        rates = rate_cache.snapshot()
+        cat_totals_usd = {}
+        for cat, ccy, amt in _report_totals(conn, start, end, tenant):
+            ccys.add(ccy)
+            rate = rates.get(ccy, 0.0)
+            usd = amt * (rate if ccy!="USD" else 1.0)
+            cat_totals_usd[cat] = cat_totals_usd.get(cat, 0.0) + usd
+
+    lines = [f"Отчёт {start.strftime('%Y-%m-%d')} → {end.strftime('%Y-%m-%d')}"]
+    if not cat_totals_usd:
+        lines.append("Нет расходов за период.")
+    else:
+        if mode == "historical":
+            lines.append("Расходы по категориям (в USD, по курсу на дату расхода):")
+        else:
+            lines.append("Расходы по категориям (в USD):")
+        for cat, val in cat_totals_usd.items():
+            lines.append(f"• {cat}: {round(val,2)}")
+    return "\n".join(lines)
+
+async def backfill_rollup_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split()
+    try:
+        if len(parts) == 3:
+            date.fromisoformat(parts[1]); date.fromisoformat(parts[2])
+            n = await db.run(backfill_expense_rollup, parts[1], parts[2], tenant_of(update))
+        else:
+            n = await db.run(backfill_expense_rollup, None, None, tenant_of(update))
+    except ValueError:
+        await update.message.reply_text("Формат: /backfillrollup [YYYY-MM-DD YYYY-MM-DD]")
+        return
+    await update.message.reply_text(f"✅ Дневные итоги пересчитаны ({n} строк).")
+
+async def report_mode_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split()
+    if len(parts) == 1:
+        mode = await db.run(get_report_mode, tenant_of(update))
+        await update.message.reply_text(f"Режим отчёта: {mode}\nИзменить: /reportmode latest|historical")
+        return
+    try:
+        await db.run(set_report_mode, parts[1].lower(), tenant_of(update))
+    except ValueError as e:
+        await update.message.reply_text(f"Ошибка: {e}")
+        return
+    await update.message.reply_text(f"✅ Режим отчёта: {parts[1].lower()}")
+
+# ===================== REPORT CACHE =====================
+REPORT_CACHE_SIZE = int(os.getenv("REPORT_CACHE_SIZE", "512"))
+# Periods computed ahead of time, after midnight and once a tenant's writes go
+# quiet for REPORT_PREWARM_QUIET_SECS.
+REPORT_PREWARM_PERIODS = ("Сегодня", "Неделя", "Месяц")
+REPORT_PREWARM_QUIET_SECS = float(os.getenv("REPORT_PREWARM_QUIET_SECS", "30"))
+
+class CachedReport:
+    __slots__ = ("text", "tenant", "start", "end", "mode", "ccys", "unrated", "expense_version", "fx_version")
+
+    def __init__(self, text, tenant, start, end, mode, ccys, unrated, expense_version, fx_version):
+        self.text, self.tenant, self.start, self.end, self.mode = text, tenant, start, end, mode
+        self.ccys, self.unrated = ccys, unrated
+        self.expense_version, self.fx_version = expense_version, fx_version
+
+class ReportCache:
+    """Report texts by (tenant, period, mode, catalog version), least recently used out.
+
+    An entry is served only while the tenant's expense_version and the
+    fx_version it was computed at are current, so a write by any worker
+    retires it. Writes made in this process are matched precisely
+    (rows_written, rates_written): entries whose period or currencies they
+    miss are vouched for at the new versions, only the others are dropped."""
+
+    def __init__(self, size:int=REPORT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = {}            # tenant -> monotonic time of its last write
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, versions:tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry.expense_version, entry.fx_version) == versions:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.REPORT_CACHE.inc("hit")
+                return entry.text
+            self.misses += 1
+        metrics.REPORT_CACHE.inc("miss")
+        return None
+
+    def put(self, key, entry:CachedReport):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def rows_written(self, tenant:int, stamps, before:int, after:int):
+        """Expense rows dated `stamps` took tenant's expense_version from before to after."""
+        stamps = sorted(stamps)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.tenant != tenant:
+                    continue
+                i = bisect_left(stamps, entry.start)
+                if entry.expense_version == before and not (i < len(stamps) and stamps[i] <= entry.end):
+                    entry.expense_version = after
+                    continue
+                if entry.expense_version == before:
+                    del self._entries[key]
+                # dropped or already stale: due for prewarming once the writes settle
+                self._dirty[tenant] = time.monotonic()
+
+    def rates_written(self, rates:dict, version:int):
+        """New rates took fx_version to `version`."""
+        ts, before = datetime.utcnow().isoformat(), version - len(rates)
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if entry.fx_version != before:
+                    continue
+                hit = entry.ccys.intersection(rates)
+                # a historical report moves only for expenses from now on, or where the rate is the first one
+                if hit and (entry.mode != "historical" or entry.end >= ts or hit & entry.unrated):
+                    del self._entries[key]
+                    self._dirty[entry.tenant] = time.monotonic()
+                else:
+                    entry.fx_version = version
+
+    def quiet(self, secs:float)->list:
+        """Tenants whose cached reports writes retired, the last write at least secs ago."""
+        cutoff = time.monotonic() - secs
+        with self._lock:
+            due = [tenant for tenant, at in self._dirty.items() if at <= cutoff]
+            for tenant in due:
+                del self._dirty[tenant]
+        return due
+
+    def expire_all(self):
+        """Make every tenant with cached reports due for prewarming (a new day)."""
+        with self._lock:
+            self._dirty.update((entry.tenant, 0.0) for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty.clear()
+
+    def stats(self)->dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+report_cache = ReportCache()
+
+def report_text(start: datetime, end: datetime, mode:str=None, tenant:int=DEFAULT_TENANT,
+                open_end:bool=False)->str:
+    """make_report_text() through report_cache.
+
+    open_end: the period runs up to now (parse_period's standard kinds); it
+    is cached for the rest of end's day and written rows retire it."""
+    conn = db.get_conn(ledger_path(tenant))
+    mode = mode or get_report_mode(tenant)
+    versions = (_expense_version(conn, tenant), _fx_version(db.get_conn(DB_PATH)))
+    last = end.date().isoformat() + "T23:59:59.999999" if open_end else end.isoformat()
+    key = (tenant, start.isoformat(), last, mode, get_catalog(tenant).version)
+    text = report_cache.get(key, versions)
+    if text is None:
+        ccys = set()
+        text = make_report_text(start, end, mode, tenant, ccys)
+        rates = rate_cache.snapshot()
+        unrated = {ccy for ccy in ccys if ccy != "USD" and ccy not in rates}
+        report_cache.put(key, CachedReport(text, tenant, start.isoformat(), last, mode, ccys, unrated, *versions))
+    return text
+
+def prewarm_reports(tenant:int):
+    mode = get_report_mode(tenant)
+    for kind in REPORT_PREWARM_PERIODS:
+        start, end = parse_period(kind)
+        report_text(start, end, mode, tenant, True)
+
+async def prewarm_reports_job(context: ContextTypes.DEFAULT_TYPE):
+    for tenant in report_cache.quiet(REPORT_PREWARM_QUIET_SECS):
+        await db.run(prewarm_reports, tenant)
+
+async def midnight_prewarm_job(context: ContextTypes.DEFAULT_TYPE):
+    # yesterday's entries no longer match today's periods
+    report_cache.expire_all()
+    await prewarm_reports_job(context)
+
+# ===================== NET WORTH =====================
+NETWORTH_STEPS = ("month", "week")
+NETWORTH_MAX_POINTS = 160
+NETWORTH_MAX_MONTHS = 120
+_NETWORTH_STEP_ALIASES = {"month": "month", "m": "month", "мес": "month", "месяц": "month", "помесячно": "month",
+                          "week": "week", "w": "week", "нед": "week", "неделя": "week", "понедельно": "week"}
+
+def networth_marks(months:int, step:str="month", now:datetime=None)->list:
+    """Bucket ends, ascending: the starts of the following months (or Mondays) over
+    the last `months` months, the last one replaced by now."""
+    now = now or datetime.utcnow()
+    first = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    for _ in range(months - 1):
+        first = (first - timedelta(days=1)).replace(day=1)
+    marks = []
+    if step == "week":
+        mark = datetime.combine(first.date() + timedelta(days=-first.weekday() % 7), dtime.min)
+        while mark < now:
+            marks.append(mark)
+            mark += timedelta(days=7)
+    else:
+        mark = first
+        while mark < now:
+            mark = (mark + timedelta(days=32)).replace(day=1)
+            marks.append(mark)
+        marks.pop()
+    return marks + [now]
+
+def networth_series(marks, tenant:int=DEFAULT_TENANT):
+    """Tenant's net worth in USD as of each of the ascending datetime marks.
+
+    One sweep: daily_account_deltas since the first mark stream in day order,
+    merged with the rate history of RateTimeline.sweep(), into running
+    per-account balances valued at each mark as it is passed. Opening balances
+    are the current account_balances minus those deltas, so nothing before the
+    first mark is read. Marks other than the last fall on midnight; the last
+    (now) takes every row up to its day. Balances are valued in the account's
+    currency, like /balance. Returns ([(mark, usd)], currencies without a
+    rate, counted as 0)."""
+    account_ccy = get_catalog(tenant).account_ccy
+    rates = get_rate_timeline().sweep([m.isoformat() for m in marks])
+    days = [m.date().isoformat() for m in marks]
+    days[-1] = (marks[-1].date() + timedelta(days=1)).isoformat()
+    # one snapshot: a write between the two reads would shift the opening balances
+    with db.snapshot(ledger_path(tenant)) as conn:
+        deltas = conn.execute("SELECT day, account, amount FROM daily_account_deltas WHERE tenant_id=? AND day >= ? "
+                              "ORDER BY day", (tenant, marks[0].date().isoformat())).fetchall()
+        balances = dict(conn.execute("SELECT account, balance FROM account_balances WHERE tenant_id=?", (tenant,)))
+    for _, acc, amt in deltas:
+        balances[acc] = balances.get(acc, 0.0) - amt
+    points, missing = [], set()
+
+    def value(k):
+        total = 0.0
+        for acc, amt in balances.items():
+            ccy = account_ccy.get(acc)
+            rate = 1.0 if ccy == "USD" else rates[k].get(ccy)
+            if rate is None:
+                if abs(amt) > 1e-12:
+                    missing.add(ccy or acc)
+                continue
+            total += amt * rate
+        points.append((marks[k], total))
+
+    k = 0
+    for day, acc, amt in deltas:
+        while k < len(marks) and day >= days[k]:
+            value(k)
+            k += 1
+        if k == len(marks):
+            break
+        balances[acc] = balances.get(acc, 0.0) + amt
+    while k < len(marks):
+        value(k)
+        k += 1
+    return points, sorted(missing)
+
+def _networth_label(mark:datetime, step:str, last:bool)->str:
+    if last:
+        return mark.strftime("%Y-%m-%d")
+    if step == "week":
+        return (mark - timedelta(days=1)).strftime("%Y-%m-%d")
+    return (mark - timedelta(days=1)).strftime("%Y-%m")
+
+def _networth_change(points)->str:
+    first, last = points[0][1], points[-1][1]
+    change = last - first
+    pct = f" ({change / abs(first) * 100:+.1f}%)" if abs(first) > 1e-9 else ""
+    return f"Изменение: {change:+.2f} USD{pct}"
+
+def networth_text(points, step:str, months:int, missing=())->str:
+    lines = [f"Чистые активы в USD, {'понедельно' if step == 'week' else 'помесячно'} за {months} мес.:"]
+    for i, (mark, usd) in enumerate(points):
+        lines.append(f"• {_networth_label(mark, step, i == len(points) - 1)}: {round(usd, 2)}")
+    lines.append(_networth_change(points))
+    if missing:
+        lines.append(f"Нет курса (учтено как 0): {', '.join(missing)}")
+    return "\n".join(lines)
+
+def _png(width:int, height:int, pixels:bytearray)->bytes:
+    # 8-bit RGB, no filtering
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data))
+    stride = width * 3
+    raw = b"".join(b"\x00" + pixels[y * stride:(y + 1) * stride] for y in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 6)) + chunk(b"IEND", b""))
+
+def render_chart_png(values, width:int=800, height:int=400)->bytes:
+    """Line chart of values as a PNG, drawn here without any plotting library.
+
+    No text: the caption carries the numbers. Grid lines split the value
+    range in quarters; a darker line marks zero when the range crosses it."""
+    bg, grid, axis, line = b"\xff\xff\xff", b"\xe0\xe0\xe0", b"\x90\x90\x90", b"\x1f\x5f\xbf"
+    px = bytearray(bg * (width * height))
+    left, right, top, bottom = 20, width - 20, 20, height - 20
+    lo, hi = min(values), max(values)
+    if hi - lo < 1e-9:
+        lo, hi = lo - 1, hi + 1
+
+    def y_of(v):
+        return round(bottom - (v - lo) / (hi - lo) * (bottom - top))
+
+    def hline(y, color):
+        px[(y * width + left) * 3:(y * width + right + 1) * 3] = color * (right - left + 1)
+
+    def dot(x, y, r, color):
+        for yy in range(max(y - r, 0), min(y + r + 1, height)):
+            x0, x1 = max(x - r, 0), min(x + r + 1, width)
+            px[(yy * width + x0) * 3:(yy * width + x1) * 3] = color * (x1 - x0)
+
+    for q in range(5):
+        hline(round(top + (bottom - top) * q / 4), grid)
+    if lo < 0 < hi:
+        hline(y_of(0), axis)
+    n = len(values)
+    xs = [round(left + (right - left) * i / (n - 1)) if n > 1 else (left + right) // 2 for i in range(n)]
+    ys = [y_of(v) for v in values]
+    for (x0, y0), (x1, y1) in zip(zip(xs, ys), zip(xs[1:], ys[1:])):
+        steps = max(abs(x1 - x0), abs(y1 - y0), 1)
+        for t in range(steps + 1):
+            dot(x0 + (x1 - x0) * t // steps, y0 + (y1 - y0) * t // steps, 1, line)
+    if n <= 60:
+        for x, y in zip(xs, ys):
+            dot(x, y, 3, line)
+    return _png(width, height, px)
+
+NETWORTH_USAGE = ("Формат: /networth [месяцев] [мес|нед] [график]\n"
+                  "Напр.: /networth 12 • /networth 6 нед график")
+
+def _parse_networth_args(args)->tuple:
+    # [N] [month|week] [chart]
+    months, step, chart = 12, "month", False
+    for arg in (a.lower() for a in args):
+        if arg.isdigit():
+            months = int(arg)
+        elif arg in _NETWORTH_STEP_ALIASES:
+            step = _NETWORTH_STEP_ALIASES[arg]
+        elif arg in ("chart", "график", "g"):
+            chart = True
+        else:
+            raise ValueError(arg)
+    if not 1 <= months <= NETWORTH_MAX_MONTHS:
+        raise ValueError(months)
+    return months, step, chart
+
+async def networth_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        months, step, chart = _parse_networth_args(update.message.text.split()[1:])
+    except ValueError:
+        await update.message.reply_text(NETWORTH_USAGE)
+        return
+    marks = networth_marks(months, step)
+    if len(marks) > NETWORTH_MAX_POINTS:
+        await update.message.reply_text("Слишком много точек — сократите период или выберите «мес».")
+        return
+    points, missing = await db.run(networth_series, marks, tenant_of(update))
+    text = networth_text(points, step, months, missing)
+    if not chart:
+        await update.message.reply_text(text)
+        return
+    values = [usd for _, usd in points]
+    caption = "\n".join([text.split("\n", 1)[0],
+                         f"{_networth_label(points[0][0], step, False)} → {_networth_label(points[-1][0], step, True)}",
+                         f"мин {round(min(values), 2)} • макс {round(max(values), 2)} • сейчас {round(values[-1], 2)}",
+                         *text.split("\n")[-1 - bool(missing):]])
+    await update.message.reply_photo(render_chart_png(values), caption=caption)
+
+# ===================== RECONCILE =====================
+async def reconcile_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cat = await tenant_catalog(tenant_of(update))
+    await update.message.reply_text("Выберите кошелёк для сверки:", reply_markup=accounts_keyboard(cat))
+    return REC_ACC
+
+async def _reconcile_repick(send, cat:Catalog, stale:list):
+    if stale:
+        send = _stale_notice(send, stale)
+    await send("Выберите кошелёк для сверки:", reply_markup=accounts_keyboard(cat))
+    return REC_ACC
+
+async def reconcile_pick_acc(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    q = update.callback_query; await q.answer()
+    acc = q.data.split(":",1)[1]
+    context.user_data["rec_acc"] = acc
+    cat = await tenant_catalog(tenant_of(update))
+    stale = _drop_stale_names(context.user_data, cat)
+    if stale:
+        return await _reconcile_repick(q.edit_message_text, cat, stale)
+    await q.edit_message_text(f"Введите конечный остаток в нативной валюте кошелька ({cat.account_ccy[acc]}).")
+    return REC_AMOUNT
+
+async def reconcile_amount(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        amt = float(update.message.text.replace(",", ".").strip())
+    except:
+        await update.message.reply_text("Нужно число.")
+        return REC_AMOUNT
+
+    tenant = tenant_of(update)
+    cat = await tenant_catalog(tenant)
+    stale = _drop_stale_names(context.user_data, cat)
+    if stale or "rec_acc" not in context.user_data:
+        return await _reconcile_repick(update.message.reply_text, cat, stale)
+    acc = context.user_data["rec_acc"]
+    ccy = cat.account_ccy[acc]
+    current = await db.run(get_account_balance, acc, tenant)
+
+    diff = amt - current
+    if abs(diff) < 1e-9:
+        await write_ledger([txn_row(datetime.utcnow().isoformat(), update.message.from_user, "reconcile",
+                                    None, acc, 0.0, ccy, note="confirm ok")], tenant=tenant)
+        await update.message.reply_text("✅ Сальдо подтверждено, корректировка не требуется.")
+    elif diff > 0:
+        await write_ledger([txn_row(datetime.utcnow().isoformat(), update.message.from_user, "reconcile",
+                                    None, acc, diff, ccy, note="reconcile up")], tenant=tenant)
+        await update.message.reply_text(f"✅ Сверка: добавлено {round(diff,8)} {ccy}")
+    else:
+        await write_ledger([txn_row(datetime.utcnow().isoformat(), update.message.from_user, "reconcile",
+                                    None, acc, -abs(diff), ccy, note="reconcile down (as expense)")], tenant=tenant)
+        await update.message.reply_text(f"✅ Сверка: списано {round(abs(diff),8)} {ccy}")
+    context.user_data.clear()
+    return ConversationHandler.END
+
+# ===================== IMPORT =====================
+# Rows per parse/insert step: one chunk in memory, one writer transaction each.
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "20000"))
+IMPORT_PROGRESS_SECS = 2.0
+IMPORT_MAX_BYTES = 20 * 1024 * 1024   # getFile limit of the Bot API
+
+# header (lowercased) -> field; the first matching column wins
+IMPORT_COLUMNS = {
+    "ts": ("date", "datetime", "ts", "дата", "дата операции"),
+    "amount": ("amount", "sum", "сумма", "сумма операции"),
+    "currency": ("currency", "ccy", "валюта"),
+    "account": ("account", "wallet", "счёт", "счет", "кошелёк", "кошелек"),
+    "category": ("category", "категория"),
+    "type": ("type", "тип"),
+    "note": ("note", "description", "comment", "описание", "комментарий", "назначение"),
+}
+IMPORT_TYPES = {
+    "expense": "expense", "расход": "expense",
+    "income": "income", "доход": "income",
+    "exchange_in": "exchange_in", "exchange_out": "exchange_out",
+    "reconcile": "reconcile", "сверка": "reconcile",
+}
+
+# DD.MM.YYYY[ HH:MM[:SS]] (also with "/"), the usual bank export format
+_DMY_TS = re.compile(r"(\d{1,2})[./](\d{1,2})[./](\d{4})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?")
+
+@functools.lru_cache(maxsize=4096)
+def _parse_statement_ts(value:str)->str:
+    # no strptime: it dominates parsing on large files
+    try:
+        return datetime.fromisoformat(value).isoformat()
+    except ValueError:
+        pass
+    m = _DMY_TS.fullmatch(value)
+    if m:
+        d, mo, y, h, mi, sec = (int(g or 0) for g in m.groups())
+        try:
+            return datetime(y, mo, d, h, mi, sec).isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"дата {value!r}")
+
+def _parse_statement_amount(value:str)->float:
+    try:
+        return float(value.replace("\xa0", "").replace(" ", "").replace(",", "."))
+    except ValueError:
+        raise ValueError(f"сумма {value!r}") from None
+
+def _statement_encoding(path:str)->str:
+    with open(path, "rb") as f:
+        head = f.read(64 * 1024)
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(head)
+        return "utf-8-sig"
+    except UnicodeDecodeError:
+        return "cp1251"   # typical for Russian bank exports
+
+class StatementReader:
+    """CSV statement parsed into txn_row() + (import_hash,) rows, one chunk at a time.
+
+    Accounts and categories are matched against the tenant's catalog.
+
+    The hash covers the row's content plus how many identical rows came
+    before it that day, so two equal lines in a statement both import while a
+    re-imported statement adds nothing. The counts span the whole file, so
+    a day's rows need not be contiguous."""
+
+    def __init__(self, path:str, user=None, account:str=None, catalog:Catalog=DEFAULT_CATALOG,
+                 closed_before:str=None):
+        self.user, self.account, self.catalog = user, account, catalog
+        self.closed_before = closed_before     # archived years take no new rows
+        self._file = open(path, newline="", encoding=_statement_encoding(path))
+        try:
+            sample = self._file.read(64 * 1024)
+            self._file.seek(0)
+            try:
+                dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+            except csv.Error:
+                dialect = csv.excel
+            self._records = csv.reader(self._file, dialect)
+            header = [h.strip().casefold() for h in next(self._records, [])]
+            self._cols = {}
+            for field, names in IMPORT_COLUMNS.items():
+                idx = next((header.index(n) for n in names if n in header), None)
+                if idx is not None:
+                    self._cols[field] = idx
+            self._idx = [self._cols.get(f) for f in IMPORT_COLUMNS]
+            missing = [f for f in ("ts", "amount") if f not in self._cols]
+            if missing or ("account" not in self._cols and not account):
+                raise ValueError("Нужны колонки «дата» и «сумма», и «счёт» (или укажите его: /import <счёт>).")
+        except Exception:
+            self._file.close()
+            raise
+        self.done = False
+        self.rows = 0
+        self.bad = 0
+        self.errors = []        # first few "line: reason"
+        self._seen = {}         # key digest -> identical rows so far; the key includes the day
+        self._accounts = {}     # raw cell -> account, statements repeat a handful of names
+
+    def _row(self, record)->tuple:
+        n = len(record)
+        ts, amount, currency, account, category, kind, note = (
+            record[i].strip() if i is not None and i < n else "" for i in self._idx)
+        ts = _parse_statement_ts(ts)
+        if self.closed_before and ts < self.closed_before:
+            raise ValueError(f"{ts[:4]} год в архиве")
+        amount = _parse_statement_amount(amount)
+        if account:
+            account = self._accounts.get(account) or self._accounts.setdefault(account, self.catalog.match_account(account))
+        else:
+            account = self.account
+        if account is None:
+            raise ValueError("нет счёта")
+        ttype = IMPORT_TYPES.get(kind.casefold()) if kind else ("expense" if amount < 0 else "income")
+        if ttype is None:
+            raise ValueError(f"тип {kind!r}")
+        if ttype != "reconcile":
+            amount = abs(amount)
+        currency = (currency or self.catalog.account_ccy[account]).upper()
+        if not self.catalog.knows("currency", currency):
+            raise ValueError(f"валюта {currency!r}")
+        if ttype == "expense":
+            category = self.catalog.match("category", category) if self.catalog.knows("category", category) else "прочее"
+        else:
+            category = None
+        note = note or None
+
+        key = "\x1f".join((ts, ttype, account, repr(amount), currency, category or "", note or "")).encode()
+        # counted by a short digest: the map holds every distinct row of the file
+        seen = hashlib.blake2b(key, digest_size=12).digest()
+        n = self._seen[seen] = self._seen.get(seen, -1) + 1
+        digest = hashlib.blake2b(key + f"\x1f{n}".encode(), digest_size=16).digest()
+        return txn_row(ts, self.user, ttype, category, account, amount, currency, note) + (digest,)
+
+    def read_chunk(self, size:int=IMPORT_CHUNK)->list:
+        out = []
+        while len(out) < size:
+            record = next(self._records, None)
+            if record is None:
+                self.done = True
+                break
+            if not any(field.strip() for field in record):
+                continue
+            try:
+                out.append(self._row(record))
+            except ValueError as e:
+                self.bad += 1
+                if len(self.errors) < 5:
+                    self.errors.append(f"{self._records.line_num}: {e}")
+        self.rows += len(out)
+        return out
+
+    def close(self):
+        self._file.close()
+
+def _import_rows(conn, rows, tenant:int=DEFAULT_TENANT)->tuple:
+    # balances and daily rollup follow through the insert triggers; duplicates insert nothing.
+    # Returns (rows inserted, (expense_version before, after)).
+    before = _expense_version(conn, tenant)
+    cur = conn.executemany("""
+    INSERT INTO transactions(tenant_id,ts,user_id,username,type,category,account,amount,currency,note,import_hash)
+    VALUES(?,?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(tenant_id,import_hash) WHERE import_hash IS NOT NULL DO NOTHING
+    """, ((tenant,) + row for row in rows))
+    return cur.rowcount, (before, _expense_version(conn, tenant))
+
+async def import_statement(path:str, user=None, account:str=None, progress=None,
+                           tenant:int=DEFAULT_TENANT)->dict:
+    """Stream a CSV statement into the ledger; progress(stats) is awaited every few seconds.
+
+    Chunks commit as they go, so an interrupted import keeps what it loaded
+    and running it again fills in only the rest."""
+    ledger = await open_ledger(tenant)
+    closed_before = await db.run(ledger_hot_start, ledger)
+    reader = await db.run(StatementReader, path, user, account, await tenant_catalog(tenant), closed_before)
+    inserted, last = 0, asyncio.get_running_loop().time()
+    try:
+        rows = await db.run(reader.read_chunk)
+        while True:
+            # parse the next chunk while the writer commits this one
+            written = asyncio.ensure_future(db.write(ledger, _import_rows, rows, tenant, alone=True)) if rows else None
+            chunk = rows
+            try:
+                rows = None if reader.done else await db.run(reader.read_chunk)
+            finally:
+                if written is not None:
+                    n, expenses = await written
+                    inserted += n
+                    # duplicates are in the list too: a superset only drops more cached reports
+                    report_cache.rows_written(tenant, [row[0] for row in chunk if row[3] == "expense"], *expenses)
+            if rows is None:
+                break
+            now = asyncio.get_running_loop().time()
+            if progress and now - last >= IMPORT_PROGRESS_SECS:
+                last = now
+                await progress({"rows": reader.rows, "inserted": inserted})
+    finally:
+        reader.close()
+    return {"rows": reader.rows, "inserted": inserted, "duplicates": reader.rows - inserted,
+            "bad": reader.bad, "errors": reader.errors}
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) == 2:
+        cat = await tenant_catalog(tenant_of(update))
+        try:
+            context.user_data["imp_acc"] = cat.match_account(parts[1])
+        except ValueError as e:
+            await update.message.reply_text(f"Ошибка: {e}. Счета: {', '.join(cat.accounts)}")
+            return ConversationHandler.END
+    await update.message.reply_text(
+        "Пришлите выписку CSV файлом.\n"
+        "Колонки: дата, сумма, и по желанию валюта, счёт, категория, тип (расход/доход), описание.\n"
+        "Без колонки «счёт» укажите его в команде: /import USD (нал). "
+        "Отрицательная сумма без типа — расход, положительная — доход."
+    )
+    return IMP_FILE
+
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    msg = update.message
+    account = context.user_data.get("imp_acc")
+    context.user_data.clear()
+    caption = (msg.caption or "").split(maxsplit=1)
+    try:
+        if len(caption) == 2 and caption[0].startswith("/import"):
+            account = (await tenant_catalog(tenant_of(update))).match_account(caption[1])
+    except ValueError as e:
+        await msg.reply_text(f"Ошибка: {e}")
+        return ConversationHandler.END
+    if msg.document.file_size and msg.document.file_size > IMPORT_MAX_BYTES:
+        await msg.reply_text("Файл больше 20 МБ — разбейте выписку на части.")
+        return ConversationHandler.END
+
+    status = await msg.reply_text("⏳ Загружаю выписку…")
+
+    async def progress(stats):
+        await status.edit_text(f"⏳ Импорт: прочитано {stats['rows']} строк, добавлено {stats['inserted']}…")
+
+    with tempfile.TemporaryDirectory(prefix="import_") as tmp:
+        path = os.path.join(tmp, "statement.csv")
+        try:
+            await (await msg.document.get_file()).download_to_drive(path)
+            stats = await import_statement(path, msg.from_user, account, progress, tenant_of(update))
+        except (ValueError, UnicodeDecodeError, csv.Error) as e:
+            await status.edit_text(f"Импорт остановлен: {e}\nЗагруженное сохранено; повторный импорт добавит только недостающее.")
+            return ConversationHandler.END
+        except Exception:
+            # the status must not stay at "⏳" forever
+            log.exception("statement import failed")
+            await status.edit_text("Импорт прервался из-за внутренней ошибки.\n"
+                                   "Загруженное сохранено; повторный импорт добавит только недостающее.")
+            return ConversationHandler.END
+    lines = [f"✅ Импорт: {stats['rows']} строк, добавлено {stats['inserted']}, уже были {stats['duplicates']}."]
+    if stats["bad"]:
+        lines.append(f"Пропущено с ошибками: {stats['bad']}")
+        lines += [f"• строка {e}" for e in stats["errors"]]
+    await status.edit_text("\n".join(lines))
+    return ConversationHandler.END
+
+# ===================== EXPORT =====================
+# Rows per fetchmany(); only this many are in memory at once.
+EXPORT_FETCH = 5000
+EXPORT_GZIP_LEVEL = 6
+EXPORT_MAX_BYTES = 50 * 1024 * 1024   # sendDocument limit of the Bot API
+EXPORT_FORMATS = ("csv", "jsonl")
+EXPORT_COLUMNS = ("id", "ts", "user_id", "username", "type", "category", "account", "amount", "currency", "note")
+
+def export_ledger(path:str, day_from:str=None, day_to:str=None, account:str=None, fmt:str="csv",
+                  tenant:int=DEFAULT_TENANT)->int:
+    """Write tenant's transactions (optionally a day range / one account) to a gzip file; returns the row count.
+
+    Rows stream from the cursor in id order, so nothing is sorted or held in
+    memory; the read runs in autocommit under WAL and never blocks writers.
+    Archived years are read from their archive files, oldest first."""
+    where, params = ["tenant_id = ?"], [tenant]
+    if day_from and day_to:
+        # "~" sorts after any time suffix, so this covers every ts on day_to
+        where.append("ts >= ? AND ts < ?")
+        params += [day_from, day_to + "~"]
+    if account:
+        where.append("account = ?")
+        params.append(account)
+    # carry-forward rows only stand in for archived ones, which are exported themselves
+    where.append("carry_year IS NULL")
+    conn = db.get_conn(ledger_path(tenant))
+    n = 0
+    with gzip.open(path, "wt", encoding="utf-8", newline="", compresslevel=EXPORT_GZIP_LEVEL) as f:
+        if fmt == "csv":
+            out = csv.writer(f)
+            out.writerow(EXPORT_COLUMNS)
+        # oldest archive first, attached one at a time
+        archives = _archives_between(conn, day_from, day_to and day_to + "~")
+        for schema in [*archives, "main"]:
+            if schema != "main":
+                schema = attach_archive(conn, *schema)
+            # NOT INDEXED: a rowid-order scan; through a tenant index SQLite would sort every row
+            sql = (f"SELECT {','.join(EXPORT_COLUMNS)} FROM {schema}.transactions NOT INDEXED WHERE "
+                   + " AND ".join(where))
+            cur = conn.execute(sql + " ORDER BY id", params)
+            try:
+                while True:
+                    rows = cur.fetchmany(EXPORT_FETCH)
+                    if not rows:
+                        break
+                    if fmt == "csv":
+                        out.writerows(rows)
+                    else:
+                        f.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n"
+                                     for row in rows)
+                    n += len(rows)
+            finally:
+                cur.close()
+    return n
+
+def _parse_export_args(args, cat:Catalog=DEFAULT_CATALOG)->tuple:
+    # [YYYY-MM-DD YYYY-MM-DD] [счёт] [csv|jsonl]
+    args = list(args)
+    fmt = args.pop().lower() if args and args[-1].lower() in EXPORT_FORMATS else "csv"
+    day_from = day_to = None
+    if len(args) >= 2 and re.fullmatch(r"\d{4}-\d{2}-\d{2}", args[0]):
+        day_from, day_to = date.fromisoformat(args[0]).isoformat(), date.fromisoformat(args[1]).isoformat()
+        args = args[2:]
+    account = cat.match_account(" ".join(args)) if args else None
+    return day_from, day_to, account, fmt
+
+async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = tenant_of(update)
+    try:
+        day_from, day_to, account, fmt = _parse_export_args(update.message.text.split()[1:],
+                                                            await tenant_catalog(tenant))
+    except ValueError:
+        await update.message.reply_text(
+            "Формат: /export [YYYY-MM-DD YYYY-MM-DD] [счёт] [csv|jsonl]\n"
+            "Напр.: /export 2025-01-01 2025-12-31 USD (нал) jsonl"
+        )
+        return
+    status = await update.message.reply_text("⏳ Готовлю выгрузку…")
+    name = "ledger" + (f"_{day_from}_{day_to}" if day_from else "") + f".{fmt}.gz"
+    with tempfile.TemporaryDirectory(prefix="export_") as tmp:
+        path = os.path.join(tmp, name)
+        n = await db.run(export_ledger, path, day_from, day_to, account, fmt, tenant)
+        if os.path.getsize(path) > EXPORT_MAX_BYTES:
+            await status.edit_text("Выгрузка больше 50 МБ — сузьте период или выберите счёт.")
+            return
+        with open(path, "rb") as f:
+            await update.message.reply_document(f, filename=name,
+                                                caption=f"Операций: {n}" + (f" • {account}" if account else ""))
+    await status.delete()
+
+# ===================== ARCHIVE =====================
+# Closed years move out of the ledger into one file per year under
+# ARCHIVE_DIR once they ended more than ARCHIVE_AFTER_DAYS ago (0 keeps
+# everything in the ledger). Daily rollups and account deltas of archived
+# days stay in the ledger and a carry-forward row per account opens the next
+# year, so balances, /networth and whole-day report ranges never read an
+# archive; partial report days and /export attach the years they reach.
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "730"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+# SQLite attaches at most 10 databases to one connection
+ARCHIVE_MAX_ATTACHED = 8
+# VACUUM after maintenance once this share of the ledger file is free pages
+VACUUM_FREE_RATIO = 0.2
+# weekly maintenance, local time: Sunday (date.weekday() 6)
+MAINTENANCE_WEEKDAY = 6
+MAINTENANCE_TIME = dtime(3, 30)
+# workers sharing DB_PATH skip a run another one claimed this recently
+MAINTENANCE_CLAIM = timedelta(hours=1)
+ARCHIVE_NOTE = "остаток на начало года, {year} в архиве"
+
+def _archive_path(path:str, year:int)->str:
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(ARCHIVE_DIR, f"{stem}_{year}.db")
+
+def _archived_years(conn)->list:
+    # [(year, path)] ascending; the table is missing until its migration ran
+    if not conn.execute("SELECT 1 FROM main.sqlite_master WHERE type='table' AND name='archives'").fetchone():
+        return []
+    return conn.execute("SELECT year, path FROM main.archives ORDER BY year").fetchall()
+
+def hot_start(conn)->str:
+    """First day kept in the ledger itself ("YYYY-01-01"), None while nothing is archived."""
+    years = _archived_years(conn)
+    return f"{years[-1][0] + 1:04d}-01-01" if years else None
+
+def ledger_hot_start(path:str)->str:
+    return hot_start(db.get_conn(path))
+
+def _archives_between(conn, ts_from:str=None, ts_to:str=None)->list:
+    # archived (year, path) overlapping [ts_from, ts_to]; a missing bound is open
+    return [(year, path) for year, path in _archived_years(conn)
+            if (not ts_from or int(ts_from[:4]) <= year) and (not ts_to or year <= int(ts_to[:4]))]
+
+def attach_archive(conn, year:int, path:str, keep=())->str:
+    """Attach year's archive to conn as "arc_<year>" unless it already is; returns the schema name.
+
+    With ARCHIVE_MAX_ATTACHED already attached, the ones not in keep are
+    detached first."""
+    schema = f"arc_{year}"
+    attached = [name for _, name, _ in conn.execute("PRAGMA database_list") if name.startswith("arc_")]
+    if schema in attached:
+        return schema
+    if len(attached) >= ARCHIVE_MAX_ATTACHED:
+        for name in attached:
+            if name not in keep:
+                try:
+                    conn.execute(f"DETACH DATABASE {name}")
+                except sqlite3.OperationalError:
+                    pass    # still read by an open statement
+    conn.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+    return schema
+
+def ledger_schemas(conn, ts_from:str, ts_to:str)->list:
+    """Schemas whose transactions cover [ts_from, ts_to], oldest first: the
+    archives it reaches, attached to conn, then "main"."""
+    schemas = []
+    for year, path in _archives_between(conn, ts_from, ts_to):
+        schemas.append(attach_archive(conn, year, path, keep=schemas))
+    return schemas + ["main"]
+
+def _copy_year(conn, year:int, ledger:str)->int:
+    # phase 1, on the archive file: (re)copy the year's rows from the ledger; returns the count
+    lo, hi = f"{year:04d}-01-01", f"{year + 1:04d}-01-01"
+    conn.execute("ATTACH DATABASE ? AS hot", (ledger,))
+    try:
+        # deferred: only the archive is written, the ledger is just read
+        conn.execute("BEGIN")
+        try:
+            if not conn.execute("SELECT 1 FROM main.sqlite_master WHERE name='transactions'").fetchone():
+                # the ledger's own definition keeps id as the rowid, so exports stream in id order
+                conn.execute(conn.execute("SELECT sql FROM hot.sqlite_master WHERE type='table' "
+                                          "AND name='transactions'").fetchone()[0])
+                conn.execute("CREATE INDEX idx_txn_type_ts ON transactions(tenant_id, type, ts, category, "
+                             "currency, amount)")
+            conn.execute("DELETE FROM main.transactions")
+            n = conn.execute("INSERT INTO main.transactions SELECT * FROM hot.transactions "
+                             "WHERE ts >= ? AND ts < ? ORDER BY id", (lo, hi)).rowcount
+            conn.execute("ANALYZE main")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.execute("DETACH DATABASE hot")
+    return n
+
+def _move_year(conn, year:int, path:str, copied:int)->int:
+    # phase 2, one ledger transaction: swap the copied rows for carry-forward rows
+    lo, hi = f"{year:04d}-01-01", f"{year + 1:04d}-01-01"
+    n = conn.execute("SELECT COUNT(*) FROM transactions WHERE ts >= ? AND ts < ?", (lo, hi)).fetchone()[0]
+    if n != copied:
+        raise RuntimeError(f"{year}: {n} rows in the ledger, {copied} in the archive copy")
+    # derived tables keep their archived days and balances do not change,
+    # so their triggers stay out of the swap
+    triggers = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='trigger' "
+                            "AND tbl_name='transactions'").fetchall()
+    for name, _ in triggers:
+        conn.execute(f"DROP TRIGGER {name}")
+    conn.execute(f"""
+    INSERT INTO transactions(ts,username,type,account,amount,currency,note,tenant_id,carry_year)
+    SELECT ?, 'archive', 'reconcile', account, SUM({_signed_amount()}), currency, ?, tenant_id, ?
+    FROM transactions WHERE ts >= ? AND ts < ?
+    GROUP BY tenant_id, account, currency
+    HAVING ABS(SUM({_signed_amount()})) > 1e-12
+    """, (hi + "T00:00:00", ARCHIVE_NOTE.format(year=year), year, lo, hi))
+    conn.execute("DELETE FROM transactions WHERE ts >= ? AND ts < ?", (lo, hi))
+    conn.execute("INSERT INTO archives(year,path,rows,archived_at) VALUES(?,?,?,?)",
+                 (year, path, n, datetime.utcnow().isoformat()))
+    for _, sql in triggers:
+        conn.execute(sql)
+    return n
+
+def archive_year(path:str, year:int)->int:
+    """Move `year`'s transactions from the ledger at path to their archive file; returns the rows moved.
+
+    The copy commits to the archive before the ledger changes, and the ledger
+    swaps the rows for carry-forward rows in one transaction on its writer, so
+    a crash leaves every row in the ledger, where the next run copies it again."""
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    archive = _archive_path(path, year)
+    copied = _copy_year(db.get_conn(archive), year, path)
+    return db.write_queue(path).submit(path, _move_year, year, archive, copied, alone=True).result()
+
+def _analyze(conn):
+    conn.execute("ANALYZE")
+
+def maintain_ledger(path:str, now:datetime=None)->dict:
+    """Archive the ledger's closed years, refresh planner statistics and VACUUM
+    when enough of the file is free; returns {"archived": {year: rows}, "vacuumed": bool}."""
+    now = now or datetime.utcnow()
+    db.migrate(path, MIGRATIONS)
+    conn = db.get_conn(path)
+    archived = {}
+    if ARCHIVE_AFTER_DAYS > 0:
+        closed = f"{(now - timedelta(days=ARCHIVE_AFTER_DAYS)).year:04d}-01-01"
+        years = [int(y) for (y,) in conn.execute(
+            "SELECT DISTINCT substr(ts,1,4) FROM transactions WHERE ts < ? AND carry_year IS NULL ORDER BY 1",
+            (closed,))]
+        for year in years:
+            archived[year] = archive_year(path, year)
+    db.write_queue(path).submit(path, _analyze, alone=True).result()
+    pages, free = (conn.execute(f"PRAGMA {name}").fetchone()[0] for name in ("page_count", "freelist_count"))
+    vacuumed = bool(pages) and free / pages >= VACUUM_FREE_RATIO
+    if vacuumed:
+        # writers wait on busy_timeout meanwhile; the job runs in the quiet hours
+        conn.execute("VACUUM")
+    return {"archived": archived, "vacuumed": vacuumed}
+
+def _ledger_files()->list:
+    paths = [DB_PATH]
+    if STORAGE_MODE == "sharded" and os.path.isdir(SHARD_DIR):
+        paths += sorted(os.path.join(SHARD_DIR, name) for name in os.listdir(SHARD_DIR)
+                        if re.fullmatch(r"tenant_-?\d+\.db", name))
+    return paths
+
+def maintain_ledgers(now:datetime=None)->dict:
+    """maintain_ledger() over DB_PATH and every shard; {path: result}.
+
+    A failing file is logged and the rest still run; its result carries the
+    error under "error" and archives nothing."""
+    results = {}
+    for path in _ledger_files():
+        try:
+            results[path] = maintain_ledger(path, now)
+        except Exception as e:
+            log.exception("ledger maintenance failed for %s", path)
+            results[path] = {"archived": {}, "vacuumed": False, "error": f"{type(e).__name__}: {e}"}
+    return results
+
+def _claim_maintenance(now:datetime)->bool:
+    # several workers schedule the job; the first to move maintenance_at runs it
+    with db.transaction(DB_PATH) as conn:
+        row = conn.execute("SELECT value FROM settings WHERE key='maintenance_at'").fetchone()
+        if row and now - datetime.fromisoformat(row[0]) < MAINTENANCE_CLAIM:
+            return False
+        conn.execute("INSERT INTO settings(key,value) VALUES('maintenance_at',?) "
+                     "ON CONFLICT(key) DO UPDATE SET value=excluded.value", (now.isoformat(),))
+    return True
+
+def scheduled_maintenance()->dict:
+    now = datetime.utcnow()
+    return maintain_ledgers(now) if _claim_maintenance(now) else None
+
+async def maintenance_job(context: ContextTypes.DEFAULT_TYPE):
+    if date.today().weekday() != MAINTENANCE_WEEKDAY:
+        return
+    results = await db.run(scheduled_maintenance)
+    for path, result in (results or {}).items():
+        if result.get("error"):
+            continue
+        log.info("ledger maintenance %s: archived %s, vacuumed %s", path, result["archived"] or "nothing",
+                 result["vacuumed"])
+
+def archive_status(tenant:int)->list:
+    return db.get_conn(ledger_path(tenant)).execute("SELECT year, archived_at FROM archives ORDER BY year").fetchall()
+
+def _archive_text(years)->str:
+    lines = ["Архив по годам:"] + [f"• {year} — перенесён {archived_at[:10]}" for year, archived_at in years]
+    if not years:
+        lines = ["В архиве пока ничего нет."]
+    if ARCHIVE_AFTER_DAYS > 0:
+        lines.append(f"Год уходит в архив через {ARCHIVE_AFTER_DAYS} дн. после окончания; "
+                     f"остатки переносятся на начало следующего года.")
+    else:
+        lines.append("Автоматическая архивация выключена (ARCHIVE_AFTER_DAYS=0).")
+    return "\n".join(lines)
+
+async def archive_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    args = context.args or []
+    if not args:
+        await update.message.reply_text(_archive_text(await db.run(archive_status, tenant_of(update))))
+        return
+    if args[0].lower() not in ("now", "сейчас"):
+        await update.message.reply_text("Формат: /archive – что в архиве; /archive now – архивировать сейчас")
+        return
+    # every tenant's ledger, and a VACUUM: never open to chat members, even without ADMIN_IDS
+    if getattr(update.effective_user, "id", None) not in ADMIN_IDS:
+        await update.message.reply_text("Запускать архивацию могут только администраторы бота (ADMIN_IDS).")
+        return
+    if ARCHIVE_AFTER_DAYS <= 0:
+        await update.message.reply_text("Архивация выключена (ARCHIVE_AFTER_DAYS=0).")
+        return
+    status = await update.message.reply_text("⏳ Переношу закрытые годы в архив…")
+    results = await db.run(maintain_ledgers)
+    moved = {}
+    for result in results.values():
+        for year, rows in result["archived"].items():
+            moved[year] = moved.get(year, 0) + rows
+    failed = [(path, result["error"]) for path, result in results.items() if result.get("error")]
+    if moved:
+        lines = ["✅ В архиве: " + ", ".join(f"{year} ({rows} опер.)" for year, rows in sorted(moved.items()))]
+    elif not failed:
+        lines = ["Закрытых лет для архива нет."]
+    else:
+        lines = []
+    if failed:
+        lines.append(f"⚠️ Не удалось обработать файлов: {len(failed)} (подробности в логе)")
+        lines += [f"• {path}: {error}" for path, error in failed[:10]]
+    await status.edit_text("\n".join(lines))
+
+# ===================== PTB APP BUILD =====================
+def make_app(update_queue: asyncio.Queue = None, max_pending:int=0):
+    # Handlers await DB work on db.executor(); process updates concurrently so a
+    # slow /report in one chat does not queue every other chat behind it (one
+    # chat's own updates still run in order).
+    # Conversation state and user_data live in SQLite, not in worker memory, so
+    # every step of a flow may be served by a different worker.
+    store = SQLitePersistence(DB_PATH)
+    builder = (ApplicationBuilder().token(require_token())
+               .base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+               .concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES, max_pending))
+               .persistence(store))
+    if update_queue is not None:
+        builder = builder.update_queue(update_queue)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start_cmd))
+    app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("setrate", setrate))
+    app.add_handler(CommandHandler("balance", balance))
+    app.add_handler(CommandHandler("networth", networth_cmd))
+    app.add_handler(CommandHandler("checkbalances", check_balances))
+    app.add_handler(CommandHandler("reportmode", report_mode_cmd))
+    app.add_handler(CommandHandler("backfillrollup", backfill_rollup_cmd))
+    app.add_handler(CommandHandler("export", export_cmd))
+    app.add_handler(CommandHandler("catalog", catalog_cmd))
+    app.add_handler(CommandHandler("archive", archive_cmd))
+
+    exp_conv = SharedConversationHandler(
+        name="expense", persistence=store,
+        entry_points=[CommandHandler("expense", expense_start), CommandHandler("e", quick_expense)],
+        states={
+            EXP_CAT: [CallbackQueryHandler(expense_pick_cat, pattern=r"^cat:")],
+            EXP_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, expense_amount)],
+            EXP_CCY: [CallbackQueryHandler(expense_pick_ccy, pattern=r"^ccy:")],
+            EXP_ACC: [CallbackQueryHandler(expense_pick_acc, pattern=r"^acc:")],
+        },
+        fallbacks=[CallbackQueryHandler(keyboard_page, pattern=PAGE_PATTERN)],
+        per_message=False,
+    )
+    app.add_handler(exp_conv)
+
+    inc_conv = SharedConversationHandler(
+        name="income", persistence=store,
+        entry_points=[CommandHandler("income", income_start), CommandHandler("i", quick_income)],
+        states={
+            INC_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, income_amount)],
+            INC_CCY: [CallbackQueryHandler(income_pick_ccy, pattern=r"^ccy:")],
+            INC_ACC: [CallbackQueryHandler(income_pick_acc, pattern=r"^acc:")],
+        },
+        fallbacks=[CallbackQueryHandler(keyboard_page, pattern=PAGE_PATTERN)],
+        per_message=False,
+    )
+    app.add_handler(inc_conv)
+
+    ex_conv = SharedConversationHandler(
+        name="exchange", persistence=store,
+        entry_points=[CommandHandler("exchange", exchange_start), CommandHandler("x", quick_exchange)],
+        states={
+            EX_FROM_ACC: [CallbackQueryHandler(ex_pick_from, pattern=r"^acc:")],
+            EX_TO_ACC: [CallbackQueryHandler(ex_pick_to, pattern=r"^acc:")],
+            EX_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, ex_amount)],
+            EX_RATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ex_rate)],
+        },
+        fallbacks=[CallbackQueryHandler(keyboard_page, pattern=PAGE_PATTERN)],
+        per_message=False,
+    )
+    app.add_handler(ex_conv)
+
+    rep_conv = SharedConversationHandler(
+        name="report", persistence=store,
+        entry_points=[CommandHandler("report", report_start)],
+        states={
+            REP_PERIOD: [CallbackQueryHandler(report_period, pattern=r"^period:")],
+            REP_CUSTOM_FROM: [MessageHandler(filters.TEXT & ~filters.COMMAND, report_custom)],
+        },
+        fallbacks=[],
+        per_message=False,
+    )
+    app.add_handler(rep_conv)
+
+    rec_conv = SharedConversationHandler(
+        name="reconcile", persistence=store,
+        entry_points=[CommandHandler("reconcile", reconcile_start)],
+        states={
+            REC_ACC: [CallbackQueryHandler(reconcile_pick_acc, pattern=r"^acc:")],
+            REC_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, reconcile_amount)],
+        },
+        fallbacks=[CallbackQueryHandler(keyboard_page, pattern=PAGE_PATTERN)],
+        per_message=False,
+    )
+    app.add_handler(rec_conv)
+
+    imp_conv = SharedConversationHandler(
+        name="import", persistence=store,
+        entry_points=[
+            CommandHandler("import", import_start),
+            MessageHandler(filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), import_file),
+        ],
+        states={
+            IMP_FILE: [MessageHandler(filters.Document.ALL, import_file)],
+        },
+        fallbacks=[],
+        per_message=False,
+    )
+    app.add_handler(imp_conv)
+    # reads the conversations' stored states before they are matched
+    app.add_handler(ConversationPrefetch(store), group=-1)
+
+    # JobQueue needs the job-queue extra; without it reports are cached but never
+    # pre-warmed, closed years are archived only through /archive now and FX
+    # rates refresh only when /balance finds them due
+    if app.job_queue is not None:
+        app.job_queue.run_repeating(prewarm_reports_job, interval=REPORT_PREWARM_QUIET_SECS,
+                                    first=REPORT_PREWARM_QUIET_SECS, name="report-prewarm")
+        app.job_queue.run_daily(midnight_prewarm_job, time=dtime(0, 1, tzinfo=datetime.now().astimezone().tzinfo),
+                                name="report-prewarm-midnight")
+        if FX_PROVIDER:
+            app.job_queue.run_repeating(refresh_rates_job, interval=FX_REFRESH_SECS, first=1, name="fx-refresh")
+        app.job_queue.run_daily(maintenance_job, time=MAINTENANCE_TIME.replace(tzinfo=datetime.now().astimezone().tzinfo),
+                                name="ledger-maintenance")
+
+    # latency/error metrics for every handler above, served on /metrics
+    metrics.instrument_app(app)
+    metrics.Gauge("bot_update_queue_depth", "Updates waiting in the PTB update queue.", app.update_queue.qsize)
+    metrics.Gauge("bot_updates_in_flight", "Updates admitted by the webhook and not processed yet.",
+                  lambda: app.update_processor.pending)
+    return app
+
+# ===================== RUNTIME =====================
+# Importing this module starts nothing. The PTB Application, its event loop
+# and the DB migrations come up in the process that serves updates, after any
+# fork (gunicorn --preload imports once in the master), and Flask is only
+# imported by create_app(); asgi.py runs the same start_runtime() on its own loop.
+application = None      # this process's PTB Application, see get_application()
+loop = None             # the loop PTB runs on in the WSGI deployment
+startup_error = None    # why start-up failed, reported on /ready
+startup_seconds = {}    # phase -> seconds: import, db, ptb, ready (since import, or the fork)
+_process_started = IMPORT_STARTED
+_runtime_lock = threading.RLock()
+# pauses between start-up attempts in the WSGI deployment; the last one repeats
+STARTUP_RETRY_SECS = (1, 2, 5, 15, 30, 60)
+# update_id уже принятых апдейтов: повторная доставка Telegram отбрасывается до разбора
+update_dedupe = UpdateDedupe(DB_PATH)
+
+def _startup_phase(phase:str, started:float):
+    elapsed = time.perf_counter() - started
+    startup_seconds[phase] = round(elapsed, 4)
+    metrics.STARTUP_SECONDS.observe(phase, elapsed)
+
+_startup_phase("import", IMPORT_STARTED)
+
+def _after_fork():
+    # the child has no loop thread: everything PTB-side is rebuilt there
+    global application, loop, startup_error, _runtime_lock, _process_started
+    application = loop = startup_error = None
+    _runtime_lock = threading.RLock()
+    _process_started = time.perf_counter()
+
+os.register_at_fork(after_in_child=_after_fork)
+
+async def start_runtime(app)->list:
+    """Migrate DB_PATH, load seen update ids and start app on the running loop.
+
+    Returns the background tasks to cancel on shutdown."""
+    t = time.perf_counter()
+    await db.run(init_db)
+    _startup_phase("db", t)
+    t = time.perf_counter()
+    rate_refresher.provider = make_rate_provider()
+    await update_dedupe.load()
+    await app.initialize()
+    await app.start()
+    _startup_phase("ptb", t)
+    _startup_phase("ready", _process_started)
+    running = asyncio.get_running_loop()
+    return [running.create_task(metrics.monitor_loop_lag()), running.create_task(update_dedupe.run())]
+
+async def stop_runtime(app, tasks=()):
+    for task in tasks:
+        task.cancel()
+    if app.running:
+        await app.stop()
+    await app.shutdown()
+    await rate_refresher.close()
+    try:
+        await update_dedupe.flush()
+    except Exception:
+        log.exception("storing seen update ids failed")
+    await asyncio.get_running_loop().run_in_executor(None, db.shutdown)
+
+def db_status()->dict:
+    """Whether DB_PATH opens and has every migration applied; blocking, keep it off the event loop."""
+    try:
+        version = db.schema_version(DB_PATH)
+    except sqlite3.Error as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": version >= len(MIGRATIONS), "schema_version": version, "migrations": len(MIGRATIONS)}
+
+def readiness(app, db_report:dict)->tuple:
+    """(ready, report) for /ready: PTB started and DB_PATH fully migrated."""
+    ptb = {"running": bool(app is not None and app.running)}
+    if startup_error:
+        ptb["error"] = startup_error
+    ready = ptb["running"] and db_report["ok"]
+    return ready, {"ready": ready, "pid": os.getpid(), "ptb": ptb, "db": db_report,
+                   "startup_seconds": dict(startup_seconds)}
+
+# ===================== FLASK + PTB RUNTIME =====================
+def get_application():
+    """This process's PTB Application, built on first use."""
+    global application
+    with _runtime_lock:
+        if application is None:
+            application = make_app(max_pending=WEBHOOK_QUEUE_SIZE)
+        return application
+
+async def _startup(app):
+    # retried until it succeeds (Telegram or the DB may be down for a while);
+    # meanwhile /ready reports the error and the webhook answers 503
+    global startup_error
+    for attempt in itertools.count():
+        try:
+            await start_runtime(app)
+        except Exception as e:
+            startup_error = str(e)
+            delay = STARTUP_RETRY_SECS[min(attempt, len(STARTUP_RETRY_SECS) - 1)]
+            log.exception("startup failed, retrying in %ss", delay)
+            await asyncio.sleep(delay)
+        else:
+            startup_error = None
+            return
+    # НЕ делаем run_polling / run_webhook — мы принимаем апдейты через Flask
+
+# how long a Flask request waits for PTB's loop to take its update
+WEBHOOK_HANDOFF_SECS = 5.0
+
+async def _accept(app, update)->bool:
+    # on PTB's loop: the processor's in-flight count and the queue are not thread-safe
+    if not app.update_processor.admit(update.update_id):
+        return False
+    app.update_queue.put_nowait(update)
+    return True
+
+def _run_loop():
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+def ensure_runtime():
+    """Start PTB on a background event loop in this process, once; returns the loop.
+
+    gunicorn.conf.py calls it right after the fork; otherwise the first request does."""
+    global loop
+    if loop is None:
+        with _runtime_lock:
+            if loop is None:
+                app = get_application()
+                loop = asyncio.new_event_loop()
+                loop.create_task(_startup(app))
+                threading.Thread(target=_run_loop, name="ptb-loop", daemon=True).start()
+    return loop
+
+def create_app():
+    """Flask app with the webhook, / (liveness), /ready and /metrics.
+
+    Run with `gunicorn 'bot:create_app()'`; PTB starts per worker, not here."""
+    from flask import Flask, request    # only the WSGI deployment needs Flask
+
+    flask_app = Flask(__name__)
+
+    @flask_app.before_request
+    def _start():
+        ensure_runtime()
+
+    # Webhook endpoint (синхронный) — безопасно прокидываем Update в очередь PTB
+    @flask_app.post(f"/{require_token()}")
+    def webhook():
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token", "") != WEBHOOK_SECRET:
+            return "forbidden", 403
+        app = get_application()
+        if not app.running:
+            # PTB ещё не запущен (или останавливается): апдейт не берём и не помечаем принятым —
+            # Telegram доставит его повторно
+            return "starting", 503, {"Retry-After": "1"}
+        if app.update_processor.full():
+            # отказываем до разбора тела
+            return "busy", 503, {"Retry-After": "1"}
+        data = request.get_json(force=True, silent=True)
+        if not isinstance(data, dict):
+            return "bad update", 400
+        update_id = data.get("update_id")
+        if isinstance(update_id, int) and not update_dedupe.claim(update_id):
+            # повтор уже принятого апдейта: подтверждаем и больше ничего не делаем
+            return "ok", 200
+        try:
+            update = Update.de_json(data, app.bot)
+        except (ValueError, TypeError, KeyError):
+            # не разобрали: снимаем отметку, иначе исправленный повтор сочтётся дубликатом
+            update_dedupe.release(update_id)
+            return "bad update", 400
+        handoff = asyncio.run_coroutine_threadsafe(_accept(app, update), ensure_runtime())
+        try:
+            accepted = handoff.result(WEBHOOK_HANDOFF_SECS)
+        except Exception:
+            handoff.cancel()
+            log.exception("update %s not handed to PTB", update_id)
+            accepted = False
+        if not accepted:
+            # отказ: повтор от Telegram не должен считаться дубликатом
+            update_dedupe.release(update_id)
+            return "busy", 503, {"Retry-After": "1"}
+        return "ok", 200
+
+    @flask_app.get("/")
+    def index():
+        return "Bot is running", 200
+
+    @flask_app.get("/ready")
+    def ready():
+        ok, report = readiness(application, db_status())
+        return report, 200 if ok else 503
+
+    @flask_app.get("/metrics")
+    def metrics_endpoint():
+        return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
+    return flask_app
+
+def __getattr__(name:str):
+    # `gunicorn bot:flask_app` keeps working: the app is created on first access
+    if name != "flask_app":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _runtime_lock:
+        if "flask_app" not in globals():
+            globals()["flask_app"] = create_app()
+    return globals()["flask_app"]
@@ -0,0 +1,352 @@
+# db.py
+import os
+import asyncio
+import functools
+import logging
+import queue
+import reprlib
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+
+# ===================== SETTINGS =====================
+BUSY_TIMEOUT_MS = 5000
+
+# Applied once per connection. WAL lets readers run next to the single writer,
+# NORMAL sync is durable across app crashes (fsync only at checkpoints),
+# busy_timeout makes concurrent gunicorn workers wait instead of failing with
+# "database is locked".
+PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("cache_size", -16000),          # KiB, ~16 MB page cache per connection
+    ("mmap_size", 256 * 1024 * 1024),
+    ("busy_timeout", BUSY_TIMEOUT_MS),
+    ("temp_store", "MEMORY"),
+)
+
+# sqlite3 keeps this many compiled statements per connection, keyed by SQL text,
+# so helpers that reuse constant SQL strings skip re-preparing them.
+STATEMENT_CACHE_SIZE = 256
+
+# Threads that run DB work for the event loop; each keeps its own connections.
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+
+# Open connections kept per thread; with one DB file per tenant the least
+# recently used ones are closed beyond this.
+DB_MAX_OPEN = max(2, int(os.getenv("DB_MAX_OPEN", "32")))
+
+# Writer threads; DB files are spread over them by path, so a long write to
+# one file only delays files that share its writer.
+DB_WRITERS = max(1, int(os.getenv("DB_WRITERS", "4")))
+
+# Group commit: the writer collects submissions for up to WRITE_BATCH_MS or
+# WRITE_BATCH_MAX submissions and commits them in one transaction.
+WRITE_BATCH_MS = float(os.getenv("WRITE_BATCH_MS", "2"))
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "500"))
+
+# Log DB helper calls slower than this (ms); 0 disables the slow-query log.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "0"))
+
+log = logging.getLogger(__name__)
+
+_local = threading.local()
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+# ===================== CONNECTIONS =====================
+def _open(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        path,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        isolation_level=None,  # autocommit; writes go through transaction()
+        cached_statements=STATEMENT_CACHE_SIZE,
+    )
+    for name, value in PRAGMAS:
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+def _conns() -> OrderedDict:
+    # Connections must not cross a fork (gunicorn --preload): drop inherited ones.
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.conns = OrderedDict()
+    return _local.conns
+
+def get_conn(path: str) -> sqlite3.Connection:
+    """Long-lived connection to `path` owned by the calling thread.
+
+    Each thread keeps at most DB_MAX_OPEN connections, least recently used
+    first out; one still inside a transaction is never closed."""
+    conns = _conns()
+    conn = conns.get(path)
+    if conn is not None:
+        conns.move_to_end(path)
+        return conn
+    conn = conns[path] = _open(path)
+    if len(conns) > DB_MAX_OPEN:
+        for old_path, old in list(conns.items())[:-1]:
+            if not old.in_transaction:
+                del conns[old_path]
+                old.close()
+                break
+    return conn
+
+@contextmanager
+def transaction(path: str):
+    """BEGIN IMMEDIATE … COMMIT on the thread's connection, ROLLBACK on error.
+
+    Taking the write lock up front avoids the deferred-lock upgrade that
+    busy_timeout cannot resolve when two workers write at once."""
+    conn = get_conn(path)
+    if conn.in_transaction:
+        # nested use joins the outer transaction
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+@contextmanager
+def snapshot(path: str):
+    """Deferred BEGIN … COMMIT for reads: every statement inside sees the same
+    WAL snapshot, and no write lock is taken."""
+    conn = get_conn(path)
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
+
+# ===================== MIGRATIONS =====================
+def schema_version(path: str) -> int:
+    return get_conn(path).execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(path: str, migrations) -> int:
+    """Bring `path` up to len(migrations); returns the resulting version.
+
+    migrations[i] is a callable(conn) that upgrades version i to i+1. Each one
+    runs in its own write transaction together with the user_version bump, and
+    the version is re-read under the lock so concurrent workers apply each
+    migration exactly once."""
+    target = len(migrations)
+    while True:
+        with transaction(path) as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= target:
+                return version
+            migrations[version](conn)
+            conn.execute(f"PRAGMA user_version={version + 1}")
+
+def close_all():
+    """Close the calling thread's connections."""
+    conns = _conns()
+    for conn in conns.values():
+        conn.close()
+    conns.clear()
+
+# ===================== ASYNC ACCESS =====================
+def executor() -> ThreadPoolExecutor:
+    global _executor, _executor_pid
+    with _executor_lock:
+        # pool threads do not survive fork either
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+            _executor_pid = os.getpid()
+        return _executor
+
+def _observe(fn, elapsed: float, failed: bool, args):
+    name = getattr(fn, "__name__", None) or repr(fn)
+    metrics.DB_CALL_SECONDS.observe(name, elapsed)
+    if failed:
+        metrics.DB_CALL_ERRORS.inc(name)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        log.warning("slow db call %s: %.1f ms args=%s", name, elapsed * 1000, reprlib.repr(args))
+
+def _timed(fn, *args, **kwargs):
+    t = time.perf_counter()
+    failed = True
+    try:
+        result = fn(*args, **kwargs)
+        failed = False
+        return result
+    finally:
+        _observe(fn, time.perf_counter() - t, failed, args)
+
+async def run(fn, *args, **kwargs):
+    """Run a blocking DB helper on the DB executor and await its result.
+
+    Keeps slow queries (reports, rebuilds) off the event loop so other chats'
+    updates and callback answers are not stalled behind them."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor(), functools.partial(_timed, fn, *args, **kwargs))
+
+def shutdown():
+    global _executor
+    for q in write_queues:
+        q.close()
+    with _executor_lock:
+        if _executor is not None and _executor_pid == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = None
+
+# ===================== GROUP-COMMIT WRITER =====================
+class WriteQueue:
+    """Single writer thread that commits queued writes in batches.
+
+    A submission is fn(conn, *args); everything fn does is atomic (it runs
+    inside its own SAVEPOINT), so multi-row operations stay all-or-nothing
+    while sharing one COMMIT, and one fsync, with every other submission in
+    the batch. The returned future resolves only after that COMMIT.
+
+    alone=True gives a submission a transaction of its own. Bulk writes use it:
+    a batch of one needs no SAVEPOINT, and under synchronous=FULL a savepoint
+    around tens of thousands of rows makes them several times slower."""
+
+    def __init__(self, batch_ms: float = WRITE_BATCH_MS, batch_max: int = WRITE_BATCH_MAX, name: str = "db-writer"):
+        self.name = name
+        self.batch_ms = batch_ms
+        self.batch_max = batch_max
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.submissions = 0
+
+    def submit(self, path: str, fn, *args, alone: bool = False) -> Future:
+        fut = Future()
+        self._ensure_thread()
+        self._queue.put((path, fn, args, fut, alone))
+        return fut
+
+    def close(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                self._full_sync = {}    # path -> the writer connection already set to FULL
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.batch_ms / 1000
+            while len(batch) < self.batch_max:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            by_path = {}
+            for item in batch:
+                if item[4]:
+                    self._commit(item[0], [item])
+                else:
+                    by_path.setdefault(item[0], []).append(item)
+            for path, items in by_path.items():
+                self._commit(path, items)
+
+    def _commit(self, path: str, items):
+        conn = get_conn(path)
+        if self._full_sync.get(path) is not conn:
+            # commits are batched, so the writer can afford an fsync per commit;
+            # per connection, since get_conn() may have closed and reopened it
+            conn.execute("PRAGMA synchronous=FULL")
+            self._full_sync[path] = conn
+        outcomes = []
+        # a lone submission is atomic through the transaction itself
+        savepoints = len(items) > 1
+        started = time.perf_counter()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for _, fn, args, fut, _ in items:
+                if not fut.set_running_or_notify_cancel():
+                    outcomes.append(None)
+                    continue
+                if savepoints:
+                    conn.execute("SAVEPOINT write_item")
+                t = time.perf_counter()
+                try:
+                    result = fn(conn, *args)
+                except Exception as e:
+                    _observe(fn, time.perf_counter() - t, True, args)
+                    if not savepoints:
+                        raise
+                    conn.execute("ROLLBACK TO write_item")
+                    conn.execute("RELEASE write_item")
+                    outcomes.append((False, e))
+                else:
+                    _observe(fn, time.perf_counter() - t, False, args)
+                    if savepoints:
+                        conn.execute("RELEASE write_item")
+                    outcomes.append((True, result))
+            conn.execute("COMMIT")
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for _, _, _, fut, _ in items:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        self.batches += 1
+        self.submissions += len(items)
+        metrics.DB_WRITE_BATCH_SECONDS.observe(None, time.perf_counter() - started)
+        metrics.DB_WRITE_BATCH_SIZE.observe(None, len(items))
+        for (_, _, _, fut, _), outcome in zip(items, outcomes):
+            if outcome is None:
+                continue
+            ok, value = outcome
+            if ok:
+                fut.set_result(value)
+            else:
+                fut.set_exception(value)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+write_queues = [WriteQueue(name=f"db-writer-{i}") for i in range(DB_WRITERS)]
+metrics.Gauge("bot_db_write_queue_depth", "Writes waiting for the group-commit writers.",
+              lambda: sum(q.depth() for q in write_queues))
+
+def write_queue(path: str) -> WriteQueue:
+    """The writer that owns `path`; every write to one file goes through the same thread."""
+    return write_queues[zlib.crc32(path.encode()) % len(write_queues)]
+
+async def write(path: str, fn, *args, alone: bool = False):
+    """Queue fn(conn, *args) on the group-commit writer and await its durable result."""
+    return await asyncio.wrap_future(write_queue(path).submit(path, fn, *args, alone=alone))
@@ -0,0 +1,184 @@
+# fake_bot_api.py
+# Local stand-in for the Telegram Bot API, for load tests: answers the methods
+# the bot calls (getMe, sendMessage, editMessageText, answerCallbackQuery, …)
+# with plausible objects and records every call. Start the bot with
+#   BOT_API_URL=http://127.0.0.1:8081
+# and it talks to this server instead of api.telegram.org.
+#   python fake_bot_api.py [--port 8081]
+import sys
+import json
+import time
+import asyncio
+import argparse
+import itertools
+from email.parser import BytesParser
+from email.policy import HTTP
+from http import HTTPStatus
+from urllib.parse import parse_qsl
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Budget", "username": "budget_load_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": False}
+
+# ===================== REQUEST PARSING =====================
+def _decode(value: str):
+    # PTB sends every parameter as a form field, complex ones JSON-encoded
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def parse_params(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("multipart/form-data"):
+        msg = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        params = {}
+        for part in msg.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            payload = part.get_payload(decode=True) or b""
+            if part.get_filename():
+                params[name] = {"filename": part.get_filename(), "size": len(payload)}
+            else:
+                params[name] = _decode(payload.decode())
+        return params
+    return {k: _decode(v) for k, v in parse_qsl(body.decode(), keep_blank_values=True)}
+
+# ===================== FAKE API =====================
+class FakeBotAPI:
+    """Minimal asyncio HTTP/1.1 server speaking enough of the Bot API for the bot's handlers.
+
+    Each call becomes a record dict (t, method, chat_id, message_id, text,
+    reply_markup, params); on_call(record), if set, is invoked on the server's
+    event loop once the response has been written."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, on_call=None):
+        self.host = host
+        self.port = port
+        self.on_call = on_call
+        self.calls = {}                     # method -> count
+        self.server = None
+        self._conns = {}                    # handler task -> writer
+        self._ids = itertools.count(1)      # message ids, unique across chats
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    async def start(self):
+        # large backlog: the bot opens many pooled connections at once
+        self.server = await asyncio.start_server(self._serve, self.host, self.port, backlog=1024)
+        return self
+
+    async def stop(self):
+        self.server.close()
+        tasks = list(self._conns)
+        for writer in self._conns.values():   # idle keep-alive connections
+            writer.close()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        self._conns[asyncio.current_task()] = writer
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                request_line, *lines = head.decode("latin-1").split("\r\n")
+                path = request_line.split(" ")[1]
+                headers = {}
+                for line in lines:
+                    if line:
+                        key, _, value = line.partition(":")
+                        headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                status, payload, record = self.handle(path, headers.get("content-type", ""), body)
+                out = json.dumps(payload).encode()
+                writer.write(f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+                             f"content-type: application/json\r\ncontent-length: {len(out)}\r\n\r\n".encode() + out)
+                await writer.drain()
+                # report the call once the bot has its answer, like a user seeing the message
+                if record is not None and self.on_call is not None:
+                    record["t"] = time.perf_counter()
+                    self.on_call(record)
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            self._conns.pop(asyncio.current_task(), None)
+            writer.close()
+
+    # ---------- methods ----------
+    def _message(self, chat_id, text, reply_markup=None, message_id=None):
+        msg = {
+            "message_id": message_id or next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if int(chat_id) > 0 else "group"},
+            "from": BOT_USER,
+            "text": text or "",
+        }
+        if reply_markup:
+            msg["reply_markup"] = reply_markup
+        return msg
+
+    def handle(self, path: str, content_type: str, body: bytes):
+        # /bot<token>/<method>
+        method = path.rsplit("/", 1)[-1].split("?", 1)[0]
+        try:
+            params = parse_params(content_type, body)
+        except (ValueError, UnicodeDecodeError):
+            return 400, {"ok": False, "error_code": 400, "description": "Bad Request: can't parse body"}, None
+        self.calls[method] = self.calls.get(method, 0) + 1
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "sendDocument", "sendPhoto"):
+            text = params.get("text") or params.get("caption")
+            result = self._message(chat_id, text, params.get("reply_markup"))
+            if method != "sendMessage":
+                result["caption"] = result.pop("text")
+                result["document"] = {"file_id": f"file{result['message_id']}",
+                                      "file_unique_id": f"u{result['message_id']}"}
+        elif method == "editMessageText":
+            result = self._message(chat_id, params.get("text"), params.get("reply_markup"),
+                                   message_id=params.get("message_id"))
+        elif method in ("answerCallbackQuery", "setWebhook", "deleteWebhook", "setMyCommands"):
+            result = True
+        elif method == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        else:
+            return 404, {"ok": False, "error_code": 404, "description": "Not Found"}, None
+        record = {
+            "t": None,
+            "method": method,
+            "chat_id": None if chat_id is None else int(chat_id),
+            "message_id": result["message_id"] if isinstance(result, dict) and "message_id" in result else None,
+            "text": params.get("text") or params.get("caption"),
+            "reply_markup": params.get("reply_markup"),
+            "params": params,
+        }
+        return 200, {"ok": True, "result": result}, record
+
+async def serve(host: str, port: int):
+    api = await FakeBotAPI(host, port).start()
+    print(f"fake Bot API on {api.url} (BOT_API_URL={api.url})", file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        print(json.dumps(api.calls, indent=2), file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,13 @@
+# gunicorn.conf.py
+# Read by gunicorn from the working directory, e.g.:
+#   gunicorn 'bot:create_app()' -w 2 --threads 8 --preload
+# Importing bot starts nothing, so --preload can import it once in the master;
+# each worker starts PTB (migrations, Bot API client, event loop thread) right
+# after the fork instead of on its first request, and /ready turns 200 then.
+
+def post_fork(server, worker):
+    # ASGI workers start PTB from asgi.py's lifespan instead
+    if "uvicorn" in server.cfg.worker_class_str:
+        return
+    import bot
+    bot.ensure_runtime()
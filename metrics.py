@@ -0,0 +1,163 @@
+# metrics.py
+# In-process metrics in Prometheus text format, no extra dependency:
+# handler / DB call latency histograms with counts and errors, queue depths
+# and event-loop lag. Recording is a bisect and a short lock, cheap enough to
+# leave on under load. Each worker process keeps its own numbers; scrape each
+# worker (or run one) when using several.
+import time
+import asyncio
+import functools
+import threading
+from bisect import bisect_left
+
+from telegram.ext import ApplicationHandlerStop, ConversationHandler
+
+# seconds; covers cached PK reads up to slow reports
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+LOOP_LAG_INTERVAL = 0.5
+
+_registry = []
+
+# ===================== PRIMITIVES =====================
+def _labels(label: str, value) -> str:
+    if label is None:
+        return ""
+    value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{label}="{value}"'
+
+def _braces(*parts) -> str:
+    parts = [p for p in parts if p]
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    def __init__(self, name: str, help: str, label: str = None):
+        self.name, self.help, self.label = name, help, label
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, key=None, n: float = 1):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            snapshot = dict(self._values)
+        for key, value in sorted(snapshot.items(), key=lambda kv: str(kv[0])):
+            yield f"{self.name}{_braces(_labels(self.label, key) if key is not None else '')} {value}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, label: str = None, buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label = name, help, label
+        self.buckets = tuple(buckets)
+        self._series = {}   # key -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, key, seconds: float):
+        i = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            series[i] += 1
+            series[-1] += seconds
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            snapshot = {k: list(v) for k, v in self._series.items()}
+        for key, series in sorted(snapshot.items(), key=lambda kv: str(kv[0])):
+            label = _labels(self.label, key) if key is not None else ""
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_braces(label, le)} {cumulative}"
+            yield f"{self.name}_sum{_braces(label)} {series[-1]}"
+            yield f"{self.name}_count{_braces(label)} {cumulative}"
+
+class Gauge:
+    """Value read at scrape time from fn(); failures render nothing.
+
+    Registering a name again replaces the previous gauge, so the newest
+    Application's queue is the one reported."""
+
+    def __init__(self, name: str, help: str, fn):
+        self.name, self.help, self.fn = name, help, fn
+        _registry[:] = [m for m in _registry if m.name != name]
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.fn()
+        except Exception:
+            return
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {value}"
+
+def render() -> str:
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ===================== BOT METRICS =====================
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "PTB handler callback latency.", "handler")
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "PTB handler callbacks that raised.", "handler")
+DB_CALL_SECONDS = Histogram("bot_db_call_seconds", "DB helper run time on its worker thread.", "fn")
+DB_CALL_ERRORS = Counter("bot_db_call_errors_total", "DB helper calls that raised.", "fn")
+DB_WRITE_BATCH_SECONDS = Histogram("bot_db_write_batch_seconds", "Group-commit batch time, BEGIN to COMMIT.")
+DB_WRITE_BATCH_SIZE = Histogram("bot_db_write_batch_size", "Submissions per group-commit batch.",
+                                buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+DUPLICATE_UPDATES = Counter("bot_duplicate_updates_total", "Redelivered updates dropped, by where they were caught.",
+                            "stage")
+FX_REFRESH = Counter("bot_fx_refresh_total", "Provider rate fetches, by outcome: ok, partial, failed.", "result")
+REPORT_CACHE = Counter("bot_report_cache_total", "Report requests answered from the cache or recomputed.", "result")
+STARTUP_SECONDS = Histogram("bot_startup_seconds", "Process start-up by phase: import, db, ptb, ready (total).",
+                            "phase", buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+LOOP_LAG_SECONDS = Histogram("bot_event_loop_lag_seconds", "How late the event loop runs a scheduled wakeup.")
+
+def timed_callback(name: str, callback):
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        t = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(name, time.perf_counter() - t)
+    return wrapper
+
+def _handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _handlers(state_handlers)
+            yield from _handlers(handler.fallbacks)
+        else:
+            yield handler
+
+def instrument_app(app):
+    """Time every handler callback registered on app, conversation steps included."""
+    for group in app.handlers.values():
+        for handler in _handlers(group):
+            callback = handler.callback
+            if not getattr(callback, "_timed", False):
+                handler.callback = timed_callback(callback.__name__, callback)
+                handler.callback._timed = True
+
+async def monitor_loop_lag(interval: float = LOOP_LAG_INTERVAL):
+    """Run on the loop to watch: records how late each sleep(interval) wakes up."""
+    while True:
+        t = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(None, max(0.0, time.perf_counter() - t - interval))
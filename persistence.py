@@ -0,0 +1,532 @@
+# persistence.py
+# SQLite-backed PTB persistence shared by every worker/process of the bot.
+# user_data / chat_data / conversation states live in one ptb_data table;
+# each process keeps what it last read or wrote (with the row version) in
+# memory, re-reads a row only when its version moved, and batches routine
+# writes (write-behind). Conversation steps are written through immediately,
+# because the user's next message may be delivered to another worker.
+import os
+import sys
+import json
+import time
+import pickle
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+
+from telegram import Update
+from telegram.ext import BaseHandler, BasePersistence, BaseUpdateProcessor, ConversationHandler, PersistenceInput
+
+import db
+import metrics
+
+# Delay before staged (write-behind) changes are committed in one batch.
+FLUSH_DELAY = float(os.getenv("PERSISTENCE_FLUSH_MS", "200")) / 1000
+
+# Webhook redeliveries: ids remembered in memory, and on disk for this long.
+DEDUPE_MEMORY = int(os.getenv("DEDUPE_MEMORY", "10000"))
+DEDUPE_TTL_SECS = int(os.getenv("DEDUPE_TTL_SECS", str(24 * 3600)))
+DEDUPE_FLUSH_SECS = 1.0
+DEDUPE_PRUNE_SECS = 600
+
+log = logging.getLogger(__name__)
+
+# ===================== SCHEMA =====================
+def create_schema(conn):
+    # data is NULL for dropped entries / ended conversations; the row stays so
+    # the version bump reaches other workers.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ptb_data(
+        kind TEXT NOT NULL,
+        id TEXT NOT NULL,
+        data BLOB,
+        version INTEGER NOT NULL,
+        PRIMARY KEY(kind, id)
+    ) WITHOUT ROWID
+    """)
+
+_UPSERT = """
+INSERT INTO ptb_data(kind,id,data,version) VALUES(?,?,?,1)
+ON CONFLICT(kind,id) DO UPDATE SET data=excluded.data, version=version+1
+RETURNING version
+"""
+# compare-and-set: only overwrite the version this process last saw
+_UPSERT_IF_VERSION = """
+INSERT INTO ptb_data(kind,id,data,version) VALUES(?,?,?,1)
+ON CONFLICT(kind,id) DO UPDATE SET data=excluded.data, version=version+1 WHERE version=?
+RETURNING version
+"""
+
+def _write_rows(conn, items):
+    """items: [(kind, id, blob, expected_version or None)] -> [new version or None on conflict]."""
+    out = []
+    for kind, id_, blob, expected in items:
+        if expected is None:
+            rows = conn.execute(_UPSERT, (kind, id_, blob)).fetchall()
+        else:
+            rows = conn.execute(_UPSERT_IF_VERSION, (kind, id_, blob, expected)).fetchall()
+        out.append(rows[0][0] if rows else None)
+    return out
+
+def _conv_kind(name: str) -> str:
+    return f"conv:{name}"
+
+def _conv_id(key) -> str:
+    return json.dumps(list(key))
+
+def _dump(obj):
+    return None if obj is None else pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+# ===================== PERSISTENCE =====================
+class SQLitePersistence(BasePersistence):
+    def __init__(self, path: str, update_interval: float = 5, flush_delay: float = FLUSH_DELAY):
+        # bot_data and arbitrary callback_data are not used by the bot
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        self.flush_delay = flush_delay
+        self._seen = {}         # (kind, id) -> (version, blob) last read/written here
+        self._dirty = {}        # (kind, id) -> (blob, version it was based on) staged for write-behind
+        self._inflight = {}     # (kind, id) -> writes from here not yet acknowledged
+        self._flush_task = None
+        self._conv_names = []
+        self._conv_handlers = []
+
+    # ---------- reads ----------
+    def _select_kind(self, kind: str):
+        return db.get_conn(self.path).execute(
+            "SELECT id, version, data FROM ptb_data WHERE kind=? AND data IS NOT NULL", (kind,)
+        ).fetchall()
+
+    def _select_one(self, kind: str, id_: str):
+        return db.get_conn(self.path).execute(
+            "SELECT version, data FROM ptb_data WHERE kind=? AND id=?", (kind, id_)
+        ).fetchone()
+
+    async def _load_kind(self, kind: str, decode_id) -> dict:
+        out = {}
+        for id_, version, blob in await db.run(self._select_kind, kind):
+            self._seen[(kind, id_)] = (version, blob)
+            out[decode_id(id_)] = pickle.loads(blob)
+        return out
+
+    async def get_user_data(self):
+        return await self._load_kind("user", int)
+
+    async def get_chat_data(self):
+        return await self._load_kind("chat", int)
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        return await self._load_kind(_conv_kind(name), lambda id_: tuple(json.loads(id_)))
+
+    async def _refresh(self, kind: str, id_: str, target: dict):
+        row = await db.run(self._select_one, kind, id_)
+        if row is None or self._inflight.get((kind, id_)):
+            return
+        seen = self._seen.get((kind, id_))
+        if seen is not None and seen[0] >= row[0]:
+            # unchanged, or a read that started before our own later write
+            return
+        # another worker wrote it: its version wins over anything staged here
+        self._dirty.pop((kind, id_), None)
+        target.clear()
+        if row[1] is not None:
+            target.update(pickle.loads(row[1]))
+        self._seen[(kind, id_)] = tuple(row)
+
+    async def refresh_user_data(self, user_id: int, user_data):
+        await self._refresh("user", str(user_id), user_data)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        await self._refresh("chat", str(chat_id), chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    def _select_conversations(self, key_ids):
+        kinds = [_conv_kind(n) for n in self._conv_names]
+        rows = {key_id: {} for key_id in key_ids}
+        for id_, kind, version, blob in db.get_conn(self.path).execute(
+                f"SELECT id, kind, version, data FROM ptb_data "
+                f"WHERE id IN ({','.join('?' * len(rows))}) AND kind IN ({','.join('?' * len(kinds))})",
+                (*rows, *kinds)):
+            rows[id_][kind] = (version, blob)
+        return rows
+
+    async def prefetch_conversations(self, keys, update_id: int):
+        """Read the stored states of `keys` off the loop, for sync_conversation() in this update.
+
+        One primary-key read per update covers every persistent conversation."""
+        rows = await db.run(self._select_conversations, [_conv_id(key) for key in keys])
+        _conv_rows.set((update_id, rows))
+
+    def sync_conversation(self, name: str, key, conversations, update_id: int):
+        """Pull the stored state of `key` into a handler's conversations dict.
+
+        Runs inside ConversationHandler.check_update (sync, on the event loop),
+        so it only uses what ConversationPrefetch read for this update; without
+        that handler in group -1 it reads the row itself."""
+        key_id = _conv_id(key)
+        prefetched = _conv_rows.get()
+        if prefetched is None or prefetched[0] != update_id or key_id not in prefetched[1]:
+            prefetched = (update_id, self._select_conversations([key_id]))
+            _conv_rows.set(prefetched)
+        rows = prefetched[1][key_id]
+        kind = _conv_kind(name)
+        row = rows.get(kind)
+        seen = self._seen.get((kind, key_id))
+        if row is None or self._inflight.get((kind, key_id)) or (seen is not None and seen[0] >= row[0]):
+            return
+        self._dirty.pop((kind, key_id), None)
+        if row[1] is None:
+            conversations.data.pop(key, None)   # untracked delete
+        else:
+            conversations.update_no_track({key: pickle.loads(row[1])})
+        self._seen[(kind, key_id)] = row
+
+    def _saw(self, kind: str, id_: str, version: int, blob):
+        # versions only grow; a late acknowledgement must not move _seen back
+        seen = self._seen.get((kind, id_))
+        if seen is None or seen[0] < version:
+            self._seen[(kind, id_)] = (version, blob)
+
+    async def _write(self, items):
+        # While our own write is in flight its row may already be committed
+        # with a version not yet in _seen; refresh/sync must not mistake it
+        # for another worker's change and roll memory back to it.
+        keys = [(kind, id_) for kind, id_, _, _ in items]
+        for key in keys:
+            self._inflight[key] = self._inflight.get(key, 0) + 1
+        try:
+            return await db.write(self.path, _write_rows, items)
+        finally:
+            for key in keys:
+                if self._inflight[key] == 1:
+                    del self._inflight[key]
+                else:
+                    self._inflight[key] -= 1
+
+    # ---------- write-behind ----------
+    def _stage(self, kind: str, id_: str, obj):
+        blob = _dump(obj)
+        seen = self._seen.get((kind, id_))
+        if (seen[1] if seen else None) == blob:
+            self._dirty.pop((kind, id_), None)
+            return
+        # the CAS is against the version this blob was derived from, so a
+        # write-through that lands before the flush wins over the staged copy
+        self._dirty[(kind, id_)] = (blob, seen[0] if seen else 0)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)
+        await self._flush_dirty()
+
+    async def _flush_dirty(self):
+        if not self._dirty:
+            return
+        staged, self._dirty = self._dirty, {}
+        items = [(kind, id_, blob, expected) for (kind, id_), (blob, expected) in staged.items()]
+        versions = await self._write(items)
+        for (kind, id_, blob, _), version in zip(items, versions):
+            if version is None:
+                # lost a race with another worker; re-read on next refresh
+                self._seen.pop((kind, id_), None)
+                log.debug("persistence conflict on %s/%s, keeping the stored version", kind, id_)
+            else:
+                self._saw(kind, id_, version, blob)
+
+    async def update_user_data(self, user_id: int, data):
+        self._stage("user", str(user_id), data)
+
+    async def update_chat_data(self, chat_id: int, data):
+        self._stage("chat", str(chat_id), data)
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def update_conversation(self, name: str, key, new_state):
+        self._stage(_conv_kind(name), _conv_id(key), new_state)
+
+    async def drop_user_data(self, user_id: int):
+        self._stage("user", str(user_id), None)
+
+    async def drop_chat_data(self, chat_id: int):
+        self._stage("chat", str(chat_id), None)
+
+    async def flush(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._flush_dirty()
+
+    # ---------- write-through ----------
+    async def commit_step(self, name: str, key, state, update: Update, context):
+        """Write a conversation step (state + user/chat data) through as soon as it ends."""
+        entries = [(_conv_kind(name), _conv_id(key), _dump(state))]
+        if update.effective_user is not None:
+            entries.append(("user", str(update.effective_user.id), _dump(context.user_data)))
+        if update.effective_chat is not None:
+            entries.append(("chat", str(update.effective_chat.id), _dump(context.chat_data)))
+        items = []
+        for kind, id_, blob in entries:
+            seen = self._seen.get((kind, id_))
+            self._dirty.pop((kind, id_), None)
+            if seen is None or seen[1] != blob:
+                items.append((kind, id_, blob, None))
+        if not items:
+            return
+        versions = await self._write(items)
+        for (kind, id_, blob, _), version in zip(items, versions):
+            self._saw(kind, id_, version, blob)
+
+    def register_conversation(self, handler):
+        if handler.name not in self._conv_names:
+            self._conv_names.append(handler.name)
+            self._conv_handlers.append(handler)
+
+    def conversation_keys(self, update) -> set:
+        return {key for key in (h.conversation_key(update) for h in self._conv_handlers) if key is not None}
+
+# ===================== CONVERSATIONS =====================
+# conversation rows read ahead for the update being processed:
+# (update_id, {key id: {kind: (version, blob)}})
+_conv_rows = contextvars.ContextVar("conv_rows", default=None)
+
+class SharedConversationHandler(ConversationHandler):
+    """ConversationHandler whose state is shared through SQLitePersistence.
+
+    Before an update is matched, the state for its key is re-read from the
+    store; after a step it is written through, so a multi-step flow survives
+    its updates landing on different workers."""
+
+    def __init__(self, *args, name: str, persistence: SQLitePersistence, **kwargs):
+        super().__init__(*args, name=name, persistent=True, **kwargs)
+        self._store = persistence
+        persistence.register_conversation(self)
+
+    def conversation_key(self, update):
+        if isinstance(update, Update) and (update.effective_chat or update.effective_user):
+            try:
+                return self._get_key(update)
+            except (AttributeError, RuntimeError):
+                return None
+        return None
+
+    def check_update(self, update):
+        key = self.conversation_key(update)
+        if key is not None:
+            self._store.sync_conversation(self.name, key, self._conversations, update.update_id)
+        return super().check_update(update)
+
+    async def handle_update(self, update, application, check_result, context):
+        result = await super().handle_update(update, application, check_result, context)
+        key = check_result[1]
+        await self._store.commit_step(self.name, key, self._conversations.get(key), update, context)
+        return result
+
+async def _prefetched(update, context):
+    pass
+
+class ConversationPrefetch(BaseHandler):
+    """Group -1 handler reading an update's conversation states on the executor.
+
+    Handlers of one update run in one task, so SharedConversationHandler's
+    check_update in group 0 finds them without touching SQLite on the loop."""
+
+    def __init__(self, persistence: SQLitePersistence):
+        super().__init__(_prefetched)
+        self._store = persistence
+
+    def check_update(self, update):
+        return self._store.conversation_keys(update) or None
+
+    async def handle_update(self, update, application, check_result, context):
+        await self._store.prefetch_conversations(check_result, update.update_id)
+
+# update_id of the update being processed, None outside of one (offline tools)
+current_update_id = contextvars.ContextVar("current_update_id", default=None)
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Concurrent update processing that keeps each chat's updates in order.
+
+    A chat's next update starts only after the previous one has finished,
+    including its conversation commit: the bot's reply goes out before
+    ConversationHandler records the new state, so a quick answer could
+    otherwise be matched against the old one. Different chats still run
+    concurrently, up to max_concurrent_updates.
+
+    PTB takes every update off update_queue as soon as it arrives, so the
+    queue never fills up; a webhook bounds the updates actually in flight
+    with admit() instead, up to max_pending (0: no bound).
+
+    PTB's process_update() (final) holds its semaphore around the whole of
+    do_process_update(), waiting for the chat included; that semaphore is
+    therefore left unbounded (so is max_concurrent_updates, as PTB sees it)
+    and the handler slots are taken here, once the chat is free, so one busy
+    chat cannot hold them all."""
+
+    def __init__(self, max_concurrent_updates: int, max_pending: int = 0):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        self._running = asyncio.BoundedSemaphore(max_concurrent_updates)
+        super().__init__(sys.maxsize)
+        self.max_pending = max_pending
+        self._chats = {}    # chat/user id -> [lock, updates holding or waiting for it]
+        self._pending = set()   # update_ids admitted and not finished yet
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def full(self) -> bool:
+        return bool(self.max_pending) and len(self._pending) >= self.max_pending
+
+    def admit(self, update_id: int) -> bool:
+        """Count update_id as in flight until it is processed; False when full.
+
+        Call on the application's loop before putting the update in the queue."""
+        if self.full():
+            return False
+        self._pending.add(update_id)
+        return True
+
+    def release(self, update_id: int) -> None:
+        # an admitted update that will not be processed after all
+        self._pending.discard(update_id)
+
+    @staticmethod
+    def _order_key(update):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def _in_order(self, key, coroutine):
+        if key is None:
+            async with self._running:
+                return await coroutine
+        entry = self._chats.get(key)
+        if entry is None:
+            entry = self._chats[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # wait for the chat before taking a handler slot
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+
+    async def do_process_update(self, update, coroutine):
+        # handlers of this update, and tasks they start, see its id
+        token = current_update_id.set(getattr(update, "update_id", None))
+        try:
+            await self._in_order(self._order_key(update), coroutine)
+        finally:
+            current_update_id.reset(token)
+            self._pending.discard(getattr(update, "update_id", None))
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+# ===================== UPDATE DEDUPE =====================
+def _store_seen(conn, ids, now: int, cutoff):
+    conn.executemany("INSERT OR IGNORE INTO seen_updates(update_id,seen_at) VALUES(?,?)", ((i, now) for i in ids))
+    if cutoff is not None:
+        conn.execute("DELETE FROM seen_updates WHERE seen_at < ?", (cutoff,))
+
+class UpdateDedupe:
+    """update_ids the webhook already accepted, so a redelivery is answered without being parsed.
+
+    The newest `size` ids are kept in memory. Accepted ids are also written
+    behind to seen_updates (kept `ttl` seconds) and reloaded by load(), so a
+    restart inside Telegram's retry window still recognises them. Another
+    worker's ids are not seen here; the ledger's update_id index covers those.
+    claim() and release() are thread-safe (Flask calls them from request threads)."""
+
+    def __init__(self, path: str, size: int = DEDUPE_MEMORY, ttl: int = DEDUPE_TTL_SECS):
+        self.path, self.size, self.ttl = path, size, ttl
+        self._ids = OrderedDict()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._pruned = 0.0
+
+    def claim(self, update_id: int) -> bool:
+        """True the first time update_id is offered, False for a redelivery."""
+        with self._lock:
+            if update_id in self._ids:
+                metrics.DUPLICATE_UPDATES.inc("webhook")
+                return False
+            self._ids[update_id] = None
+            if len(self._ids) > self.size:
+                self._ids.popitem(last=False)
+            self._pending.append(update_id)
+            return True
+
+    def release(self, update_id: int):
+        """Forget a claimed id whose delivery was refused, so its retry is taken."""
+        with self._lock:
+            self._ids.pop(update_id, None)
+            if update_id in self._pending:
+                self._pending.remove(update_id)
+
+    def _select(self):
+        return db.get_conn(self.path).execute(
+            "SELECT update_id FROM seen_updates WHERE seen_at >= ? ORDER BY update_id DESC LIMIT ?",
+            (int(time.time()) - self.ttl, self.size)).fetchall()
+
+    async def load(self):
+        """Remember the newest stored ids; call on start, before updates arrive."""
+        rows = await db.run(self._select)
+        with self._lock:
+            ids = OrderedDict.fromkeys(update_id for (update_id,) in reversed(rows))
+            ids.update(self._ids)
+            while len(ids) > self.size:
+                ids.popitem(last=False)
+            self._ids = ids
+
+    async def flush(self):
+        with self._lock:
+            ids, self._pending = self._pending, []
+        now = time.time()
+        prune = now - self._pruned >= DEDUPE_PRUNE_SECS
+        if not ids and not prune:
+            return
+        try:
+            await db.write(self.path, _store_seen, ids, int(now), int(now) - self.ttl if prune else None)
+        except Exception:
+            with self._lock:
+                self._pending[:0] = ids
+            raise
+        if prune:
+            self._pruned = now
+
+    async def run(self, interval: float = DEDUPE_FLUSH_SECS):
+        """Background write-behind loop; cancel it on shutdown and flush() once more."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("storing seen update ids failed")
@@ -0,0 +1,39 @@
+# conftest.py
+# bot reads its settings at import: point it at a scratch directory first, so
+# nothing here touches budget.db or reaches Telegram. Each test then gets its
+# own DB file through the `bot` fixture.
+#   pip install pytest && python -m pytest -q
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+_scratch = tempfile.mkdtemp(prefix="budget_tests_")
+os.environ.update(DB_PATH=os.path.join(_scratch, "import.db"), BOT_TOKEN="0:tests",
+                  STORAGE_MODE="shared", FX_PROVIDER="", DEFAULT_TENANT_ID="0")
+
+import bot as bot_module   # noqa: E402
+import db                   # noqa: E402
+
+@pytest.fixture
+def bot(tmp_path, monkeypatch):
+    """The bot module on an empty, migrated DB of its own, with every in-process cache dropped."""
+    monkeypatch.setattr(bot_module, "DB_PATH", str(tmp_path / "budget.db"))
+    monkeypatch.setattr(bot_module, "ARCHIVE_DIR", str(tmp_path / "archive"))
+    bot_module.reset_rate_caches()
+    bot_module.report_cache.clear()
+    bot_module._catalogs.clear()
+    bot_module.init_db()
+    yield bot_module
+    db.close_all()
+    bot_module.reset_rate_caches()
+    bot_module.report_cache.clear()
+    bot_module._catalogs.clear()
+
+@pytest.fixture(scope="session", autouse=True)
+def _shutdown_db():
+    yield
+    db.shutdown()
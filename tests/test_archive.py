@@ -0,0 +1,64 @@
+# test_archive.py
+# Archiving closed years moves rows out of the hot ledger; nothing a tenant
+# can see may change: balances, reports (partial days and rollup days in both
+# valuation modes), net worth and exports.
+import gzip
+from datetime import datetime
+
+import pytest
+
+import bench_ledger
+import db
+
+PERIODS = [
+    (datetime(2022, 11, 3, 13, 17), datetime(2023, 2, 7, 9, 1)),     # partial days, inside the archive
+    (datetime(2023, 12, 30, 5, 0), datetime(2024, 1, 2, 3, 0)),      # across the archive boundary
+    (datetime(2022, 1, 1), datetime(2025, 12, 1)),                   # everything
+    (datetime(2024, 3, 1, 12, 0), datetime(2024, 3, 9, 12, 0)),      # hot ledger only
+]
+EXPORT_RANGES = [(None, None), ("2022-12-01", "2024-02-01"), ("2023-05-01", "2023-05-31")]
+
+def snapshot(bot, tmp_path):
+    out = {"balances": bot.sum_balances_by_account(0)}
+    for mode in bot.REPORT_MODES:
+        for start, end in PERIODS:
+            out["report", mode, start] = bot.make_report_text(start, end, mode, 0)
+    points, missing = bot.networth_series(bot.networth_marks(40, "month", bench_ledger.END))
+    out["networth"] = ([(mark, round(value, 6)) for mark, value in points], missing)
+    for day_from, day_to in EXPORT_RANGES:
+        path = str(tmp_path / "export.csv.gz")
+        n = bot.export_ledger(path, day_from, day_to, fmt="csv", tenant=0)
+        with gzip.open(path, "rt") as f:
+            out["export", day_from] = (n, sorted(f.read().splitlines()))
+    return out
+
+@pytest.fixture
+def ledger(bot, monkeypatch):
+    monkeypatch.setattr(bot, "ARCHIVE_AFTER_DAYS", 300)
+    bench_ledger.build_ledger(bot, db, 4000, 7)
+    return bot
+
+def test_archive_keeps_balances_reports_and_exports(ledger, tmp_path):
+    bot = ledger
+    before = snapshot(bot, tmp_path)
+
+    results = bot.maintain_ledgers(bench_ledger.END)
+
+    assert sorted(results[bot.DB_PATH]["archived"]) == [2022, 2023]
+    conn = db.get_conn(bot.DB_PATH)
+    assert conn.execute("SELECT MIN(ts) FROM transactions WHERE carry_year IS NULL").fetchone()[0] >= "2024"
+    assert [year for year, _ in bot.archive_status(0)] == [2022, 2023]
+    # reports must not be served from a copy made before the move
+    bot.report_cache.clear()
+    after = snapshot(bot, tmp_path)
+    assert after.keys() == before.keys()
+    for key in before:
+        assert after[key] == before[key], key
+    assert not bot.verify_account_balances(repair=False, tenant=0)
+
+def test_archive_again_is_a_no_op(ledger, tmp_path):
+    bot = ledger
+    bot.maintain_ledgers(bench_ledger.END)
+    before = snapshot(bot, tmp_path)
+    assert bot.maintain_ledgers(bench_ledger.END)[bot.DB_PATH]["archived"] == {}
+    assert snapshot(bot, tmp_path) == before
@@ -0,0 +1,104 @@
+# test_catalog.py
+# /catalog edits: a rename carries the chat's ledger with it, archived names
+# leave the keyboards, and a flow holding a name the catalog no longer offers
+# asks for it again instead of failing.
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import db
+
+TENANT = 9
+
+@pytest.fixture
+def edit(bot):
+    asyncio.run(bot.write_ledger([bot.txn_row("2025-03-10T10:00:00", None, "expense", "еда", "ARS (нал)",
+                                              1000, "ARS")], tenant=TENANT))
+
+    def apply(action, kind, name, arg=None):
+        stored = asyncio.run(db.write(bot.DB_PATH, bot.edit_catalog, TENANT, action, kind, name, arg))
+        bot._catalogs.pop(TENANT, None)
+        return stored
+    return bot, apply
+
+def catalog(bot):
+    return asyncio.run(bot.tenant_catalog(TENANT))
+
+def buttons(markup):
+    return [button.callback_data for row in markup.inline_keyboard for button in row]
+
+def test_rename_moves_the_ledger(edit):
+    bot, apply = edit
+    assert apply("rename", "account", "ars (НАЛ)", "Песо (нал)") == "Песо (нал)"
+    assert apply("rename", "category", "Еда", "Продукты") == "продукты"
+    balances = bot.sum_balances_by_account(TENANT)
+    assert balances["Песо (нал)"] == -1000 and "ARS (нал)" not in balances
+    assert db.get_conn(bot.DB_PATH).execute("SELECT account, category FROM transactions WHERE tenant_id=?",
+                                            (TENANT,)).fetchall() == [("Песо (нал)", "продукты")]
+    assert catalog(bot).account_ccy["Песо (нал)"] == "ARS"
+    # other chats keep the built-in names
+    assert "ARS (нал)" in asyncio.run(bot.tenant_catalog(TENANT + 1)).accounts
+
+def test_add_archive_and_restore(edit):
+    bot, apply = edit
+    apply("add", "account", "Кошелёк", "GEL")
+    cat = catalog(bot)
+    assert cat.account_ccy["Кошелёк"] == "GEL" and "GEL" in cat.currencies
+    apply("archive", "account", "Кошелёк")
+    assert "Кошелёк" not in catalog(bot).accounts
+    apply("restore", "account", "кошелёк")
+    assert catalog(bot).accounts[-1] == "Кошелёк"
+
+@pytest.mark.parametrize("action, kind, name, arg", [
+    ("add", "category", "ЕДА", None),           # exists, any case
+    ("rename", "account", "USD (нал)", "ARS (нал)"),
+    ("rename", "currency", "USD", "USX"),
+    ("rename", "account", "нет такого", "x"),
+    ("add", "currency", "доллар", None),
+])
+def test_refused_edits(edit, action, kind, name, arg):
+    _, apply = edit
+    with pytest.raises(ValueError):
+        apply(action, kind, name, arg)
+
+def test_last_active_entry_stays(edit):
+    bot, apply = edit
+    for category in catalog(bot).categories[1:]:
+        apply("archive", "category", category)
+    with pytest.raises(ValueError):
+        apply("archive", "category", catalog(bot).categories[0])
+
+class Chat:
+    """Replies a flow step sends, and the user_data it keeps."""
+    def __init__(self, **data):
+        self.user_data, self.sent = data, []
+
+    async def send(self, text, **kwargs):
+        self.sent.append((text, buttons(kwargs["reply_markup"]) if "reply_markup" in kwargs else None))
+
+def test_exchange_with_a_renamed_account_asks_again(edit):
+    bot, apply = edit
+    chat = Chat(ex_from="ARS (нал)", ex_to="USD (нал)", ex_amt=100.0, ex_rate=0.001)
+    apply("rename", "account", "ARS (нал)", "Песо (нал)")
+    assert asyncio.run(bot._exchange_next(chat.send, chat, TENANT)) == bot.EX_FROM_ACC
+    text, keys = chat.sent[0]
+    assert "«ARS (нал)» больше нет" in text and "acc:Песо (нал)" in keys
+    assert chat.user_data == {"ex_to": "USD (нал)", "ex_amt": 100.0, "ex_rate": 0.001}
+
+def test_expense_with_an_archived_category_asks_again(edit):
+    bot, apply = edit
+    chat = Chat(exp_cat="еда", exp_amount=5.0, exp_ccy="ARS", exp_acc="ARS (нал)")
+    apply("archive", "category", "еда")
+    assert asyncio.run(bot._expense_next(chat.send, chat, TENANT)) == bot.EXP_CAT
+    assert "«еда» больше нет" in chat.sent[0][0]
+    assert bot.sum_balances_by_account(TENANT)["ARS (нал)"] == -1000
+
+def test_reconcile_with_a_renamed_account_asks_again(edit):
+    bot, apply = edit
+    chat = Chat(rec_acc="ARS (нал)")
+    apply("rename", "account", "ARS (нал)", "Песо (нал)")
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=TENANT),
+                             message=SimpleNamespace(text="10", from_user=None, reply_text=chat.send))
+    assert asyncio.run(bot.reconcile_amount(update, chat)) == bot.REC_ACC
+    assert "acc:Песо (нал)" in chat.sent[0][1]
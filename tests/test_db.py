@@ -0,0 +1,18 @@
+# test_db.py
+# The group-commit writer commits at synchronous=FULL on every connection it
+# uses, including one get_conn() reopened after evicting it.
+import db
+
+def _synchronous(conn):
+    return conn.execute("PRAGMA synchronous").fetchone()[0]
+
+def test_writer_sets_full_sync_on_reopened_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_MAX_OPEN", 2)
+    writer = db.WriteQueue(name="test-writer")
+    paths = [str(tmp_path / f"{name}.db") for name in "abc"]
+    try:
+        # the third file evicts the first from the writer thread's connections
+        seen = [writer.submit(path, _synchronous).result(5) for path in paths + paths[:1]]
+    finally:
+        writer.close()
+    assert seen == [2, 2, 2, 2]     # FULL
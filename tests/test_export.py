@@ -0,0 +1,69 @@
+# test_export.py
+# /export streams one chat's rows in id order, in either format, with the
+# day range inclusive and notes kept byte for byte.
+import asyncio
+import csv
+import gzip
+import json
+
+import pytest
+
+TENANT = 4
+NOTE = 'чек "№1", строка\nвторая'
+
+@pytest.fixture
+def ledger(bot, monkeypatch):
+    monkeypatch.setattr(bot, "EXPORT_FETCH", 2)     # several fetches per file
+    rows = [
+        ("2025-03-01T00:00:00", "expense", "еда", "ARS (нал)", 100, "ARS", NOTE),
+        ("2025-03-02T23:59:59", "income", None, "USD (нал)", 50, "USD", None),
+        ("2025-03-03T12:00:00", "expense", "аренда", "ARS (нал)", 700, "ARS", None),
+        ("2025-03-04T08:00:00", "expense", "еда", "EUR (карта)", 9.5, "EUR", None),
+    ]
+    asyncio.run(bot.write_ledger([bot.txn_row(ts, None, *row) for ts, *row in rows], tenant=TENANT))
+    asyncio.run(bot.write_ledger([bot.txn_row("2025-03-02T10:00:00", None, "expense", "еда", "ARS (нал)", 1, "ARS")],
+                                 tenant=TENANT + 1))
+    return bot
+
+def export(bot, tmp_path, fmt="csv", **kwargs):
+    path = str(tmp_path / f"export.{fmt}.gz")
+    n = bot.export_ledger(path, fmt=fmt, tenant=TENANT, **kwargs)
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            header, *rows = list(csv.reader(f))
+            assert tuple(header) == bot.EXPORT_COLUMNS
+            rows = [dict(zip(header, row)) for row in rows]
+        else:
+            rows = [json.loads(line) for line in f]
+    assert n == len(rows)
+    return rows
+
+@pytest.mark.parametrize("fmt", ["csv", "jsonl"])
+def test_whole_ledger(ledger, tmp_path, fmt):
+    rows = export(ledger, tmp_path, fmt)
+    assert [row["ts"][:10] for row in rows] == ["2025-03-01", "2025-03-02", "2025-03-03", "2025-03-04"]
+    assert [int(row["id"]) for row in rows] == sorted(int(row["id"]) for row in rows)
+    assert rows[0]["note"] == NOTE
+
+def test_day_range_includes_its_last_day(ledger, tmp_path):
+    rows = export(ledger, tmp_path, day_from="2025-03-02", day_to="2025-03-03")
+    assert [row["ts"] for row in rows] == ["2025-03-02T23:59:59", "2025-03-03T12:00:00"]
+
+def test_one_account(ledger, tmp_path):
+    rows = export(ledger, tmp_path, "jsonl", account="ARS (нал)")
+    assert [(row["amount"], row["category"]) for row in rows] == [(100.0, "еда"), (700.0, "аренда")]
+
+def test_empty_range(ledger, tmp_path):
+    assert export(ledger, tmp_path, day_from="2024-01-01", day_to="2024-12-31") == []
+
+@pytest.mark.parametrize("args, parsed", [
+    ([], (None, None, None, "csv")),
+    (["jsonl"], (None, None, None, "jsonl")),
+    (["2025-03-01", "2025-03-31", "ars", "(нал)", "CSV"], ("2025-03-01", "2025-03-31", "ARS (нал)", "csv")),
+])
+def test_arguments(bot, args, parsed):
+    assert bot._parse_export_args(args) == parsed
+
+def test_unknown_account_argument(bot):
+    with pytest.raises(ValueError):
+        bot._parse_export_args(["нет", "такого"])
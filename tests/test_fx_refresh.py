@@ -0,0 +1,57 @@
+# test_fx_refresh.py
+# RateRefresher asks the provider only for catalog currencies that are due,
+# stores a rate only when it changed, and counts an unchanged answer as a
+# fresh check so the currency is not asked for again until its TTL runs out.
+import asyncio
+
+import pytest
+
+import db
+
+STALE = "2024-01-01T00:00:00"
+
+class Quotes:
+    def __init__(self, rates):
+        self.rates, self.asked = rates, []
+
+    async def fetch(self, currencies):
+        self.asked.append(sorted(currencies))
+        return {ccy: rate for ccy, rate in self.rates.items() if ccy in currencies}
+
+    async def close(self):
+        pass
+
+@pytest.fixture
+def stale(bot, monkeypatch):
+    monkeypatch.setattr(bot, "CCY_LIST", ["ARS", "EUR", "USD"])
+    with db.transaction(bot.DB_PATH) as conn:
+        conn.executemany("INSERT INTO fx_rates(ts,currency,to_usd) VALUES(?,?,?)",
+                         [(STALE, "ARS", 0.001), (STALE, "EUR", 1.1)])
+    return bot
+
+def rows(bot, currency):
+    return db.get_conn(bot.DB_PATH).execute("SELECT COUNT(*) FROM fx_rates WHERE currency=?", (currency,)).fetchone()[0]
+
+def test_unchanged_rate_is_checked_not_stored(stale):
+    bot = stale
+    quotes = Quotes({"ARS": 0.001, "EUR": 1.2})
+    refresher = bot.RateRefresher(quotes)
+    version = bot._fx_version(db.get_conn(bot.DB_PATH))
+
+    assert asyncio.run(refresher.refresh()) == {"EUR": 1.2}
+    assert quotes.asked == [["ARS", "EUR"]]
+    assert (rows(bot, "ARS"), rows(bot, "EUR")) == (1, 2)
+    assert bot._fx_version(db.get_conn(bot.DB_PATH)) == version + 1
+    assert bot.rate_cache.snapshot()["EUR"] == 1.2
+
+    # ARS's stored rate is still old, but the provider just confirmed it
+    assert asyncio.run(refresher.refresh()) == {}
+    assert quotes.asked == [["ARS", "EUR"]]
+
+def test_currency_outside_the_catalogs_is_not_asked_for(stale):
+    bot = stale
+    with db.transaction(bot.DB_PATH) as conn:
+        conn.execute("INSERT INTO fx_rates(ts,currency,to_usd) VALUES(?,?,?)", (STALE, "XYZ", 5.0))
+    quotes = Quotes({})
+    asyncio.run(bot.RateRefresher(quotes).refresh())
+    assert quotes.asked == [["ARS", "EUR"]]
@@ -0,0 +1,60 @@
+# test_import.py
+# /import: equal lines of a statement each import once, a statement imported
+# again adds only what it did not have before, and bad lines are reported
+# without stopping the rest.
+import asyncio
+
+import pytest
+
+import db
+
+TENANT = 3
+HEADER = "Дата;Сумма;Счёт;Категория;Описание\n"
+LINES = [
+    "01.03.2025;-100;ARS (нал);еда;кофе\n",
+    "01.03.2025;-100;ARS (нал);еда;кофе\n",       # a second coffee, not a duplicate
+    "02.03.2025 09:30;5000;USD (нал);;зарплата\n",
+    "01.03.2025;-100;ARS (нал);еда;кофе\n",       # the day's third, out of order
+    "03.03.2025;-1 200,50;ARS (нал);неизвестная;\n",
+]
+
+def statement(tmp_path, lines, encoding="utf-8", name="statement.csv"):
+    path = tmp_path / name
+    path.write_text(HEADER + "".join(lines), encoding=encoding)
+    return str(path)
+
+@pytest.fixture
+def load(bot):
+    return lambda path: asyncio.run(bot.import_statement(path, tenant=TENANT))
+
+def test_statement_imports_once(bot, load, tmp_path):
+    path = statement(tmp_path, LINES)
+    assert load(path) == {"rows": 5, "inserted": 5, "duplicates": 0, "bad": 0, "errors": []}
+    balances = bot.sum_balances_by_account(TENANT)
+    assert (balances["ARS (нал)"], balances["USD (нал)"]) == (-1500.5, 5000)
+    assert load(path)["inserted"] == 0
+    # the same statement a day later: only the new line goes in
+    later = statement(tmp_path, LINES + ["04.03.2025;-7;ARS (нал);еда;\n"], name="later.csv")
+    assert load(later) == {"rows": 6, "inserted": 1, "duplicates": 5, "bad": 0, "errors": []}
+    assert bot.sum_balances_by_account(TENANT)["ARS (нал)"] == -1507.5
+
+def test_unknown_category_goes_to_other(bot, load, tmp_path):
+    load(statement(tmp_path, LINES[-1:]))
+    assert db.get_conn(bot.DB_PATH).execute(
+        "SELECT category FROM transactions WHERE tenant_id=?", (TENANT,)).fetchall() == [("прочее",)]
+
+def test_bad_lines_are_reported(load, tmp_path):
+    result = load(statement(tmp_path, ["31.02.2025;-1;ARS (нал);еда;\n", "01.03.2025;abc;ARS (нал);еда;\n",
+                                       "01.03.2025;-1;Нет такого;еда;\n"] + LINES[:1]))
+    assert (result["inserted"], result["bad"]) == (1, 3)
+    assert [error.split(":")[0] for error in result["errors"]] == ["2", "3", "4"]
+
+def test_cp1251_statement(bot, load, tmp_path):
+    assert load(statement(tmp_path, LINES[:1], encoding="cp1251"))["inserted"] == 1
+    assert bot.sum_balances_by_account(TENANT)["ARS (нал)"] == -100
+
+def test_missing_columns_refuse(load, tmp_path):
+    path = tmp_path / "bad.csv"
+    path.write_text("what;ever\n1;2\n", encoding="utf-8")
+    with pytest.raises(ValueError, match="колонки"):
+        load(str(path))
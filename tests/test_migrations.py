@@ -0,0 +1,65 @@
+# test_migrations.py
+# Migration 8 gives the rows written before tenancy to one chat: the one set
+# in DEFAULT_TENANT_ID, or the private chat of the only user who wrote them.
+# Anything else stops the upgrade before it changes the file.
+import pytest
+
+import db
+
+PRE_TENANCY = 7
+
+@pytest.fixture
+def legacy(tmp_path, monkeypatch):
+    """The bot module on a DB migrated only up to PRE_TENANCY; returns (bot, add_row)."""
+    import bot
+    path = str(tmp_path / "legacy.db")
+    monkeypatch.setattr(bot, "DB_PATH", path)
+    monkeypatch.delenv("DEFAULT_TENANT_ID", raising=False)
+    db.migrate(path, bot.MIGRATIONS[:PRE_TENANCY])
+
+    def add_row(user_id, account="ARS (нал)", amount=100.0):
+        with db.transaction(path) as conn:
+            conn.execute("INSERT INTO transactions(ts,user_id,username,type,category,account,amount,currency) "
+                         "VALUES('2024-05-01T10:00:00',?,NULL,'expense','еда',?,?,'ARS')", (user_id, account, amount))
+    yield bot, add_row
+    db.close_all()
+
+def tenants(path):
+    conn = db.get_conn(path)
+    return (conn.execute("SELECT tenant_id, COUNT(*) FROM transactions GROUP BY 1").fetchall(),
+            conn.execute("SELECT tenant_id, account, balance FROM account_balances").fetchall())
+
+def test_empty_ledger_migrates(legacy):
+    bot, _ = legacy
+    assert bot.init_db() == len(bot.MIGRATIONS)
+
+def test_several_users_without_owner_refuse_and_leave_the_file(legacy):
+    bot, add_row = legacy
+    add_row(101)
+    add_row(102)
+    with pytest.raises(RuntimeError, match="DEFAULT_TENANT_ID"):
+        bot.init_db()
+    assert db.schema_version(bot.DB_PATH) == PRE_TENANCY
+
+def test_configured_owner_gets_every_row(legacy, monkeypatch):
+    bot, add_row = legacy
+    add_row(101)
+    add_row(102, amount=50.0)
+    monkeypatch.setenv("DEFAULT_TENANT_ID", "-100777")
+    monkeypatch.setattr(bot, "DEFAULT_TENANT", -100777)
+    assert bot.init_db() == len(bot.MIGRATIONS)
+    assert tenants(bot.DB_PATH) == ([(-100777, 2)], [(-100777, "ARS (нал)", -150.0)])
+
+def test_single_user_ledger_goes_to_their_private_chat(legacy):
+    bot, add_row = legacy
+    add_row(101)
+    add_row(101)
+    assert bot.init_db() == len(bot.MIGRATIONS)
+    assert tenants(bot.DB_PATH) == ([(101, 2)], [(101, "ARS (нал)", -200.0)])
+    assert bot.sum_balances_by_account(101)["ARS (нал)"] == -200.0
+
+def test_rows_without_a_user_refuse(legacy):
+    bot, add_row = legacy
+    add_row(None)
+    with pytest.raises(RuntimeError):
+        bot.init_db()
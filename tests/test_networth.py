@@ -0,0 +1,71 @@
+# test_networth.py
+# networth_series() sweeps deltas and rate history once; every point must
+# equal the net worth computed directly from the rows and rates as of its mark.
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import db
+
+TENANT = 6
+NOW = datetime(2025, 6, 15, 12, 0)
+ROWS = [
+    ("2025-02-10T09:00:00", "income", None, "USD (нал)", 1000, "USD"),
+    ("2025-02-11T09:00:00", "income", None, "ARS (нал)", 500000, "ARS"),
+    ("2025-03-31T23:59:59", "expense", "еда", "ARS (нал)", 20000, "ARS"),
+    ("2025-04-01T00:00:00", "exchange_out", None, "USD (нал)", 100, "USD"),
+    ("2025-04-01T00:00:00", "exchange_in", None, "EUR (карта)", 90, "EUR"),
+    ("2025-04-20T10:00:00", "reconcile", None, "ARS (нал)", -5000, "ARS"),
+    ("2025-05-05T10:00:00", "income", None, "ETH (биржа А)", 2, "ETH"),     # no rate at all
+    ("2025-06-15T23:00:00", "expense", "еда", "EUR (карта)", 10, "EUR"),     # later today
+    ("2025-07-01T10:00:00", "expense", "еда", "USD (нал)", 1, "USD"),        # after now
+]
+RATES = [("2025-01-01T00:00:00", "ARS", 0.001), ("2025-04-15T12:00:00", "ARS", 0.0008),
+         ("2025-01-01T00:00:00", "EUR", 1.1), ("2025-05-20T00:00:00", "EUR", 1.2)]
+SIGN = {"income": 1, "exchange_in": 1, "reconcile": 1, "expense": -1, "exchange_out": -1}
+
+@pytest.fixture
+def ledger(bot):
+    asyncio.run(bot.write_ledger([bot.txn_row(ts, None, *row) for ts, *row in ROWS], tenant=TENANT))
+    asyncio.run(bot.write_ledger([bot.txn_row("2025-03-01T00:00:00", None, "income", None, "USD (нал)", 7, "USD")],
+                                 tenant=TENANT + 1))
+    with db.transaction(bot.DB_PATH) as conn:
+        conn.executemany("INSERT INTO fx_rates(ts,currency,to_usd) VALUES(?,?,?)", RATES)
+    return bot
+
+def direct(bot, mark, last):
+    account_ccy = bot.get_catalog(TENANT).account_ccy
+    cutoff = mark.date().isoformat() + "~" if last else mark.isoformat()
+    total = 0.0
+    for ts, ttype, _, account, amount, _ in ROWS:
+        if ts >= cutoff:
+            continue
+        ccy = account_ccy[account]
+        history = sorted((rts, rate) for rts, rccy, rate in RATES if rccy == ccy)
+        if ccy == "USD":
+            rate = 1.0
+        elif not history:
+            continue
+        else:
+            rate = ([rate for rts, rate in history if rts <= mark.isoformat()] or [history[0][1]])[-1]
+        total += SIGN[ttype] * amount * rate
+    return total
+
+@pytest.mark.parametrize("months, step", [(4, "month"), (3, "week"), (1, "month")])
+def test_series_matches_the_rows(ledger, months, step):
+    bot = ledger
+    marks = bot.networth_marks(months, step, NOW)
+    points, missing = bot.networth_series(marks, TENANT)
+    assert [mark for mark, _ in points] == marks
+    for k, (mark, usd) in enumerate(points):
+        assert usd == pytest.approx(direct(bot, mark, k == len(marks) - 1)), mark
+    assert missing == ["ETH"]
+
+@pytest.mark.parametrize("months, step, expected", [
+    (3, "month", ["2025-05-01", "2025-06-01"]),
+    (1, "week", ["2025-06-02", "2025-06-09"]),
+])
+def test_marks(bot, months, step, expected):
+    marks = bot.networth_marks(months, step, NOW)
+    assert [m.date().isoformat() for m in marks[:-1]] == expected and marks[-1] == NOW
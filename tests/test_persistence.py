@@ -0,0 +1,49 @@
+# test_persistence.py
+# A conversation step written by one worker is picked up by another before
+# its next update is matched, read ahead off the loop by ConversationPrefetch.
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from telegram import Update
+from telegram.ext import CommandHandler, MessageHandler, filters
+from telegram.ext._utils.trackingdict import TrackingDict
+
+from persistence import ConversationPrefetch, SharedConversationHandler, SQLitePersistence
+
+ASKED = 1
+
+def message(update_id, text):
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 1714557600, "text": text,
+        "chat": {"id": 7, "type": "private"}, "from": {"id": 7, "is_bot": False, "first_name": "u"}}}, None)
+
+async def _step(update, context):
+    return ASKED
+
+def conversation(store):
+    handler = SharedConversationHandler(
+        name="ask", persistence=store, entry_points=[CommandHandler("ask", _step)],
+        states={ASKED: [MessageHandler(filters.TEXT & ~filters.COMMAND, _step)]}, fallbacks=[])
+    handler._conversations = TrackingDict()     # as Application.initialize() leaves it
+    return handler
+
+@pytest.mark.filterwarnings("ignore::UserWarning")
+def test_step_from_another_worker_is_prefetched(bot, monkeypatch):
+    here, there = SQLitePersistence(bot.DB_PATH), SQLitePersistence(bot.DB_PATH)
+    handler, _ = conversation(here), conversation(there)
+    prefetch = ConversationPrefetch(here)
+    answer = message(2, "42")
+
+    async def scenario():
+        # the other worker took /ask and is now waiting for the answer
+        await there.commit_step("ask", (7, 7), ASKED, message(1, "/ask"),
+                                SimpleNamespace(user_data={}, chat_data={}))
+        keys = prefetch.check_update(answer)
+        assert keys == {(7, 7)}
+        await prefetch.handle_update(answer, None, keys, None)
+        # matching the update reads nothing more
+        monkeypatch.setattr(here, "_select_conversations", None)
+        return handler.check_update(answer)
+
+    assert asyncio.run(scenario())
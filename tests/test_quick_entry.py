@@ -0,0 +1,53 @@
+# test_quick_entry.py
+# parse_quick_line: a line is read into fields or refused as a whole, never
+# recorded with part of its amount taken for a name.
+import asyncio
+
+import pytest
+
+@pytest.fixture
+def parse(bot):
+    parser = asyncio.run(bot.tenant_catalog(0)).parser()
+    return lambda kind, line: bot.parse_quick_line(parser, kind, line)
+
+@pytest.mark.parametrize("line, amount", [
+    ("1500 еда ARS (нал)", 1500.0),
+    ("1 500 еда ARS (нал)", 1500.0),
+    ("1 500 еда ARS (нал)", 1500.0),
+    ("12 000,50 еда ARS (нал)", 12000.5),
+    ("1.500.000 еда ARS (нал)", 1500000.0),
+    ("1.500.000,25 еда ARS (нал)", 1500000.25),
+    ("1.5 еда ARS (нал)", 1.5),
+    ("2,75 еда ARS (нал)", 2.75),
+])
+def test_amounts(parse, line, amount):
+    e = parse("expense", line)
+    assert "error" not in e
+    assert (e["amount"], e["category"], e["account"]) == (amount, "еда", "ARS (нал)")
+
+@pytest.mark.parametrize("line", ["1 50 еда ARS (нал)", "1500 200 еда ARS (нал)", "1.500.00 еда ARS (нал)",
+                                  "1,500.5 еда ARS (нал)"])
+def test_stray_numbers_refuse_the_line(parse, line):
+    assert parse("expense", line)["error"]
+
+@pytest.mark.parametrize("kind, line", [("expense", "100 еда ARS (нал) @ 3"), ("income", "100 USD (нал) @ 1")])
+def test_rate_outside_exchange_refuses_the_line(parse, kind, line):
+    assert "/x" in parse(kind, line)["error"]
+
+def test_exchange(parse):
+    e = parse("exchange", "1 000 USD (нал) > ARS (нал) @ 1 # обменник")
+    assert "error" not in e
+    assert (e["amount"], e["from"], e["to"], e["rate"], e["note"]) == (1000.0, "USD (нал)", "ARS (нал)", 1.0, "обменник")
+
+def test_income_with_currency_and_note(parse):
+    e = parse("income", "50 000 USD нал # зарплата")
+    assert (e["amount"], e["currency"], e["account"], e["note"]) == (50000.0, "USD", "USD (нал)", "зарплата")
+
+def test_loose_names(parse):
+    e = parse("expense", "300 Еда ars нал")
+    assert (e["category"], e["account"]) == ("еда", "ARS (нал)")
+    assert parse("expense", "300 аренд usdt биржа a")["account"] == "USDT (биржа А)"
+
+def test_missing_fields_are_none(parse):
+    e = parse("expense", "300")
+    assert (e["amount"], e["category"], e["account"], e["words"]) == (300.0, None, None, False)
@@ -0,0 +1,121 @@
+# test_report_cache.py
+# ReportCache serves a report only while nothing it depends on changed:
+# writes made here vouch for the entries they cannot affect (rows_written,
+# rates_written) and drop the others; writes by another worker retire all.
+import asyncio
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+import db
+
+TENANT = 5
+CLOSED = (datetime(2025, 3, 1), datetime(2025, 3, 31, 23, 59, 59))
+
+@pytest.fixture
+def cached(bot):
+    asyncio.run(bot.write_ledger(rates={"ARS": 0.001, "EUR": 1.1}))
+    asyncio.run(bot.write_ledger([bot.txn_row("2025-03-10T10:00:00", None, "expense", "еда", "ARS (нал)",
+                                              1000, "ARS")], tenant=TENANT))
+    return bot
+
+def serve(bot, period, mode):
+    """(text, served from the cache); the text must match a fresh computation either way."""
+    if period == "today":
+        start, end = bot.parse_period("Сегодня")
+        open_end = True
+    else:
+        (start, end), open_end = CLOSED, False
+    hits = bot.report_cache.hits
+    text = bot.report_text(start, end, mode, TENANT, open_end)
+    assert text == bot.make_report_text(start, end, mode, TENANT)
+    return text, bot.report_cache.hits > hits
+
+def prime(bot):
+    for period in ("today", "closed"):
+        for mode in bot.REPORT_MODES:
+            assert not serve(bot, period, mode)[1]
+            assert serve(bot, period, mode)[1]
+
+def write(bot, txns=(), rates=None):
+    asyncio.run(bot.write_ledger(txns, rates, tenant=TENANT))
+
+def today_row(bot, ttype, category, amount, account="ARS (нал)", currency="ARS"):
+    return bot.txn_row(datetime.now().isoformat(), None, ttype, category, account, amount, currency)
+
+def test_expense_drops_only_periods_it_falls_in(cached):
+    bot = cached
+    prime(bot)
+    write(bot, [today_row(bot, "expense", "еда", 50)])
+    for mode in bot.REPORT_MODES:
+        assert not serve(bot, "today", mode)[1]
+        assert serve(bot, "closed", mode)[1]
+
+def test_income_keeps_every_report(cached):
+    bot = cached
+    prime(bot)
+    write(bot, [today_row(bot, "income", None, 50)])
+    for period in ("today", "closed"):
+        for mode in bot.REPORT_MODES:
+            assert serve(bot, period, mode)[1]
+
+def test_backdated_expense_drops_the_closed_period(cached):
+    bot = cached
+    prime(bot)
+    write(bot, [bot.txn_row("2025-03-20T08:00:00", None, "expense", "еда", "ARS (нал)", 10, "ARS")])
+    for mode in bot.REPORT_MODES:
+        assert not serve(bot, "closed", mode)[1]
+        assert serve(bot, "today", mode)[1]
+
+def test_rate_of_an_unused_currency_keeps_every_report(cached):
+    bot = cached
+    write(bot, [today_row(bot, "expense", "еда", 50)])
+    prime(bot)
+    write(bot, rates={"EUR": 1.2})
+    for period in ("today", "closed"):
+        for mode in bot.REPORT_MODES:
+            assert serve(bot, period, mode)[1]
+
+@pytest.mark.parametrize("period, mode, kept", [
+    ("closed", "latest", False),        # today's rate values every expense
+    ("today", "latest", False),
+    ("closed", "historical", True),     # the new rate applies from now on only
+    ("today", "historical", False),     # the period runs up to now
+])
+def test_rate_of_a_used_currency(cached, period, mode, kept):
+    bot = cached
+    write(bot, [today_row(bot, "expense", "еда", 50)])
+    prime(bot)
+    write(bot, rates={"ARS": 0.002})
+    assert serve(bot, period, mode)[1] is kept
+
+def test_first_rate_of_a_currency_drops_historical_reports_using_it(cached):
+    bot = cached
+    write(bot, [bot.txn_row("2025-03-12T10:00:00", None, "expense", "еда", "USDT (биржа А)", 20, "USDT")])
+    prime(bot)
+    # amounts dated before a currency's first rate are valued at that rate
+    write(bot, rates={"USDT": 1.0})
+    assert not serve(bot, "closed", "historical")[1]
+
+def test_write_by_another_worker_retires_reports(cached):
+    bot = cached
+    prime(bot)
+    conn = sqlite3.connect(bot.DB_PATH)
+    with conn:
+        conn.execute("INSERT INTO transactions(tenant_id,ts,type,category,account,amount,currency) "
+                     "VALUES(?,?,?,?,?,?,?)", (TENANT, "2025-03-11T00:00:00", "expense", "еда", "ARS (нал)", 7, "ARS"))
+    conn.close()
+    for mode in bot.REPORT_MODES:
+        assert not serve(bot, "closed", mode)[1]
+
+def test_other_tenants_writes_keep_reports(cached):
+    bot = cached
+    prime(bot)
+    asyncio.run(bot.write_ledger([bot.txn_row("2025-03-15T10:00:00", None, "expense", "еда", "ARS (нал)", 5, "ARS")],
+                                 tenant=TENANT + 1))
+    for period in ("today", "closed"):
+        for mode in bot.REPORT_MODES:
+            assert serve(bot, period, mode)[1]
+    assert db.get_conn(bot.DB_PATH).execute("SELECT COUNT(*) FROM transactions WHERE tenant_id=?",
+                                            (TENANT + 1,)).fetchone()[0] == 1
@@ -0,0 +1,62 @@
+# test_sharding.py
+# In sharded mode every chat's ledger lives in a file of its own, while rates
+# stay in DB_PATH; split_into_shards() moves a shared ledger over unchanged.
+import asyncio
+import os
+from datetime import datetime
+
+import pytest
+
+import db
+
+ROWS = {
+    11: [("2025-03-10T10:00:00", "expense", "еда", "ARS (нал)", 1000, "ARS"),
+         ("2025-03-11T10:00:00", "income", None, "USD (нал)", 50, "USD")],
+    22: [("2025-03-12T10:00:00", "expense", "аренда", "EUR (карта)", 300, "EUR")],
+}
+
+MARCH = (datetime(2025, 3, 1), datetime(2025, 3, 31, 23, 59, 59))
+
+def write(bot):
+    asyncio.run(bot.write_ledger(rates={"ARS": 0.001, "EUR": 1.1}))
+    for tenant, rows in ROWS.items():
+        asyncio.run(bot.write_ledger([bot.txn_row(ts, None, *row) for ts, *row in rows], tenant=tenant))
+
+def state(bot, tenant):
+    return bot.sum_balances_by_account(tenant), bot.make_report_text(*MARCH, "historical", tenant)
+
+def ledger(bot, path):
+    return db.get_conn(path).execute("SELECT tenant_id, COUNT(*) FROM transactions GROUP BY 1").fetchall()
+
+@pytest.fixture
+def sharded(bot, tmp_path, monkeypatch):
+    def switch():
+        monkeypatch.setattr(bot, "STORAGE_MODE", "sharded")
+        monkeypatch.setattr(bot, "SHARD_DIR", str(tmp_path / "tenants"))
+        monkeypatch.setattr(bot, "_ready_shards", set())
+        bot.report_cache.clear()
+    return bot, switch
+
+def test_each_tenant_writes_its_own_file(sharded):
+    bot, switch = sharded
+    switch()
+    write(bot)
+    assert ledger(bot, bot.DB_PATH) == []
+    for tenant, rows in ROWS.items():
+        path = bot.ledger_path(tenant)
+        assert os.path.basename(path) == f"tenant_{tenant}.db"
+        assert ledger(bot, path) == [(tenant, len(rows))]
+    assert bot.sum_balances_by_account(11)["ARS (нал)"] == -1000
+    assert bot.sum_balances_by_account(22)["EUR (карта)"] == -300
+    assert bot.rate_cache.snapshot()["EUR"] == 1.1
+
+def test_split_keeps_balances_and_reports(sharded):
+    bot, switch = sharded
+    write(bot)
+    before = {tenant: state(bot, tenant) for tenant in ROWS}
+    switch()
+    assert bot.split_into_shards() == {tenant: len(rows) for tenant, rows in ROWS.items()}
+    assert bot.split_into_shards() == {}
+    for tenant in ROWS:
+        assert ledger(bot, bot.ledger_path(tenant)) == [(tenant, len(ROWS[tenant]))]
+        assert state(bot, tenant) == before[tenant]
@@ -0,0 +1,31 @@
+# test_startup.py
+# A start-up that fails (Telegram or the DB unreachable) is retried with the
+# error on /ready until it succeeds.
+import asyncio
+from types import SimpleNamespace
+
+def test_startup_retries_until_it_succeeds(bot, monkeypatch):
+    attempts, reported = [], []
+
+    async def start_runtime(app):
+        reported.append(bot.readiness(app, {"ok": True}))
+        attempts.append(app)
+        if len(attempts) < 3:
+            raise RuntimeError(f"telegram down #{len(attempts)}")
+        app.running = True
+
+    monkeypatch.setattr(bot, "start_runtime", start_runtime)
+    monkeypatch.setattr(bot, "STARTUP_RETRY_SECS", (0,))
+    monkeypatch.setattr(bot, "startup_error", None)
+    app = SimpleNamespace(running=False)
+    asyncio.run(bot._startup(app))
+
+    assert len(attempts) == 3
+    assert [ready for ready, _ in reported] == [False] * 3
+    assert [report["ptb"].get("error") for _, report in reported] == [None, "telegram down #1", "telegram down #2"]
+    assert bot.startup_error is None
+    assert bot.readiness(app, {"ok": True})[0]
+    assert not bot.readiness(app, {"ok": False})[0]
+
+def test_httpx_is_imported_by_the_http_provider_only(bot):
+    assert not hasattr(bot, "httpx")
@@ -0,0 +1,39 @@
+# test_update_processor.py
+# ChatOrderedUpdateProcessor runs one chat's updates one after another, while
+# a chat with a backlog never holds the handler slots other chats need.
+import asyncio
+
+from telegram import Update
+
+from persistence import ChatOrderedUpdateProcessor, current_update_id
+
+def update(update_id, chat_id):
+    return Update.de_json({"update_id": update_id, "message": {
+        "message_id": update_id, "date": 1714557600, "chat": {"id": chat_id, "type": "private"}, "text": "x"}}, None)
+
+def test_chat_order_and_free_slots():
+    async def scenario():
+        processor = ChatOrderedUpdateProcessor(2, max_pending=10)
+        gate, done = asyncio.Event(), []
+
+        async def handler(u, wait):
+            assert current_update_id.get() == u.update_id
+            if wait:
+                await gate.wait()
+            done.append(u.update_id)
+
+        busy = [update(i, 1) for i in range(1, 6)]
+        for u in busy:
+            assert processor.admit(u.update_id)
+        tasks = [asyncio.create_task(processor.process_update(u, handler(u, True))) for u in busy]
+        await asyncio.sleep(0)
+        # chat 1 holds one slot; its backlog waits for the chat, not for a slot
+        await asyncio.wait_for(processor.process_update(update(9, 2), handler(update(9, 2), False)), 1)
+        assert done == [9]
+        assert processor.pending == 5
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert done == [9, 1, 2, 3, 4, 5]
+        assert processor.pending == 0 and not processor._chats
+
+    asyncio.run(scenario())
@@ -0,0 +1,61 @@
+# test_webhook.py
+# The webhook answers a Telegram redelivery of an accepted update without
+# parsing it again, but an update it refused or could not parse must be
+# taken when Telegram sends it again.
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from persistence import ChatOrderedUpdateProcessor, UpdateDedupe
+
+MESSAGE = {"message_id": 1, "date": 1714557600, "chat": {"id": 7, "type": "private"}, "text": "/start"}
+
+def test_dedupe_claims_once_and_release_reopens(tmp_path):
+    dedupe = UpdateDedupe(str(tmp_path / "seen.db"))
+    assert dedupe.claim(10)
+    assert not dedupe.claim(10)
+    dedupe.release(10)
+    assert dedupe.claim(10)
+
+@pytest.fixture
+def flask_webhook(bot, monkeypatch):
+    """(post(body), app) against create_app() with PTB faked by a queue on a loop of its own."""
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    app = SimpleNamespace(running=True, bot=None, update_queue=asyncio.Queue(),
+                          update_processor=ChatOrderedUpdateProcessor(4, max_pending=2))
+    monkeypatch.setattr(bot, "application", app)
+    monkeypatch.setattr(bot, "loop", loop)
+    monkeypatch.setattr(bot, "update_dedupe", UpdateDedupe(bot.DB_PATH))
+    client = bot.create_app().test_client()
+
+    def post(body):
+        return client.post(f"/{bot.BOT_TOKEN}", json=body).status_code
+    yield post, app
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+def test_flask_takes_an_update_once(flask_webhook):
+    post, app = flask_webhook
+    assert post({"update_id": 1, "message": MESSAGE}) == 200
+    assert post({"update_id": 1, "message": MESSAGE}) == 200
+    assert app.update_queue.qsize() == 1
+
+def test_flask_releases_an_update_it_cannot_parse(flask_webhook):
+    post, app = flask_webhook
+    assert post({"update_id": 2, "message": {"text": "no chat"}}) == 400
+    assert post({"update_id": 2, "message": MESSAGE}) == 200
+    assert app.update_queue.qsize() == 1
+
+def test_flask_releases_an_update_refused_while_busy(flask_webhook):
+    post, app = flask_webhook
+    app.update_processor.admit(98)
+    app.update_processor.admit(99)      # max_pending=2: full
+    assert post({"update_id": 3, "message": MESSAGE}) == 503
+    app.update_processor.release(99)
+    assert post({"update_id": 3, "message": MESSAGE}) == 200
+    assert app.update_queue.qsize() == 1